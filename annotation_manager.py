@@ -1,7 +1,19 @@
 #!/usr/bin/env python
+from __future__ import print_function
+
+import argparse
+import io
+import multiprocessing
 import sys
+import time
+from collections import OrderedDict
 
-from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.AnnotationManager import AnnotationManager, SyncStatistics
+from annotation_manager.cache import DEFAULT_CACHE_PATH
+from annotation_manager.distributed import DistributedSyncCoordinator, run_worker
+from annotation_manager.progress import ProgressReporter, ProgressEvent
+from annotation_manager.server import LibraryServer, DEFAULT_SOCKET_PATH
+from annotation_manager.text_index import AnnotationTextIndex, DEFAULT_INDEX_PATH
 
 
 class AnnotationManagerCLI(object):
@@ -9,10 +21,287 @@ class AnnotationManagerCLI(object):
     def __init__(self):
         super(AnnotationManagerCLI, self).__init__()
 
-        self.manager = AnnotationManager()
+        self.manager = AnnotationManager(cache_path=DEFAULT_CACHE_PATH)
 
     def execute_commandline(self, argv):
-        pass
+        parser = argparse.ArgumentParser(prog=argv[0], description="Document annotation manager and synchronizer.")
+        subparsers = parser.add_subparsers(dest="command")
+
+        sync_parser = subparsers.add_parser("sync",
+                                            help="export annotations missing in the destination from the source")
+        sync_parser.add_argument("source")
+        sync_parser.add_argument("destination")
+        sync_parser.add_argument("--stats", action="store_true", help="print statistics of the sync")
+        sync_parser.add_argument("--progress", action="store_true", help="print progress events to stderr")
+        sync_parser.add_argument("--slow-document-timeout", type=float, default=None,
+                                 help="report documents processed longer than this many seconds")
+
+        batch_parser = subparsers.add_parser(
+            "batch", help="run all syncs listed in a job file in one process",
+            description="Each non-empty line of the job file not starting with # contains a source and a destination "
+                        "separated by a tab. Libraries, plugins and caches are shared by all the jobs.")
+        batch_parser.add_argument("job_file")
+        batch_parser.add_argument("--jobs", type=int, default=1, help="number of worker processes")
+        batch_parser.add_argument("--stats", action="store_true", help="print statistics of the jobs")
+
+        coordinate_parser = subparsers.add_parser(
+            "coordinate", help="sync with the annotations compared by workers sharing a work queue",
+            description="Matches the documents, puts the document pairs into the work queue and exports the results "
+                        "of the workers. Workers on other machines are started by the work command.")
+        coordinate_parser.add_argument("source")
+        coordinate_parser.add_argument("destination")
+        coordinate_parser.add_argument("queue", help="path to the work queue on storage shared with the workers")
+        coordinate_parser.add_argument("--shards", type=int, default=16, help="number of shards")
+        coordinate_parser.add_argument("--local-workers", type=int, default=0,
+                                       help="number of worker processes to start on this machine")
+        coordinate_parser.add_argument("--timeout", type=float, default=DistributedSyncCoordinator.DEFAULT_TIMEOUT,
+                                       help="seconds to wait for the workers to process all shards")
+        coordinate_parser.add_argument("--stats", action="store_true", help="print statistics of the sync")
+
+        work_parser = subparsers.add_parser("work", help="process shards of a work queue until none are left")
+        work_parser.add_argument("queue")
+        work_parser.add_argument("--lease", type=float, default=600.0,
+                                 help="seconds after which an unfinished shard is given to another worker")
+
+        export_parser = subparsers.add_parser("export", help="export the whole library of the source")
+        export_parser.add_argument("source")
+        export_parser.add_argument("destination")
+
+        serve_parser = subparsers.add_parser(
+            "serve", help="keep the imported libraries loaded and answer queries over a Unix socket")
+        serve_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="path to the socket")
+
+        index_parser = subparsers.add_parser("index", help="update the full-text index of annotations of the sources")
+        index_parser.add_argument("sources", nargs="+")
+        index_parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="path to the index")
+
+        search_parser = subparsers.add_parser("search", help="search the texts and comments of indexed annotations")
+        search_parser.add_argument("query")
+        search_parser.add_argument("--limit", type=int, default=20, help="maximum number of results")
+        search_parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="path to the index")
+
+        cache_parser = subparsers.add_parser("cache", help="maintain the persistent cache")
+        cache_parser.add_argument("action", choices=("stats", "prune", "clear", "verify"))
+        cache_parser.add_argument("--namespace", default=None, help="only clear this namespace")
+        cache_parser.add_argument("--max-age", type=float, default=None,
+                                  help="prune also the values not used for this many days")
+
+        arguments = parser.parse_args([self._decode(argument) for argument in argv[1:]])
+
+        if arguments.command == "sync":
+            if arguments.slow_document_timeout is not None:
+                self.manager.progress = ProgressReporter(arguments.slow_document_timeout)
+            if arguments.progress:
+                self.manager.progress.subscribe(self._print_event)
+            return self._print_statistics([self.manager.sync(arguments.source, arguments.destination)],
+                                          arguments.stats)
+
+        if arguments.command == "batch":
+            jobs = self.read_job_file(arguments.job_file)
+            start_time = time.time()
+            statistics = self.run_jobs(jobs, arguments.jobs)
+            return self._print_statistics(statistics, arguments.stats, time.time() - start_time)
+
+        if arguments.command == "coordinate":
+            return self._print_statistics(
+                [self.manager.distributed_sync(arguments.source, arguments.destination, arguments.queue,
+                                               arguments.shards, arguments.local_workers, arguments.timeout)],
+                arguments.stats)
+
+        if arguments.command == "export":
+            self.manager.export_library(arguments.source, arguments.destination)
+            return 0
+
+        if arguments.command == "serve":
+            LibraryServer(self.manager, arguments.socket).serve()
+            return 0
+
+        if arguments.command == "index":
+            index = AnnotationTextIndex(arguments.index)
+            try:
+                print("%i documents reindexed" % self.manager.update_text_index(arguments.sources, index))
+            finally:
+                index.close()
+            return 0
+
+        if arguments.command == "search":
+            index = AnnotationTextIndex(arguments.index)
+            try:
+                for result in index.search(arguments.query, arguments.limit):
+                    print(unicode(result))
+            finally:
+                index.close()
+            return 0
+
+        if arguments.command == "cache":
+            return self.maintain_cache(arguments.action, arguments.namespace, arguments.max_age)
+
+        if arguments.command == "work":
+            self.manager.install_conversion_cache()
+            run_worker(arguments.queue, lease=arguments.lease)
+            return 0
+
+        return 1
+
+    def maintain_cache(self, action, namespace=None, max_age=None):
+        cache = self.manager.open_cache()
+        try:
+            if action == "stats":
+                statistics = cache.get_statistics()
+                for namespace_statistics in statistics:
+                    print(namespace_statistics)
+                print("%i namespaces, %i bytes in total (budget %s) in %s" % (
+                    len(statistics), cache.get_size(), cache.budget, cache.path))
+            elif action == "prune":
+                print("%i values removed" % cache.prune(max_age * 24 * 3600 if max_age is not None else None))
+            elif action == "clear":
+                print("%i values removed" % cache.clear(namespace))
+            elif action == "verify":
+                problems = cache.verify()
+                for problem in problems:
+                    print(problem)
+                print("%i problems found" % len(problems))
+                return 1 if len(problems) > 0 else 0
+        finally:
+            cache.close()
+
+        return 0
+
+    def run_jobs(self, jobs, processes=1):
+        """Run the given sync jobs.
+
+        The jobs sharing a source or a destination are grouped (see :py:meth:`group_jobs`) and each group runs in a
+        single process, so every source is imported only once per group and no destination is written by two
+        processes at once. With more than one process, the groups are distributed among the worker processes.
+
+        :param jobs: Tuples (source, destination).
+        :type jobs: list of tuple
+        :param int processes: Number of worker processes.
+        :return: Statistics of the jobs (in the order of the jobs).
+        :rtype: list of SyncStatistics
+        """
+        groups = self.group_jobs(jobs)
+
+        if processes <= 1 or len(groups) <= 1:
+            results = [_run_job_group(group, self.manager) for group in groups]
+        else:
+            # the plugins are already loaded, so the forked workers don't discover them again
+            pool = multiprocessing.Pool(min(processes, len(groups)))
+            try:
+                results = pool.map(_run_job_group, groups, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        statistics = [None] * len(jobs)
+        for group_result in results:
+            for index, job_statistics in group_result:
+                statistics[index] = job_statistics
+
+        return statistics
+
+    @staticmethod
+    def group_jobs(jobs):
+        """Group the jobs that are connected by sharing a source or a destination.
+
+        :param jobs: Tuples (source, destination).
+        :type jobs: list of tuple
+        :return: The groups, each a list of tuples (index of the job, job) in the order of the jobs.
+        :rtype: list of list
+        """
+        # union-find over the sources and destinations
+        parents = {}
+
+        def find(endpoint):
+            while parents.setdefault(endpoint, endpoint) != endpoint:
+                parents[endpoint] = parents[parents[endpoint]]
+                endpoint = parents[endpoint]
+            return endpoint
+
+        for source, destination in jobs:
+            # a library may be the source of one job and the destination of another
+            parents[find(source)] = find(destination)
+
+        groups = OrderedDict()
+        for index, job in enumerate(jobs):
+            groups.setdefault(find(job[0]), []).append((index, job))
+
+        return list(groups.values())
+
+    @staticmethod
+    def read_job_file(path):
+        """Read sync jobs from a job file.
+
+        :param basestring path: Path to the job file.
+        :return: Tuples (source, destination).
+        :rtype: list of tuple
+        """
+        jobs = []
+        with io.open(path, encoding='utf-8') as job_file:
+            for line_number, line in enumerate(job_file, 1):
+                line = line.strip()
+                if len(line) == 0 or line.startswith(u"#"):
+                    continue
+
+                parts = [part.strip() for part in line.split(u"\t") if len(part.strip()) > 0]
+                if len(parts) != 2:
+                    raise ValueError("%s:%i: expected a source and a destination separated by a tab" %
+                                     (path, line_number))
+                jobs.append(tuple(parts))
+
+        return jobs
+
+    @staticmethod
+    def _print_statistics(statistics, print_statistics, total_duration=None):
+        failed = [job_statistics for job_statistics in statistics if job_statistics.error is not None]
+
+        if print_statistics:
+            for job_statistics in statistics:
+                print(job_statistics)
+            if total_duration is not None:
+                print("%i jobs (%i failed): %i documents matched, %i annotations exported in %.2f s" % (
+                    len(statistics), len(failed), sum(s.documents_matched for s in statistics),
+                    sum(s.annotations_exported for s in statistics), total_duration))
+
+        for job_statistics in failed:
+            sys.stderr.write("%s -> %s failed: %s\n" % (job_statistics.source, job_statistics.destination,
+                                                         job_statistics.error))
+
+        return 1 if len(failed) > 0 else 0
+
+    @staticmethod
+    def _print_event(event):
+        if event.kind != ProgressEvent.DOCUMENT_DISCOVERED:
+            sys.stderr.write("%s\n" % event)
+
+    @staticmethod
+    def _decode(argument):
+        return argument.decode(sys.getfilesystemencoding()) if isinstance(argument, bytes) else argument
+
+
+# manager of a worker process of AnnotationManagerCLI.run_jobs()
+_worker_manager = None
+
+
+def _run_job_group(group, manager=None):
+    global _worker_manager
+
+    if manager is None:
+        if _worker_manager is None:
+            _worker_manager = AnnotationManager(cache_path=DEFAULT_CACHE_PATH)
+        manager = _worker_manager
+
+    results = []
+    for index, (source, destination) in group:
+        try:
+            statistics = manager.sync(source, destination)
+        except Exception as e:
+            statistics = SyncStatistics(source, destination)
+            statistics.error = str(e)
+        results.append((index, statistics))
+
+    return results
+
 
 if __name__ == '__main__':
     # run CLI
@@ -3,10 +3,19 @@ import logging
 import os
 import pkgutil
 import sys
+import time
 
 from annotation_manager.exporter import AnnotationExporterFactory
 from annotation_manager.importer import AnnotationImporterFactory
-from annotation_manager.common_representation import DocumentLibrary
+from annotation_manager.common_representation import DocumentLibrary, LibraryCandidates, set_conversion_cache, \
+    add_conversion_listener, remove_conversion_listener
+from annotation_manager.cache import Cache
+from annotation_manager.conversion_cache import ConversionCache
+from annotation_manager.distributed import DistributedSyncCoordinator, run_local_workers
+from annotation_manager.merge import MergedDocumentLibrary
+from annotation_manager.progress import ProgressReporter, ProgressEvent
+from annotation_manager.snapshot import write_snapshot
+from annotation_manager.watcher import create_watcher
 
 logging.basicConfig()
 
@@ -31,9 +40,38 @@ class AnnotationManager(object):
     _destination_importer = None
     _exporter = None
 
-    def __init__(self, source=None, destination=None):
+    _common_documents = None
+    # tuple (source library, its LibraryCandidates) for the predicate pushdown
+    _candidates = None
+
+    # if True, the keys of the source documents are passed to the destination importer, so that it can skip loading
+    # the documents that cannot match
+    predicate_pushdown = True
+    # the SHA1 hashes of the source documents are computed for the pushdown only if at most this many are unknown
+    pushdown_hash_limit = 256
+
+    # path to the persistent cache of conversions (such as DEFAULT_CACHE_PATH), None to disable it
+    cache_path = None
+    # limit of the total size of the cached values in bytes (None for no limit)
+    cache_budget = Cache.DEFAULT_BUDGET
+    # namespace -> limit of the size of its cached values in bytes
+    cache_namespace_budgets = {ConversionCache.NAMESPACE: 256 * 1024 * 1024}
+
+    # plugin directories whose plugins have already been loaded (by any instance)
+    _loaded_plugin_paths = set()
+
+    def __init__(self, source=None, destination=None, cache_path=None):
+        """
+        :param source: The source of :py:meth:`sync_and_export_annotations`.
+        :param destination: The destination of :py:meth:`sync_and_export_annotations`.
+        :param basestring cache_path: Path to the persistent cache of the conversions done by this manager (overrides
+                                      the class default, which disables the cache).
+        """
         super(AnnotationManager, self).__init__()
 
+        if cache_path is not None:
+            self.cache_path = cache_path
+
         this_script_path = os.path.dirname(os.path.realpath(__file__))
         additional_plugin_dirs = [
             # ./annotation_manager/plugins
@@ -44,9 +82,19 @@ class AnnotationManager(object):
 
         AnnotationManager.load_plugins(*additional_plugin_dirs)
 
+        # this manager's cache of conversions, installed by each of its operations
+        self._conversion_cache = ConversionCache(self.open_cache()) if self.cache_path is not None else None
+
         self._importer_factories = []
         self._exporter_factories = []
 
+        # publisher of the progress events of the syncs run by this manager
+        self.progress = ProgressReporter()
+
+        # importers and exporters reused by sync(), keyed by their source/destination
+        self._importers = {}
+        self._exporters = {}
+
         if hasattr(AnnotationImporterFactory, "registered"):
             for factory in AnnotationImporterFactory.registered:
                 self.add_importer_factory(factory)
@@ -58,6 +106,25 @@ class AnnotationManager(object):
         self.import_source(source)
         self.import_destination(destination)
 
+    def open_cache(self):
+        """Open the persistent cache with the budgets configured for this manager.
+
+        :rtype: Cache
+        """
+        if self.cache_path is None:
+            raise ValueError("The cache is disabled")
+
+        return Cache(self.cache_path, self.cache_budget, self.cache_namespace_budgets)
+
+    def install_conversion_cache(self):
+        """Make the conversion functions use the cache of this manager (or no cache, if it has none).
+
+        The conversion functions use a single process-wide cache, so every operation of a manager installs its cache
+        first. Code converting annotations outside of the operations of a manager (such as a worker of a distributed
+        sync) calls this itself.
+        """
+        set_conversion_cache(self._conversion_cache)
+
     def get_source_library(self):
         if self._source_library is None and self._source_importer is not None:
             self._source_library = self._source_importer.get_annotated_library()
@@ -66,44 +133,438 @@ class AnnotationManager(object):
 
     def get_destination_library(self):
         if self._destination_library is None and self._destination_importer is not None:
-            self._destination_library = self._destination_importer.get_annotated_library()
+            candidates = self._get_candidates(self.get_source_library()) if self._source_importer is not None else None
+            self._destination_library = self._destination_importer.get_annotated_library(candidates)
 
         return self._destination_library
 
     def import_source(self, source):
         if source is not None:
             self._source = source
-            for factory in self._importer_factories:
-                importer = factory.get_importer_for_source(self._source)
-                if importer is not None:
-                    self._source_importer = importer
-                    break
+            importer = self.find_importer(self._source)
+            if importer is not None:
+                self._source_importer = importer
 
     def import_destination(self, destination):
         if destination is not None:
             self._destination = destination
-            for factory in self._importer_factories:
-                importer = factory.get_importer_for_source(self._destination)
-                if importer is not None:
-                    self._destination_importer = importer
-                    break
-            for factory in self._exporter_factories:
-                exporter = factory.get_exporter_for_destination(self._destination)
-                if exporter is not None:
-                    self._exporter = exporter
-                    break
+            importer = self.find_importer(self._destination)
+            if importer is not None:
+                self._destination_importer = importer
+            exporter = self.find_exporter(self._destination)
+            if exporter is not None:
+                self._exporter = exporter
+
+    def save_source_snapshot(self, path, convert_forms=False):
+        """Write the source library to a snapshot file, which can be later used as a source itself.
+
+        Refreshing an existing snapshot only reloads the documents whose annotations changed.
+
+        :param basestring path: Path to the snapshot file.
+        :param bool convert_forms: Whether to store both the bbox and pdfloc forms of all annotations.
+        :return: Number of documents whose annotations had to be (re)loaded.
+        :rtype: int
+        """
+        self.install_conversion_cache()
+        return write_snapshot(self.get_source_library(), path, convert_forms)
+
+    def find_importer(self, source):
+        """Get an importer for the given source from the first registered factory that handles it.
+
+        :param source: The source.
+        :return: The importer, or None if no factory handles the source.
+        :rtype: AnnotationImporter
+        """
+        for factory in self._importer_factories:
+            importer = factory.get_importer_for_source(source)
+            if importer is not None:
+                return importer
+        return None
+
+    def find_exporter(self, destination):
+        """Get an exporter for the given destination from the first registered factory that handles it.
+
+        :param destination: The destination.
+        :return: The exporter, or None if no factory handles the destination.
+        :rtype: AnnotationExporter
+        """
+        for factory in self._exporter_factories:
+            exporter = factory.get_exporter_for_destination(destination)
+            if exporter is not None:
+                return exporter
+        return None
+
+    def merge_sources(self, sources, fan_out=False):
+        """Merge the annotations of any number of sources into a single canonical library.
+
+        The documents of all sources are matched in one pass, and the annotations of matching documents are
+        deduplicated by grouping them by their keys, so no pairwise syncs are needed.
+
+        :param sources: The sources to merge.
+        :type sources: list
+        :param bool fan_out: If True, export the merged annotations back to every source that has an exporter, so
+                             that all of them end up with the same annotations.
+        :return: The merged library.
+        :rtype: MergedDocumentLibrary
+        """
+        self.install_conversion_cache()
+
+        importers = []
+        for source in sources:
+            importer = self.find_importer(source)
+            if importer is None:
+                raise ValueError("No importer found for source %s" % source)
+            importers.append(importer)
+
+        merged_library = MergedDocumentLibrary([importer.get_annotated_library() for importer in importers])
+
+        if fan_out:
+            for index, source in enumerate(sources):
+                exporter = self.find_exporter(source)
+                if exporter is None:
+                    log.warning("No exporter found for source %s, not exporting the merged annotations to it", source)
+                    continue
+
+                for merged_document in merged_library.get_documents():
+                    if len(merged_document.members) == 1:
+                        continue
+
+                    for document in merged_document.get_members_from(index):
+                        _, missing_annotations, _ = merged_document.find_common_annotations(document)
+                        if len(missing_annotations) > 0:
+                            exporter.add_annotations_to_document(document, missing_annotations)
+
+                exporter.flush()
+
+        return merged_library
 
     def sync_and_export_annotations(self):
+        self.install_conversion_cache()
+        self.progress.emit(ProgressEvent.SYNC_STARTED, details=u"%s -> %s" % (self._source, self._destination))
+        self._emit_discovered(self.get_source_library(), self.get_destination_library())
+
+        common = self._get_common_documents()
+
+        try:
+            for (source_document, destination_document) in self._emit_matched(common):
+                self._sync_document_pair(source_document, destination_document)
+            self._exporter.flush()
+        finally:
+            self.progress.emit(ProgressEvent.SYNC_FINISHED)
+
+    def sync(self, source, destination):
+        """Export the annotations missing in the destination from the source.
+
+        Unlike :py:meth:`sync_and_export_annotations`, this doesn't change the source and destination of this manager.
+        The importers and exporters (and thus the imported libraries with their cached annotation sets) are kept
+        between the calls, so running many syncs sharing sources or destinations in one manager pays for each import
+        only once.
+
+        :param source: The source.
+        :param destination: The destination.
+        :return: Statistics of the sync.
+        :rtype: SyncStatistics
+        """
+        self.install_conversion_cache()
+
+        statistics = SyncStatistics(source, destination)
+        start_time = time.time()
+        self.progress.emit(ProgressEvent.SYNC_STARTED, details=u"%s -> %s" % (source, destination))
+
+        try:
+            source_library, destination_library, exporter = self._get_sync_endpoints(source, destination)
+            statistics.import_duration = time.time() - start_time
+            self._emit_discovered(source_library, destination_library)
+
+            common, _, _ = source_library.find_common_documents(destination_library)
+
+            for (source_document, destination_document) in self._emit_matched(common):
+                statistics.documents_matched += 1
+                statistics.annotations_exported += self._sync_document_pair(source_document, destination_document,
+                                                                            exporter)
+            exporter.flush()
+        finally:
+            statistics.duration = time.time() - start_time
+            self.progress.emit(ProgressEvent.SYNC_FINISHED, duration=statistics.duration, details=unicode(statistics))
+
+        return statistics
+
+    def distributed_sync(self, source, destination, queue_path, shard_count=16, local_workers=0,
+                         timeout=DistributedSyncCoordinator.DEFAULT_TIMEOUT):
+        """Export the annotations missing in the destination from the source, with the annotations compared by
+        workers claiming shards of the document pairs from a work queue.
+
+        This manager is the coordinator and the only writer to the destination. Workers on other machines are started
+        by ``annotation_manager.py work QUEUE`` (they need to see the queue and the documents under the same paths).
+
+        :param source: The source.
+        :param destination: The destination.
+        :param basestring queue_path: Path to the work queue database on storage shared with the workers.
+        :param int shard_count: Number of shards to partition the document pairs into.
+        :param int local_workers: Number of worker processes to start on this machine.
+        :param float timeout: Maximum time to wait for the workers in seconds (None to wait indefinitely).
+        :return: Statistics of the sync, with an error if some shards failed even after retrying.
+        :rtype: SyncStatistics
+        """
+        statistics = SyncStatistics(source, destination)
+        start_time = time.time()
+
+        source_library, destination_library, exporter = self._get_sync_endpoints(source, destination)
+        statistics.import_duration = time.time() - start_time
+
+        common, _, _ = source_library.find_common_documents(destination_library)
+        statistics.documents_matched = len(common)
+
+        coordinator = DistributedSyncCoordinator(queue_path, destination_library, exporter)
+        try:
+            coordinator.submit(common, shard_count)
+            # the local workers inherit the installed cache
+            self.install_conversion_cache()
+            workers = run_local_workers(queue_path, local_workers)
+            try:
+                statistics.annotations_exported = coordinator.collect(timeout)
+            except RuntimeError as e:
+                statistics.error = str(e)
+                for worker in workers:
+                    worker.terminate()
+            for worker in workers:
+                worker.join()
+
+            failed = coordinator.get_failed_shards()
+            if statistics.error is None and len(failed) > 0:
+                statistics.error = "%i shards failed (shard %i: %s), see %s" % (len(failed), failed[0][0], failed[0][1],
+                                                                               queue_path)
+        finally:
+            coordinator.close()
+
+        statistics.duration = time.time() - start_time
+
+        return statistics
+
+    def _get_sync_endpoints(self, source, destination):
+        """Return the source library, destination library and destination exporter, reusing the importers and
+        exporters of previous syncs.
+
+        :rtype: tuple
+        """
+        if destination not in self._exporters:
+            self._exporters[destination] = self.find_exporter(destination)
+
+        source_importer = self.get_importer(source)
+        destination_importer = self.get_importer(destination)
+        exporter = self._exporters[destination]
+
+        if source_importer is None:
+            raise ValueError("No importer found for source %s" % source)
+        if destination_importer is None or exporter is None:
+            raise ValueError("No importer or exporter found for destination %s" % destination)
+
+        source_library = source_importer.get_annotated_library()
+        destination_library = destination_importer.get_annotated_library(self._get_candidates(source_library))
+
+        return source_library, destination_library, exporter
+
+    def get_library(self, source):
+        """Return the library of the given source, importing it on the first request.
+
+        The importer (and thus the library with its indexes and cached annotation sets) is shared with
+        :py:meth:`sync`.
+
+        :param source: The source.
+        :rtype: DocumentLibrary
+        """
+        importer = self.get_importer(source)
+        if importer is None:
+            raise ValueError("No importer found for source %s" % source)
+        return importer.get_annotated_library()
+
+    def export_library(self, source, destination):
+        """Export the whole library of the source (not only the annotations missing in the destination).
+
+        :param source: The source.
+        :param destination: The destination.
+        """
+        exporter = self.find_exporter(destination)
+        if exporter is None:
+            raise ValueError("No exporter found for destination %s" % destination)
+        self.install_conversion_cache()
+        exporter.export_library(self.get_library(source))
+
+    def update_text_index(self, sources, index):
+        """Update the full-text index of annotation texts and comments with the libraries of the given sources.
+
+        :param sources: The sources; each library is indexed under its source.
+        :type sources: list
+        :param AnnotationTextIndex index: The index.
+        :return: Number of reindexed documents.
+        :rtype: int
+        """
+        return sum(index.update(self.get_library(source), unicode(source)) for source in sources)
+
+    def forget_libraries(self, source=None):
+        """Drop the importers (and libraries) kept for :py:meth:`sync` and :py:meth:`get_library`.
+
+        :param source: The source whose importer is dropped, or None to drop all of them.
+        """
+        if source is None:
+            self._importers.clear()
+            self._exporters.clear()
+        else:
+            self._importers.pop(source, None)
+            self._exporters.pop(source, None)
+
+    def get_importer(self, source):
+        """Return the importer of the source kept for :py:meth:`sync` and :py:meth:`get_library`, creating it on the
+        first request.
+
+        :param source: The source.
+        :return: The importer, or None if no importer handles the source.
+        :rtype: AnnotationImporter
+        """
+        if source not in self._importers:
+            self._importers[source] = self.find_importer(source)
+        return self._importers[source]
+
+    def _get_candidates(self, source_library):
+        """Return the keys of the source documents for filtering the destination library (see
+        :py:attr:`predicate_pushdown`), or None if no filtering should be done.
+
+        :rtype: LibraryCandidates
+        """
+        if not self.predicate_pushdown:
+            return None
+
+        # the same candidates object for the same library lets the importers reuse their filtered libraries
+        if self._candidates is None or self._candidates[0] is not source_library:
+            unknown_hashes = sum(1 for document in source_library.get_documents()
+                                 if document._filehashes.get('sha1') is None)
+            compute_hashes = ('sha1',) if unknown_hashes <= self.pushdown_hash_limit else ()
+            self._candidates = (source_library, LibraryCandidates.from_library(source_library, compute_hashes))
+
+        return self._candidates[1]
+
+    def watch(self, debounce=2.0, poll_interval=1.0, stop_condition=None):
+        """Keep the destination in sync with the source, re-syncing whenever one of them changes.
+
+        The source and destination are watched by inotify on Linux and polled elsewhere. After a burst of changes
+        settles for `debounce` seconds, only the common documents whose annotation versions changed since their last
+        sync are synced again. The libraries, document matches and cached annotation sets stay in memory between the
+        syncs. Documents added to the source or destination after the watch started are not picked up.
+
+        :param float debounce: Length of the quiet period (in seconds) that ends a burst of changes.
+        :param float poll_interval: Interval (in seconds) for polling the paths and checking the stop condition.
+        :param stop_condition: A callable that returns True when watching should stop. If None, watch until
+                               interrupted.
+        """
+        self.install_conversion_cache()
+
+        importers = [importer for importer in (self._source_importer, self._destination_importer)
+                     if importer is not None]
+        paths = []
+        for importer in importers:
+            paths.extend(path for path in importer.get_watched_paths() if path not in paths)
+
+        synced_versions = {}
+
+        watcher = create_watcher(paths, poll_interval)
+        try:
+            self._sync_changed_documents(synced_versions)
+
+            while stop_condition is None or not stop_condition():
+                changed = watcher.wait_debounced(debounce, timeout=poll_interval)
+                if len(changed) == 0:
+                    continue
+
+                log.info("Changed: %s", ", ".join(sorted(changed)))
+
+                for importer in importers:
+                    importer.notify_changed(changed & set(importer.get_watched_paths()))
+                # the importers return their current libraries (which are the same unless they were reloaded)
+                self._source_library = None
+                self._destination_library = None
+
+                self._sync_changed_documents(synced_versions)
+        finally:
+            watcher.close()
+
+    def _sync_changed_documents(self, synced_versions):
+        """Sync the common documents whose annotations changed since they were synced for the last time.
+
+        :param dict synced_versions: Full paths of the (source, destination) documents -> their annotation versions
+                                     after the last sync. Updated by this method.
+        """
+        exported = []
+        for (source_document, destination_document) in self._get_common_documents():
+            key = (source_document.full_path, destination_document.full_path)
+            versions = (source_document.get_annotations_version(), destination_document.get_annotations_version())
+
+            if None not in versions and synced_versions.get(key) == versions:
+                continue
+
+            if self._sync_document_pair(source_document, destination_document) > 0:
+                exported.append((key, destination_document))
+            synced_versions[key] = versions
+
+        self._exporter.flush()
+
+        # our own export changes the destination versions (once the exporter wrote the annotations)
+        for key, destination_document in exported:
+            synced_versions[key] = (synced_versions[key][0], destination_document.get_annotations_version())
+
+    def _get_common_documents(self):
         source_library = self.get_source_library()
         destination_library = self.get_destination_library()
 
-        common, only_source, only_destination = source_library.find_common_documents(destination_library)
+        # matching documents may need hashing whole files, so keep the result as long as the libraries are the same
+        if self._common_documents is None or self._common_documents[0] is not source_library or \
+                self._common_documents[1] is not destination_library:
+            common, only_source, only_destination = source_library.find_common_documents(destination_library)
+            self._common_documents = (source_library, destination_library, common)
 
-        for (source_document, destination_document) in common:
+        return self._common_documents[2]
+
+    def _sync_document_pair(self, source_document, destination_document, exporter=None):
+        """Export the annotations found only in the source document to the destination document.
+
+        :param AnnotationExporter exporter: The exporter to use. If None, the exporter of the destination is used.
+        :return: The number of exported annotations.
+        :rtype: int
+        """
+        if exporter is None:
+            exporter = self._exporter
+
+        exported = 0
+
+        start_time = time.time()
+        self.progress.emit(ProgressEvent.DOCUMENT_STARTED, source_document)
+        add_conversion_listener(self.progress)
+        try:
             common_annotations, only_source_annotations, only_destination_annotations = \
                 source_document.find_common_annotations(destination_document)
 
-            self._exporter.add_annotations_to_document(destination_document, only_source_annotations)
+            if len(only_source_annotations) > 0:
+                exported = exporter.add_annotations_to_document(destination_document, only_source_annotations)
+                self.progress.emit(ProgressEvent.ANNOTATIONS_EXPORTED, destination_document, count=exported)
+        except Exception as e:
+            self.progress.emit(ProgressEvent.ERROR, source_document, error=str(e))
+            raise
+        finally:
+            remove_conversion_listener(self.progress)
+            self.progress.emit(ProgressEvent.DOCUMENT_FINISHED, source_document, duration=time.time() - start_time)
+
+        return exported
+
+    def _emit_discovered(self, source_library, destination_library):
+        for details, library in ((u"source", source_library), (u"destination", destination_library)):
+            for document in library.get_documents():
+                self.progress.emit(ProgressEvent.DOCUMENT_DISCOVERED, document, details=details)
+
+    def _emit_matched(self, common):
+        # the total is known before the first document is synced
+        for source_document, destination_document in common:
+            self.progress.emit(ProgressEvent.DOCUMENT_MATCHED, source_document, details=destination_document.full_path)
+        for pair in common:
+            yield pair
 
     def add_importer_factory(self, factory):
         """
@@ -136,7 +597,10 @@ class AnnotationManager(object):
         :param paths: Paths to the plugin directories.
         :type paths: basestring
         """
-        paths = list(paths)
+        paths = [path for path in paths if path not in AnnotationManager._loaded_plugin_paths]
+        if len(paths) == 0:
+            return
+        AnnotationManager._loaded_plugin_paths.update(paths)
 
         for _, name, _ in pkgutil.iter_modules(paths):
             fid, pathname, desc = imp.find_module(name, paths)
@@ -147,3 +611,30 @@ class AnnotationManager(object):
                                 pathname, e.message)
             if fid:
                 fid.close()
+
+
+class SyncStatistics(object):
+    """
+    Statistics of a single sync run by :py:meth:`AnnotationManager.sync`.
+    """
+
+    def __init__(self, source, destination):
+        super(SyncStatistics, self).__init__()
+
+        self.source = source
+        self.destination = destination
+        self.documents_matched = 0
+        self.annotations_exported = 0
+        # time spent importing the libraries (zero when they were already imported) and in the whole sync
+        self.import_duration = 0.0
+        self.duration = 0.0
+        # description of the error that made the sync fail, or None
+        self.error = None
+
+    def __str__(self):
+        if self.error is not None:
+            return "%s -> %s: failed (%s)" % (self.source, self.destination, self.error)
+
+        return "%s -> %s: %i documents matched, %i annotations exported in %.2f s (import %.2f s)" % (
+            self.source, self.destination, self.documents_matched, self.annotations_exported, self.duration,
+            self.import_duration)
@@ -0,0 +1,517 @@
+"""
+Persistent cache for the parts of the package that keep state between runs.
+
+The cached values are stored in a single SQLite database under ``~/.annotation_manager/cache``, divided into
+namespaces (one per kind of cached data). The only user so far is :py:class:`ConversionCache`, which stores the
+converted annotations. The in-memory state kept during a single run, such as the :py:class:`AnnotationSetCache` of
+the libraries and the parsed state of the Pocketbook annotation files, is not stored here: it is not counted in the
+budgets and not affected by the maintenance operations. The values are opaque byte strings stored under
+keys that should be derived from the contents they depend on (see :py:func:`content_key`), so a stale value is never
+found instead of being invalidated.
+
+The total size of the values is limited by a global budget and optionally by per-namespace budgets; when a budget is
+exceeded, the least recently used values are evicted. Several processes may use the cache at the same time: the
+database is in the WAL mode, so the readers don't block the writer, and the writes are serialized by SQLite.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.environ["HOME"], ".annotation_manager", "cache", "cache.sqlite")
+
+# maximum number of SQL variables in a single query
+_QUERY_CHUNK = 500
+
+
+def content_key(*parts):
+    """Create a key from the given parts (e.g. fingerprints of the contents the cached value was computed from).
+
+    :return: The SHA1 hex digest of the parts.
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, bytes):
+            part = str(part)
+        # the lengths keep ("ab", "c") and ("a", "bc") apart
+        h.update(b"%i:" % len(part))
+        h.update(part)
+    return h.hexdigest()
+
+
+class NamespaceStatistics(object):
+    """
+    Statistics of a namespace of the cache, as returned by :py:meth:`Cache.get_statistics`.
+    """
+
+    def __init__(self, namespace, entries, size, budget, hits, misses, evictions):
+        super(NamespaceStatistics, self).__init__()
+
+        self.namespace = namespace
+        self.entries = entries
+        self.size = size
+        # None if only the global budget applies
+        self.budget = budget
+        self.hits = hits
+        self.misses = misses
+        self.evictions = evictions
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else None
+
+    def __str__(self):
+        hit_ratio = "%.1f %%" % (100 * self.hit_ratio) if self.hit_ratio is not None else "-"
+        budget = _format_size(self.budget) if self.budget is not None else "-"
+        return "%s: %i entries, %s (budget %s), %i hits, %i misses (hit ratio %s), %i evictions" % (
+            self.namespace, self.entries, _format_size(self.size), budget, self.hits, self.misses, hit_ratio,
+            self.evictions)
+
+
+class Cache(object):
+    """
+    SQLite-backed store of namespaced values with size budgets and LRU eviction.
+
+    The access times and the hit/miss counters are kept in memory and written together with the next write (or by
+    :py:meth:`flush`), so the lookups don't write to the database.
+    """
+
+    # default limit of the total size of the values in bytes
+    DEFAULT_BUDGET = 512 * 1024 * 1024
+
+    # when a budget is exceeded, values are evicted until the size drops to this fraction of the budget
+    EVICTION_TARGET = 0.9
+
+    # the buffered access times and counters are written after this many lookups at the latest
+    FLUSH_INTERVAL = 1000
+
+    BUSY_TIMEOUT = 30.0
+
+    _path = None
+    _budget = None
+    _namespace_budgets = None
+
+    _connection = None
+    _connection_pid = None
+
+    # (namespace, key) -> last access time, not written yet
+    _accessed = None
+    # namespace -> [hits, misses], not written yet
+    _counters = None
+    _lookups = 0
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, budget=DEFAULT_BUDGET, namespace_budgets=None):
+        """
+        :param basestring path: Path to the cache database (created if it doesn't exist).
+        :param int budget: Limit of the total size of the values in bytes (None for no limit).
+        :param dict namespace_budgets: Namespace -> limit of the size of its values in bytes.
+        """
+        super(Cache, self).__init__()
+
+        directory = os.path.dirname(path)
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._path = path
+        self._budget = budget
+        self._namespace_budgets = dict(namespace_budgets or {})
+        self._accessed = {}
+        self._counters = {}
+        self._connect()
+
+    def namespace(self, name):
+        """Return the store of the given namespace.
+
+        :param basestring name: Name of the namespace.
+        :rtype: CacheNamespace
+        """
+        return CacheNamespace(self, name)
+
+    def get_many(self, namespace, keys):
+        """Return the values stored under the given keys.
+
+        :param basestring namespace: The namespace.
+        :param keys: The keys.
+        :type keys: list of basestring
+        :return: Key -> value, for the keys found in the cache.
+        :rtype: dict
+        """
+        return self._lookup(namespace, keys, "key,value", lambda row: (row[0], bytes(row[1])))
+
+    def get_existing_keys(self, namespace, keys):
+        """Return those of the given keys that have values in the cache, without reading the values.
+
+        This is only a probe: it doesn't count as a use of the values (nor as hits or misses).
+
+        :rtype: set
+        """
+        return set(self._lookup(namespace, keys, "key", lambda row: (row[0], True), False))
+
+    def put_many(self, namespace, items):
+        """Store values, replacing the values already stored under the same keys.
+
+        Values are evicted afterwards if a budget is exceeded.
+
+        :param basestring namespace: The namespace.
+        :param items: Tuples (key, value).
+        :type items: list of tuple
+        """
+        now = time.time()
+        rows = [(namespace, key, sqlite3.Binary(value), len(value), zlib.crc32(value) & 0xffffffff, now)
+                for (key, value) in items]
+        if len(rows) == 0:
+            return
+
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM entries WHERE namespace=? AND key=?",
+                                   [(namespace, row[1]) for row in rows])
+            connection.executemany("INSERT INTO entries (namespace,key,value,size,checksum,accessed) "
+                                   "VALUES (?,?,?,?,?,?)", rows)
+            self._write_buffered(connection)
+            self._enforce_budgets(connection, namespace, self.EVICTION_TARGET)
+
+    def delete_many(self, namespace, keys):
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM entries WHERE namespace=? AND key=?",
+                                   [(namespace, key) for key in keys])
+
+    def flush(self):
+        """Write the buffered access times and hit/miss counters."""
+        if len(self._accessed) == 0 and len(self._counters) == 0:
+            return
+
+        with self._transaction() as connection:
+            self._write_buffered(connection)
+
+    def get_statistics(self):
+        """Return the statistics of all the namespaces that have ever been used.
+
+        :rtype: list of NamespaceStatistics
+        """
+        self.flush()
+
+        return [NamespaceStatistics(name, entries, size, self._namespace_budgets.get(name), hits, misses, evictions)
+                for (name, entries, size, hits, misses, evictions) in self._get_connection().execute(
+                    "SELECT name,entries,size,hits,misses,evictions FROM namespaces ORDER BY name")]
+
+    def get_size(self, namespace=None):
+        """Return the size of the values of the namespace (or of all namespaces) in bytes.
+
+        :rtype: int
+        """
+        if namespace is None:
+            row = self._get_connection().execute("SELECT SUM(size) FROM namespaces").fetchone()
+        else:
+            row = self._get_connection().execute("SELECT size FROM namespaces WHERE name=?", (namespace,)).fetchone()
+        return (row[0] or 0) if row is not None else 0
+
+    def prune(self, max_age=None):
+        """Evict values until all the budgets are met and compact the database.
+
+        :param float max_age: If given, also remove the values not used for this many seconds.
+        :return: Number of removed values.
+        :rtype: int
+        """
+        with self._transaction() as connection:
+            self._write_buffered(connection)
+
+            removed = 0
+            if max_age is not None:
+                removed += self._evict(connection, "accessed<?", (time.time() - max_age,))
+
+            for (name,) in connection.execute("SELECT name FROM namespaces").fetchall():
+                removed += self._enforce_budgets(connection, name, 1.0)
+
+        self._compact()
+
+        return removed
+
+    def clear(self, namespace=None):
+        """Remove all the values (and statistics) of the namespace, or of all namespaces.
+
+        :return: Number of removed values.
+        :rtype: int
+        """
+        self._accessed = dict(item for item in self._accessed.items()
+                              if namespace is not None and item[0][0] != namespace)
+        self._counters = dict(item for item in self._counters.items() if namespace is not None and item[0] != namespace)
+
+        with self._transaction() as connection:
+            if namespace is None:
+                removed = connection.execute("DELETE FROM entries").rowcount
+                connection.execute("DELETE FROM namespaces")
+            else:
+                removed = connection.execute("DELETE FROM entries WHERE namespace=?", (namespace,)).rowcount
+                connection.execute("DELETE FROM namespaces WHERE name=?", (namespace,))
+
+        self._compact()
+
+        return removed
+
+    def verify(self):
+        """Check the integrity of the database and of all the values, and repair what can be repaired.
+
+        Values whose checksums don't match are removed and the sizes of the namespaces are recomputed.
+
+        :return: Descriptions of the problems found.
+        :rtype: list of str
+        """
+        problems = [row[0] for row in self._get_connection().execute("PRAGMA integrity_check")
+                    if row[0] != "ok"]
+
+        with self._transaction() as connection:
+            self._write_buffered(connection)
+
+            corrupted = [(rowid, namespace, key) for (rowid, namespace, key, value, checksum) in connection.execute(
+                "SELECT rowid,namespace,key,value,checksum FROM entries")
+                if zlib.crc32(bytes(value)) & 0xffffffff != checksum]
+            for rowid, namespace, key in corrupted:
+                problems.append("Corrupted value of %s in %s removed" % (key, namespace))
+                connection.execute("DELETE FROM entries WHERE rowid=?", (rowid,))
+
+            for name, entries, size in connection.execute(
+                    "SELECT n.name,n.entries,n.size FROM namespaces n").fetchall():
+                actual_entries, actual_size = connection.execute(
+                    "SELECT COUNT(*),COALESCE(SUM(size),0) FROM entries WHERE namespace=?", (name,)).fetchone()
+                if (entries, size) != (actual_entries, actual_size):
+                    problems.append("Size of %s corrected" % name)
+                    connection.execute("UPDATE namespaces SET entries=?,size=? WHERE name=?",
+                                       (actual_entries, actual_size, name))
+
+        return problems
+
+    def close(self):
+        if self._connection is not None:
+            if self._connection_pid == os.getpid():
+                try:
+                    self.flush()
+                except sqlite3.Error:
+                    log.warning("Failed to write the cache statistics", exc_info=True)
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def budget(self):
+        return self._budget
+
+    def get_namespace_budget(self, namespace):
+        return self._namespace_budgets.get(namespace)
+
+    def _lookup(self, namespace, keys, columns, convert, record=True):
+        keys = list(set(keys))
+        results = {}
+        connection = self._get_connection()
+        for chunk in _chunks(keys):
+            results.update(convert(row) for row in connection.execute(
+                "SELECT %s FROM entries WHERE namespace=? AND key IN (%s)" % (columns, ",".join("?" * len(chunk))),
+                [namespace] + chunk))
+
+        if not record:
+            return results
+
+        now = time.time()
+        for key in results:
+            self._accessed[(namespace, key)] = now
+
+        counters = self._counters.setdefault(namespace, [0, 0])
+        counters[0] += len(results)
+        counters[1] += len(keys) - len(results)
+
+        self._lookups += len(keys)
+        if self._lookups >= self.FLUSH_INTERVAL:
+            try:
+                self.flush()
+            except sqlite3.OperationalError:
+                # the cache is busy, try again with the next lookup
+                log.debug("Failed to write the cache access times", exc_info=True)
+
+        return results
+
+    def _write_buffered(self, connection):
+        connection.executemany("UPDATE entries SET accessed=? WHERE namespace=? AND key=? AND accessed<?",
+                               [(accessed, namespace, key, accessed)
+                                for ((namespace, key), accessed) in self._accessed.items()])
+        for namespace, (hits, misses) in self._counters.items():
+            connection.execute("INSERT OR IGNORE INTO namespaces (name) VALUES (?)", (namespace,))
+            connection.execute("UPDATE namespaces SET hits=hits+?,misses=misses+? WHERE name=?",
+                               (hits, misses, namespace))
+
+        self._accessed = {}
+        self._counters = {}
+        self._lookups = 0
+
+    def _enforce_budgets(self, connection, namespace, target):
+        """Evict the least recently used values if the budget of the namespace or the global budget is exceeded.
+
+        :param float target: Fraction of the exceeded budget to evict down to.
+        :return: Number of evicted values.
+        :rtype: int
+        """
+        evicted = 0
+
+        budget = self._namespace_budgets.get(namespace)
+        if budget is not None:
+            size = connection.execute("SELECT size FROM namespaces WHERE name=?", (namespace,)).fetchone()
+            if size is not None and size[0] > budget:
+                evicted += self._evict_bytes(connection, size[0] - int(budget * target), namespace)
+
+        if self._budget is not None:
+            size = connection.execute("SELECT COALESCE(SUM(size),0) FROM namespaces").fetchone()[0]
+            if size > self._budget:
+                evicted += self._evict_bytes(connection, size - int(self._budget * target))
+
+        return evicted
+
+    def _evict_bytes(self, connection, size, namespace=None):
+        if namespace is None:
+            rows = connection.execute("SELECT rowid,size FROM entries ORDER BY accessed")
+        else:
+            rows = connection.execute("SELECT rowid,size FROM entries WHERE namespace=? ORDER BY accessed",
+                                      (namespace,))
+
+        rowids = []
+        for rowid, entry_size in rows:
+            if size <= 0:
+                break
+            rowids.append(rowid)
+            size -= entry_size
+
+        evicted = 0
+        for chunk in _chunks(rowids):
+            evicted += self._evict(connection, "rowid IN (%s)" % ",".join("?" * len(chunk)), chunk)
+        return evicted
+
+    @staticmethod
+    def _evict(connection, condition, parameters):
+        evictions = connection.execute("SELECT namespace,COUNT(*) FROM entries WHERE %s GROUP BY namespace"
+                                       % condition, parameters).fetchall()
+        connection.executemany("UPDATE namespaces SET evictions=evictions+? WHERE name=?",
+                               [(count, namespace) for (namespace, count) in evictions])
+        connection.execute("DELETE FROM entries WHERE %s" % condition, parameters)
+        return sum(count for (_, count) in evictions)
+
+    def _compact(self):
+        connection = self._get_connection()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("VACUUM")
+
+    def _transaction(self):
+        return _Transaction(self._get_connection())
+
+    def _get_connection(self):
+        # a connection inherited by a forked process must not be used
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connect()
+        return self._connection
+
+    def _connect(self):
+        # the transactions are started explicitly by _Transaction
+        if self._connection_pid is not None and self._connection_pid != os.getpid():
+            # the buffers were inherited from the parent process, which writes them itself
+            self._accessed = {}
+            self._counters = {}
+            self._lookups = 0
+
+        self._connection = sqlite3.connect(self._path, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+        self._connection_pid = os.getpid()
+
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value BLOB, size INTEGER, "
+            "checksum INTEGER, accessed REAL, PRIMARY KEY (namespace, key));"
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);"
+            "CREATE INDEX IF NOT EXISTS entries_namespace_accessed ON entries (namespace, accessed);"
+            "CREATE TABLE IF NOT EXISTS namespaces (name TEXT PRIMARY KEY, entries INTEGER DEFAULT 0, "
+            "size INTEGER DEFAULT 0, hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0, evictions INTEGER DEFAULT 0);"
+            # the sizes of the namespaces are kept up to date by the database, whichever process writes
+            "CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries BEGIN "
+            "INSERT OR IGNORE INTO namespaces (name) VALUES (new.namespace); "
+            "UPDATE namespaces SET entries=entries+1,size=size+new.size WHERE name=new.namespace; END;"
+            "CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries BEGIN "
+            "UPDATE namespaces SET entries=entries-1,size=size-old.size WHERE name=old.namespace; END;")
+
+
+class _Transaction(object):
+    """
+    Write transaction taking the database lock at its start, so that concurrent writers wait for each other instead
+    of failing on the upgrade of a read lock.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+class CacheNamespace(object):
+    """
+    The values of a single namespace of a :py:class:`Cache`.
+    """
+
+    def __init__(self, cache, name):
+        super(CacheNamespace, self).__init__()
+
+        self._cache = cache
+        self._name = name
+
+    def get(self, key, default=None):
+        return self._cache.get_many(self._name, [key]).get(key, default)
+
+    def get_many(self, keys):
+        """:rtype: dict"""
+        return self._cache.get_many(self._name, keys)
+
+    def get_existing_keys(self, keys):
+        """:rtype: set"""
+        return self._cache.get_existing_keys(self._name, keys)
+
+    def put(self, key, value):
+        self._cache.put_many(self._name, [(key, value)])
+
+    def put_many(self, items):
+        self._cache.put_many(self._name, items)
+
+    def delete(self, key):
+        self._cache.delete_many(self._name, [key])
+
+    def clear(self):
+        return self._cache.clear(self._name)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def cache(self):
+        return self._cache
+
+
+def _chunks(values):
+    for start in range(0, len(values), _QUERY_CHUNK):
+        yield values[start:start + _QUERY_CHUNK]
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%.0f %s" % (size, unit) if unit == "B" else "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
@@ -1,24 +1,165 @@
 import hashlib
 import os
+import posixpath
+import time
+import unicodedata
 from abc import ABCMeta, abstractmethod
 from six import add_metaclass
 
 from collections import OrderedDict
 
+from annotation_manager.plugins.utils import hashfile
 from pdfloc_converter.converter import PDFLocConverter
-from pdfloc_converter.pdfloc import PDFLocBoundingBoxes, PointOnPage, PDFLoc, PDFLocPair
+from pdfloc_converter.pdfloc import PDFLocBoundingBoxes, PointOnPage, PDFLoc, PDFLocPair, BoundingBoxOnPage
+
+
+class AnnotationSetCache(object):
+    """
+    A least-recently-used cache of :py:class:`AnnotationSet`s bounded by entry count and approximate byte size.
+
+    Every entry is stored together with the source version it was loaded from (see
+    :py:meth:`AnnotatedDocument.get_annotations_version`). An entry whose version differs from the current version
+    of its source is considered stale and is dropped on access.
+    """
+
+    _max_entries = None
+    _max_bytes = None
+
+    _entries = None
+    _size = 0
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        """
+        :param int max_entries: Maximum number of cached annotation sets (None for unlimited).
+        :param int max_bytes: Maximum approximate size of all cached annotation sets in bytes (None for unlimited).
+        """
+        super(AnnotationSetCache, self).__init__()
+
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, version):
+        """Return the cached annotation set for the given key if it was loaded from the given source version.
+
+        :param key: Key of the cached annotation set (usually the document path).
+        :param version: The current version of the annotation source.
+        :return: The cached annotation set, or None if it is not cached or is stale.
+        :rtype: :py:class:`AnnotationSet`
+        """
+        if key not in self._entries:
+            return None
+
+        cached_version, annotations, size = self._entries.pop(key)
+        if cached_version != version:
+            self._size -= size
+            return None
+
+        # re-insert to mark the entry as the most recently used one
+        self._entries[key] = (cached_version, annotations, size)
+        return annotations
+
+    def put(self, key, version, annotations):
+        """Store the annotation set loaded from the given source version.
+
+        :param key: Key of the cached annotation set (usually the document path).
+        :param version: The version of the annotation source the set was loaded from.
+        :param AnnotationSet annotations: The annotation set to cache.
+        """
+        self.invalidate(key)
+
+        size = annotations.approximate_size()
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+
+        self._entries[key] = (version, annotations, size)
+        self._size += size
+
+        self._evict()
+
+    def update_size(self, key, annotations):
+        """Measure the size of a cached annotation set again after annotations were added to it (e.g. conversions),
+        evicting entries if the cache grew too large.
+
+        :param key: Key of the cached annotation set.
+        :param AnnotationSet annotations: The annotation set; nothing is done unless it is the cached one.
+        """
+        if key not in self._entries or self._entries[key][1] is not annotations:
+            return
+
+        version, _, size = self._entries[key]
+        new_size = annotations.approximate_size()
+        self._entries[key] = (version, annotations, new_size)
+        self._size += new_size - size
+
+        if self._max_bytes is not None and new_size > self._max_bytes:
+            self.invalidate(key)
+        self._evict()
+
+    def invalidate(self, key=None):
+        """Remove the given entry from the cache, or all entries if key is None.
+
+        :param key: Key of the entry to remove, or None to clear the whole cache.
+        """
+        if key is None:
+            self._entries.clear()
+            self._size = 0
+        elif key in self._entries:
+            self._size -= self._entries.pop(key)[2]
+
+    def _evict(self):
+        while len(self._entries) > 0 and (
+                (self._max_entries is not None and len(self._entries) > self._max_entries) or
+                (self._max_bytes is not None and self._size > self._max_bytes)):
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+    @property
+    def size(self):
+        """Approximate size of all cached annotation sets in bytes."""
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
 
 
 @add_metaclass(ABCMeta)
 class DocumentLibrary(object):
+    """
+    A collection of annotated documents indexed by their paths.
 
-    def __init__(self):
+    Secondary indexes by size, filename, normalized path (see :py:func:`normalize_path`) and every known file hash
+    are maintained as documents are added. Hashes computed later (e.g. by :py:meth:`AnnotatedDocument.get_filehash`)
+    are indexed as soon as they are known.
+    """
+
+    _annotation_cache = None
+
+    def __init__(self, annotation_cache=None):
+        """
+        :param AnnotationSetCache annotation_cache: Cache for the annotation sets of the documents in this library. If
+                                                    None, a cache with the default limits is created.
+        """
         self._documents = OrderedDict()
+        self._annotation_cache = annotation_cache if annotation_cache is not None else AnnotationSetCache()
+
+        self._by_size = {}
+        self._by_filename = {}
+        self._by_normalized_path = {}
+        # (hash method, hash) -> documents
+        self._by_hash = {}
 
     def add_documents(self, **documents):
         for path, document in documents.items():
             assert isinstance(document, AnnotatedDocument)
+            document.annotation_cache = self._annotation_cache
+
+            if path in self._documents:
+                self._unindex_document(path, self._documents[path])
             self._documents[path] = document
+            self._index_document(path, document)
 
     def get_documents(self):
         """Return a list of all documents in this library.
@@ -28,19 +169,192 @@ class DocumentLibrary(object):
         """
         return tuple(self._documents.values())
 
-    def get_document_by_path(self, path):
+    def get_document_by_path(self, path, normalized=False):
         """Return the document instance corresponding to the given filesystem path.
 
         :param basestring|unicode path: Filesystem path of the document.
+        :param bool normalized: If True and no document has exactly the given path, look the path up by its normalized
+                                form (see :py:func:`normalize_path`).
         :return: The document instance, or None if the document is not found.
         :rtype: :py:class:`AnnotatedDocument`
         """
-        return self._documents[path] if path in self._documents else None
+        if path in self._documents:
+            return self._documents[path]
+
+        if normalized:
+            documents = self.get_documents_by_normalized_path(path)
+            if len(documents) > 0:
+                return documents[0]
+
+        return None
+
+    def get_documents_by_size(self, filesize):
+        """Return the documents of the given size.
+
+        :param int filesize: Size of the document files in bytes.
+        :rtype: tuple of :py:class:`AnnotatedDocument`
+        """
+        return tuple(self._by_size.get(filesize, ()))
+
+    def get_documents_by_filename(self, filename):
+        """Return the documents with the given filename (the last component of their paths).
+
+        :param unicode filename: The filename.
+        :rtype: tuple of :py:class:`AnnotatedDocument`
+        """
+        return tuple(self._by_filename.get(filename, ()))
+
+    def get_documents_by_normalized_path(self, path):
+        """Return the documents whose paths equal the given path after normalization (see :py:func:`normalize_path`).
+
+        :param unicode path: The path (normalized or not).
+        :rtype: tuple of :py:class:`AnnotatedDocument`
+        """
+        return tuple(self._by_normalized_path.get(normalize_path(path), ()))
+
+    def get_documents_by_hash(self, hash, hash_method='sha1'):
+        """Return the documents with the given content hash.
+
+        Only the hashes known so far are looked up; no hashes are computed.
+
+        :param str hash: The hex digest.
+        :param str hash_method: Name of the hash function (as in :py:meth:`AnnotatedDocument.get_filehash`).
+        :rtype: tuple of :py:class:`AnnotatedDocument`
+        """
+        return tuple(self._by_hash.get((hash_method, hash), ()))
+
+    def get_sizes(self):
+        """Return the set of sizes of the documents in this library."""
+        return frozenset(self._by_size.keys())
 
     def find_common_documents(self, other):
         assert isinstance(other, DocumentLibrary)
         return find_common_items(self.get_documents(), other.get_documents(), lambda document: document.filesize)
 
+    def _index_document(self, path, document):
+        self._by_size.setdefault(document.filesize, []).append(document)
+        self._by_filename.setdefault(document.filename, []).append(document)
+        self._by_normalized_path.setdefault(normalize_path(path), []).append(document)
+        for hash_method, hash in document._filehashes.items():
+            if hash is not None:
+                self._by_hash.setdefault((hash_method, hash), []).append(document)
+
+        document.add_filehash_listener(self._index_filehash)
+
+    def _unindex_document(self, path, document):
+        document.remove_filehash_listener(self._index_filehash)
+
+        _remove_from_index(self._by_size, document.filesize, document)
+        _remove_from_index(self._by_filename, document.filename, document)
+        _remove_from_index(self._by_normalized_path, normalize_path(path), document)
+        for hash_method, hash in document._filehashes.items():
+            if hash is not None:
+                _remove_from_index(self._by_hash, (hash_method, hash), document)
+
+    def _index_filehash(self, document, hash_method, hash):
+        documents = self._by_hash.setdefault((hash_method, hash), [])
+        if not any(indexed is document for indexed in documents):
+            documents.append(document)
+
+    @property
+    def annotation_cache(self):
+        return self._annotation_cache
+
+
+def normalize_path(path):
+    """Normalize a path for lookups insensitive to Unicode normalization, letter case and path separators.
+
+    :param unicode path: The path.
+    :return: The NFC-normalized, case-folded path with forward slashes as separators.
+    :rtype: unicode
+    """
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', 'replace')
+    path = unicodedata.normalize('NFC', path).replace(u"\\", u"/")
+    return posixpath.normpath(path).lower()
+
+
+def _remove_from_index(index, key, document):
+    documents = index.get(key)
+    if documents is None:
+        return
+
+    documents[:] = [indexed for indexed in documents if indexed is not document]
+    if len(documents) == 0:
+        del index[key]
+
+
+class LibraryCandidates(object):
+    """
+    Keys of the documents of one library that documents of another library have to match.
+
+    Importers can use them as a filter and skip loading documents that cannot match any of the candidates: a document
+    matches only if it has one of the candidate sizes and either one of the candidate filenames or one of the
+    candidate hashes (see :py:meth:`AnnotatedDocument.__eq__`).
+    """
+
+    def __init__(self, sizes, filenames, hashes=None, complete_hash_methods=()):
+        """
+        :param sizes: The candidate file sizes.
+        :param filenames: The candidate filenames.
+        :param dict hashes: Hash method -> candidate hashes.
+        :param complete_hash_methods: The hash methods whose hashes are known for all the candidate documents. Only
+                                      for these a document with a non-candidate filename and hash can be skipped.
+        """
+        super(LibraryCandidates, self).__init__()
+
+        self._sizes = frozenset(sizes)
+        self._filenames = frozenset(filenames)
+        self._hashes = dict((hash_method, frozenset(method_hashes))
+                            for (hash_method, method_hashes) in (hashes or {}).items())
+        self._complete_hash_methods = frozenset(complete_hash_methods)
+
+    @staticmethod
+    def from_library(library, compute_hashes=()):
+        """Collect the candidate keys of all documents of the library.
+
+        :param DocumentLibrary library: The library.
+        :param compute_hashes: Hash methods whose hashes are computed for the documents that don't know them yet, so
+                               that they are complete.
+        :rtype: LibraryCandidates
+        """
+        hashes = {}
+        for document in library.get_documents():
+            for hash_method in compute_hashes:
+                document.get_filehash(hash_method)
+            for hash_method, hash in document._filehashes.items():
+                if hash is not None:
+                    hashes.setdefault(hash_method, set()).add(hash)
+
+        documents = library.get_documents()
+        complete_hash_methods = [hash_method for hash_method in hashes
+                                 if all(document._filehashes.get(hash_method) is not None for document in documents)]
+
+        return LibraryCandidates(library.get_sizes(), (document.filename for document in documents), hashes,
+                                 complete_hash_methods)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def filenames(self):
+        return self._filenames
+
+    def get_hashes(self, hash_method):
+        return self._hashes.get(hash_method, frozenset())
+
+    def is_hash_complete(self, hash_method):
+        """Return True if the hashes of the given method are known for all the candidate documents."""
+        return hash_method in self._complete_hash_methods
+
+    def may_match(self, filesize):
+        """Return False if a document of the given size cannot match any candidate."""
+        return filesize in self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
 
 @add_metaclass(ABCMeta)
 class AnnotatedDocument(object):
@@ -50,46 +364,146 @@ class AnnotatedDocument(object):
     _full_path = None
     _filehashes = {'md5': None, 'sha1': None}
 
+    _annotation_cache = None
+    _filehash_listeners = None
+
     def __init__(self, full_path, filesize):
         super(AnnotatedDocument, self).__init__()
         self._full_path = full_path
         self._filename = full_path.split(os.sep)[-1]
         self._filesize = filesize
+        self._filehashes = {'md5': None, 'sha1': None}
+        self._filehash_listeners = []
 
-    @abstractmethod
     def get_annotations(self):
         """Return the set of annotations for this document.
 
+        If the document belongs to a library with an annotation cache and it can tell the version of its annotation
+        source, the annotation set is served from the cache as long as the source does not change. Conversions added
+        to the returned set (e.g. by :py:meth:`find_common_annotations`) are thus kept for subsequent calls.
+
+        Subclasses implement :py:meth:`_load_annotations`.
+
+        :return: The set of annotations.
+        :rtype: :py:class:`AnnotationSet`
+        """
+        if self._annotation_cache is None:
+            return self._load_annotations()
+
+        version = self.get_annotations_version()
+        if version is None:
+            return self._load_annotations()
+
+        annotations = self._annotation_cache.get(self.full_path, version)
+        if annotations is None:
+            annotations = self._load_annotations()
+            self._annotation_cache.put(self.full_path, version, annotations)
+
+        return annotations
+
+    @abstractmethod
+    def _load_annotations(self):
+        """Load the set of annotations for this document from its source.
+
         :return: The set of annotations.
         :rtype: :py:class:`AnnotationSet`
         """
         pass
 
-    def find_common_annotations(self, other_document, convert_to_bboxes=True):
+    def get_annotations_version(self):
+        """Return a token identifying the current version of the annotation source of this document.
+
+        The token has to change whenever the annotations of this document change. Returning None disables caching of
+        the annotation set.
+
+        :return: The version token (any comparable value), or None if the version is unknown.
+        """
+        return None
+
+    def find_common_annotations(self, other_document, convert_to_bboxes=True, planner=None, match_text=True):
+        """Find annotations this document has in common with the other document.
+
+        If `match_text` is True, the annotations whose highlighted text is known on both sides are first matched by
+        the text and page, which needs no conversion (see :py:func:`match_annotations_by_text`). Only the annotations
+        left unresolved are compared geometrically, in the form chosen by the conversion planner. The annotations found
+        only in this document are returned in the bbox form if `convert_to_bboxes` is True, and in the pdfloc form
+        otherwise, so that they can be exported. The common annotations and the annotations found only in the other
+        document are returned in the form they were compared in (or in the form they are available in, if no comparison
+        was needed).
+
+        :param AnnotatedDocument other_document: The document to compare with.
+        :param bool convert_to_bboxes: Whether the annotations found only in this document should be bboxes.
+        :param ConversionPlanner planner: The planner to use. If None, the default planner is used.
+        :param bool match_text: Whether to match the annotations by their texts before comparing them geometrically.
+        :return: Tuple (common annotation pairs, annotations only in this document, annotations only in the other one).
+        """
         assert isinstance(other_document, AnnotatedDocument)
 
+        if planner is None:
+            planner = ConversionPlanner.default
+
         my_annotations = self.get_annotations()
         other_annotations = other_document.get_annotations()
 
-        if my_annotations.empty() and other_annotations.empty():
-            return [], my_annotations, other_annotations
-
-        if convert_to_bboxes:
+        text_common = []
+        if match_text and not my_annotations.empty() and not other_annotations.empty():
+            text_common, my_annotations, other_annotations = match_annotations_by_text(my_annotations,
+                                                                                       other_annotations)
+
+        common, only_mine, only_other = self._find_common_annotations_geometrically(
+            my_annotations, other_document, other_annotations, convert_to_bboxes, planner)
+
+        return text_common + common, only_mine, only_other
+
+    def _find_common_annotations_geometrically(self, my_annotations, other_document, other_annotations,
+                                               convert_to_bboxes, planner):
+        plan = planner.plan(self, my_annotations, other_document, other_annotations, convert_to_bboxes)
+
+        if plan == ConversionPlanner.SKIP:
+            # nothing of ours can be missing on the other side
+            return [], [], other_annotations.available_annotations()
+
+        if plan == ConversionPlanner.EXPORT_ALL:
+            # no annotation can be common, so only our side needs converting (to the exported form)
+            if convert_to_bboxes:
+                if len(my_annotations.bbox_annotations) == 0:
+                    pdfloc_to_bboxes(self, my_annotations)
+                return [], coalesce_all_bboxes(my_annotations.bbox_annotations), \
+                    other_annotations.available_annotations()
+            else:
+                if len(my_annotations.pdfloc_annotations) == 0:
+                    bboxes_to_pdfloc(self, my_annotations)
+                return [], list(my_annotations.pdfloc_annotations), other_annotations.available_annotations()
+
+        if plan == ConversionPlanner.COMPARE_BBOXES:
             if len(my_annotations.bbox_annotations) == 0:
                 pdfloc_to_bboxes(self, my_annotations)
             if len(other_annotations.bbox_annotations) == 0:
                 pdfloc_to_bboxes(other_document, other_annotations)
 
-            return find_common_items(my_annotations.bbox_annotations, other_annotations.bbox_annotations,
-                                     lambda annotation: annotation.page)
+            # both sides are compared (and exported) with their rectangles coalesced, so that highlights split into
+            # rectangles differently still match
+            common, only_mine, only_other = find_common_items(
+                coalesce_all_bboxes(my_annotations.bbox_annotations),
+                coalesce_all_bboxes(other_annotations.bbox_annotations),
+                lambda annotation: annotation.page, annotation_fingerprint)
+
+            if not convert_to_bboxes and len(only_mine) > 0:
+                only_mine = convert_bboxes_to_pdflocs(self, only_mine)
         else:
             if len(my_annotations.pdfloc_annotations) == 0:
                 bboxes_to_pdfloc(self, my_annotations)
             if len(other_annotations.pdfloc_annotations) == 0:
                 bboxes_to_pdfloc(other_document, other_annotations)
 
-            return find_common_items(my_annotations.pdfloc_annotations, other_annotations.pdfloc_annotations,
-                                     lambda annotation: annotation.page)
+            common, only_mine, only_other = find_common_items(
+                my_annotations.pdfloc_annotations, other_annotations.pdfloc_annotations,
+                lambda annotation: annotation.page, annotation_fingerprint)
+
+            if convert_to_bboxes and len(only_mine) > 0:
+                only_mine = coalesce_all_bboxes(convert_pdflocs_to_bboxes(self, only_mine))
+
+        return common, only_mine, only_other
 
     def __eq__(self, other):
         if not isinstance(other, AnnotatedDocument):
@@ -105,14 +519,39 @@ class AnnotatedDocument(object):
             if hash is not None and hash_method in other._filehashes and other._filehashes[hash_method] is not None:
                 return hash == other._filehashes[hash_method]
 
-        self._filehashes['sha1'] = hashlib.sha1(open(self.full_path, 'rb').read()).hexdigest()
-        other._filehashes['sha1'] = hashlib.sha1(open(other.full_path, 'rb').read()).hexdigest()
-
-        return self._filehashes['sha1'] == other._filehashes['sha1']
+        return self.get_filehash('sha1') == other.get_filehash('sha1')
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def get_filehash(self, hash_method='sha1'):
+        """Return the hash of the document's contents, computing it if it is not known yet.
+
+        :param str hash_method: Name of a :py:mod:`hashlib` hash function.
+        :return: The hex digest.
+        :rtype: str
+        """
+        if self._filehashes.get(hash_method) is None:
+            self._set_filehash(hash_method, hashfile(self.full_path, hashlib.new(hash_method)))
+
+        return self._filehashes[hash_method]
+
+    def add_filehash_listener(self, listener):
+        """Register a callable notified whenever a hash of this document becomes known.
+
+        :param listener: Callable taking the document, the hash method and the hash.
+        """
+        self._filehash_listeners.append(listener)
+
+    def remove_filehash_listener(self, listener):
+        if listener in self._filehash_listeners:
+            self._filehash_listeners.remove(listener)
+
+    def _set_filehash(self, hash_method, hash):
+        self._filehashes[hash_method] = hash
+        for listener in self._filehash_listeners:
+            listener(self, hash_method, hash)
+
     @property
     def full_path(self):
         return self._full_path
@@ -125,6 +564,14 @@ class AnnotatedDocument(object):
     def filesize(self):
         return self._filesize
 
+    @property
+    def annotation_cache(self):
+        return self._annotation_cache
+
+    @annotation_cache.setter
+    def annotation_cache(self, cache):
+        self._annotation_cache = cache
+
 
 @add_metaclass(ABCMeta)
 class AnnotationSet(object):
@@ -133,9 +580,54 @@ class AnnotationSet(object):
     _bbox_annotations = []  # TODO remove
     _annotations = []
 
+    def __init__(self):
+        super(AnnotationSet, self).__init__()
+
+        # instance lists, so that conversions appended to one set do not leak into the other sets
+        self._pdfloc_annotations = []
+        self._bbox_annotations = []
+
     def empty(self):
         return len(self._pdfloc_annotations) == 0 and len(self._bbox_annotations) == 0
 
+    def count(self):
+        """Return the number of annotations in this set (regardless of the forms they are available in)."""
+        return max(len(self._pdfloc_annotations), len(self._bbox_annotations))
+
+    def pages(self):
+        """Return the pages touched by the annotations in this set.
+
+        :rtype: set of int
+        """
+        return set(annotation.page for annotation in self.available_annotations())
+
+    def available_annotations(self):
+        """Return all the annotations in the bbox form if available, otherwise in the pdfloc form.
+
+        :rtype: list of PDFLocBoundingBoxes|PDFLocPair
+        """
+        if len(self._bbox_annotations) > 0 and len(self._bbox_annotations) == self.count():
+            return list(self._bbox_annotations)
+        return list(self._pdfloc_annotations)
+
+    def subset(self, indices):
+        """Return a set containing only the annotations with the given indices.
+
+        The indices refer to the list returned by :py:meth:`available_annotations`. The subset contains every form
+        that is available for all the annotations of this set.
+
+        :param indices: The indices of the annotations to keep.
+        :type indices: list of int
+        :rtype: AnnotationSubset
+        """
+        count = self.count()
+        pdfloc_annotations = [self._pdfloc_annotations[i] for i in indices] \
+            if len(self._pdfloc_annotations) == count else []
+        bbox_annotations = [self._bbox_annotations[i] for i in indices] \
+            if len(self._bbox_annotations) == count else []
+
+        return AnnotationSubset(pdfloc_annotations, bbox_annotations, self, list(indices))
+
     @property
     def pdfloc_annotations(self):
         return self._pdfloc_annotations
@@ -144,6 +636,19 @@ class AnnotationSet(object):
     def bbox_annotations(self):
         return self._bbox_annotations
 
+    def approximate_size(self):
+        """Return a rough estimate of the memory occupied by this annotation set.
+
+        :return: The estimated size in bytes.
+        :rtype: int
+        """
+        size = 256
+        for pdfloc in self._pdfloc_annotations:
+            size += 512 + (len(pdfloc.comment) if getattr(pdfloc, 'comment', None) else 0)
+        for bbox in self._bbox_annotations:
+            size += 256 + 128 * len(bbox.bboxes) + (len(bbox.comment) if getattr(bbox, 'comment', None) else 0)
+        return size
+
     # TODO convert to the generalized annotation
 
     def __str__(self):
@@ -160,6 +665,39 @@ class AnnotationSet(object):
         return "No annotations."
 
 
+class AnnotationSubset(AnnotationSet):
+    """
+    A part of another annotation set (see :py:meth:`AnnotationSet.subset`).
+
+    Converting a subset converts the whole set it is a part of (see :py:func:`pdfloc_to_bboxes`), so that the
+    conversions are kept by that set, which may be cached by its document.
+    """
+
+    _parent = None
+    _indices = None
+
+    def __init__(self, pdfloc_annotations, bbox_annotations, parent=None, indices=None):
+        """
+        :param AnnotationSet parent: The set this is a part of (or None).
+        :param indices: Indices of the annotations of this subset in the parent's available annotations.
+        :type indices: list of int
+        """
+        super(AnnotationSubset, self).__init__()
+
+        self._pdfloc_annotations = pdfloc_annotations
+        self._bbox_annotations = bbox_annotations
+        self._parent = parent
+        self._indices = indices
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def indices(self):
+        return self._indices
+
+
 @add_metaclass(ABCMeta)
 class Annotation(object):
 
@@ -269,7 +807,35 @@ class Bookmark(PointAnnotation, AnnotationWithText):
         return "Bookmark"
 
 
-def find_common_items(list1, list2, key_function):
+def set_annotation_text(annotation, text):
+    """Attach the highlighted text to an annotation, like :py:attr:`AnnotationWithText.text`.
+
+    The text is kept apart from the comment, which is the note of the user.
+
+    :param annotation: The annotation.
+    :type annotation: PDFLocPair|PDFLocBoundingBoxes
+    :param unicode text: The highlighted text (None if unknown).
+    :return: The annotation.
+    """
+    annotation.text = text
+    return annotation
+
+
+def find_common_items(list1, list2, key_function, fingerprint_function=None, fallback_to_equality=True):
+    """Find the items common to both lists.
+
+    The items are first bucketed by `key_function`; only the items in the same bucket are compared. Inside a bucket,
+    the items are matched by looking up their fingerprints (if `fingerprint_function` is given) and then, if
+    `fallback_to_equality` is True, the items left unmatched are compared by `==`.
+
+    :param list list1: The first list.
+    :param list list2: The second list.
+    :param key_function: Function returning the bucket key of an item.
+    :param fingerprint_function: Function returning a hashable fingerprint of an item; items with equal fingerprints
+                                 are considered equal.
+    :param bool fallback_to_equality: Whether to compare the items unmatched by fingerprints by `==`.
+    :return: Tuple (list of common pairs (item from list1, item from list2), items only in list1, items only in list2).
+    """
     list1_items = {}
     list2_items = {}
 
@@ -297,25 +863,490 @@ def find_common_items(list1, list2, key_function):
     for key in keys_2 - keys_1:
         only_2.extend(list2_items[key])
     for key in keys_1 & keys_2:
-        for item_1 in list1_items[key]:
-            for item_2 in list2_items[key]:
-                if item_1 == item_2:
-                    common.append((item_1, item_2))
+        unmatched_1 = list1_items[key]
+        unmatched_2 = list2_items[key]
+
+        if fingerprint_function is not None:
+            unmatched_1, unmatched_2 = _match_by_fingerprints(unmatched_1, unmatched_2, fingerprint_function, common)
+
+        if fallback_to_equality:
+            unmatched_1, unmatched_2 = _match_by_equality(unmatched_1, unmatched_2, common)
+
+        only_1.extend(unmatched_1)
+        only_2.extend(unmatched_2)
 
     return common, only_1, only_2
 
 
+def _match_by_fingerprints(items_1, items_2, fingerprint_function, common):
+    items_2_by_fingerprint = {}
+    for item_2 in items_2:
+        items_2_by_fingerprint.setdefault(fingerprint_function(item_2), []).append(item_2)
+
+    unmatched_1 = []
+    matched_fingerprints = set()
+    for item_1 in items_1:
+        fingerprint = fingerprint_function(item_1)
+        if fingerprint in items_2_by_fingerprint:
+            common.extend((item_1, item_2) for item_2 in items_2_by_fingerprint[fingerprint])
+            matched_fingerprints.add(fingerprint)
+        else:
+            unmatched_1.append(item_1)
+
+    unmatched_2 = [item_2 for item_2 in items_2 if fingerprint_function(item_2) not in matched_fingerprints]
+
+    return unmatched_1, unmatched_2
+
+
+def _match_by_equality(items_1, items_2, common):
+    matched_2 = set()
+    unmatched_1 = []
+    for item_1 in items_1:
+        matched = False
+        for i, item_2 in enumerate(items_2):
+            if item_1 == item_2:
+                common.append((item_1, item_2))
+                matched_2.add(i)
+                matched = True
+        if not matched:
+            unmatched_1.append(item_1)
+
+    unmatched_2 = [item_2 for i, item_2 in enumerate(items_2) if i not in matched_2]
+
+    return unmatched_1, unmatched_2
+
+
+# precision (in PDF points) to which bbox coordinates are quantized in annotation fingerprints
+FINGERPRINT_PRECISION = 0.5
+
+
+def annotation_fingerprint(annotation, precision=FINGERPRINT_PRECISION):
+    """Return a canonical hashable fingerprint of the annotation.
+
+    Bbox annotations are fingerprinted by the sorted list of their rectangles with the coordinates quantized to the
+    given precision; pdfloc annotations by their normalized endpoints. Annotations with equal fingerprints are
+    considered the same annotation.
+
+    :param annotation: The annotation.
+    :type annotation: PDFLocBoundingBoxes|PDFLocPair
+    :param float precision: Quantization step of the bbox coordinates.
+    :rtype: tuple
+    """
+    if isinstance(annotation, PDFLocBoundingBoxes):
+        return ('bboxes', annotation.page, tuple(sorted(
+            (bbox.page,) + tuple(int(round(coordinate / precision)) for coordinate in bbox.bbox)
+            for bbox in annotation.bboxes)))
+
+    if isinstance(annotation, PDFLocPair):
+        return ('pdfloc', _normalize_pdfloc(annotation.start), _normalize_pdfloc(annotation.end))
+
+    raise TypeError("Unsupported annotation type %s" % type(annotation))
+
+
+def _normalize_pdfloc(pdfloc):
+    return "".join(str(pdfloc).split()).lstrip("#").lower()
+
+
+def annotation_text(annotation):
+    """Return the normalized highlighted text of the annotation.
+
+    The text is NFKC-normalized, lower-cased and has its whitespace collapsed, so that the same highlight stored by
+    different programs yields the same text. The comment is not used: it is the note of the user, which different
+    highlights may share.
+
+    :param annotation: The annotation.
+    :return: The normalized text, or None if the annotation has no highlighted text.
+    :rtype: unicode
+    """
+    text = getattr(annotation, 'text', None)
+    if not text:
+        return None
+
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+
+    text = u" ".join(unicodedata.normalize('NFKC', text).lower().split())
+    return text if len(text) > 0 else None
+
+
+def match_annotations_by_text(annotations, other_annotations):
+    """Match the annotations of two sets by their normalized highlighted texts and pages.
+
+    The annotations are matched one to one, and only if the page and text identify a single annotation on each side.
+    Annotations sharing their page and text with another annotation of their set (e.g. the same phrase highlighted
+    twice on a page) are left unresolved, to be compared geometrically.
+
+    :param AnnotationSet annotations: The first set.
+    :param AnnotationSet other_annotations: The second set.
+    :return: Tuple (list of common pairs, unresolved part of the first set, unresolved part of the second set). If
+             nothing matched, the given sets are returned as the unresolved parts.
+    """
+    mine = annotations.available_annotations()
+    other = other_annotations.available_annotations()
+
+    other_by_text = _index_by_text(other)
+    if len(other_by_text) == 0:
+        return [], annotations, other_annotations
+
+    my_by_text = _index_by_text(mine)
+
+    common = []
+    matched_mine = set()
+    matched_other = set()
+    for key, my_indices in sorted(my_by_text.items(), key=lambda item: item[1][0]):
+        other_indices = other_by_text.get(key)
+        if len(my_indices) == 1 and other_indices is not None and len(other_indices) == 1:
+            common.append((mine[my_indices[0]], other[other_indices[0]]))
+            matched_mine.add(my_indices[0])
+            matched_other.add(other_indices[0])
+
+    if len(common) == 0:
+        return [], annotations, other_annotations
+
+    return common, annotations.subset([i for i in range(len(mine)) if i not in matched_mine]), \
+        other_annotations.subset([j for j in range(len(other)) if j not in matched_other])
+
+
+def _index_by_text(annotations):
+    by_text = {}
+    for i, annotation in enumerate(annotations):
+        text = annotation_text(annotation)
+        if text is not None:
+            by_text.setdefault((annotation.page, text), []).append(i)
+    return by_text
+
+
+# maximum horizontal gap (in PDF points) between two rectangles on a line that are still merged
+COALESCE_TOLERANCE = 1.0
+# minimum vertical overlap (relative to the lower rectangle) of two rectangles on the same line
+COALESCE_LINE_OVERLAP = 0.5
+
+
+def coalesce_bboxes(annotation, tolerance=COALESCE_TOLERANCE):
+    """Return the annotation with the overlapping or touching rectangles on the same line and page merged.
+
+    Mendeley stores a rectangle per line fragment and conversion from pdfloc may produce several adjacent rectangles
+    per line. Merging them makes equal highlights equal regardless of how they were split, and leaves fewer rectangles
+    to compare and export.
+
+    :param PDFLocBoundingBoxes annotation: The annotation.
+    :param float tolerance: Maximum horizontal gap between two rectangles that are merged.
+    :return: The coalesced annotation (the given one if there was nothing to merge).
+    :rtype: PDFLocBoundingBoxes
+    """
+    if len(annotation.bboxes) < 2:
+        return annotation
+
+    # rectangles as [page, left, bottom, right, top, y-axis flipped], in the order of their left edges
+    rectangles = sorted(([bbox.page, min(bbox.bbox[0], bbox.bbox[2]), min(bbox.bbox[1], bbox.bbox[3]),
+                          max(bbox.bbox[0], bbox.bbox[2]), max(bbox.bbox[1], bbox.bbox[3]), bbox.bbox[1] > bbox.bbox[3]]
+                         for bbox in annotation.bboxes), key=lambda rectangle: (rectangle[0], rectangle[1]))
+
+    merged = []
+    for rectangle in rectangles:
+        for line_rectangle in merged:
+            if line_rectangle[0] == rectangle[0] and rectangle[1] <= line_rectangle[3] + tolerance and \
+                    _vertical_overlap(line_rectangle, rectangle) >= COALESCE_LINE_OVERLAP:
+                line_rectangle[2] = min(line_rectangle[2], rectangle[2])
+                line_rectangle[3] = max(line_rectangle[3], rectangle[3])
+                line_rectangle[4] = max(line_rectangle[4], rectangle[4])
+                break
+        else:
+            merged.append(rectangle)
+
+    if len(merged) == len(annotation.bboxes):
+        return annotation
+
+    bboxes = []
+    for page, left, bottom, right, top, flipped in merged:
+        bboxes.append(BoundingBoxOnPage((left, top, right, bottom) if flipped else (left, bottom, right, top), page))
+
+    return set_annotation_text(PDFLocBoundingBoxes(bboxes, annotation.page, getattr(annotation, 'comment', None)),
+                               getattr(annotation, 'text', None))
+
+
+def coalesce_all_bboxes(annotations, tolerance=COALESCE_TOLERANCE):
+    """Return the list of the given annotations coalesced by :py:func:`coalesce_bboxes`.
+
+    :type annotations: list of PDFLocBoundingBoxes
+    :rtype: list of PDFLocBoundingBoxes
+    """
+    return [coalesce_bboxes(annotation, tolerance) for annotation in annotations]
+
+
+def _vertical_overlap(rectangle_1, rectangle_2):
+    overlap = min(rectangle_1[4], rectangle_2[4]) - max(rectangle_1[2], rectangle_2[2])
+    smaller_height = min(rectangle_1[4] - rectangle_1[2], rectangle_2[4] - rectangle_2[2])
+    if smaller_height <= 0:
+        return 1.0 if overlap >= 0 else 0.0
+    return overlap / float(smaller_height)
+
+
+class ConversionPlanner(object):
+    """
+    Chooses how to compare the annotations of two documents so that as little conversion work as possible is done.
+
+    Converting annotations between the pdfloc and bbox forms requires parsing the document, which is by far the most
+    expensive part of a sync. The planner estimates the cost of the possible strategies from the annotation counts,
+    the pages touched by the annotations and the availability of already converted forms, and picks the cheapest one.
+    """
+
+    # nothing has to be compared or converted
+    SKIP = "skip"
+    # no annotation can be common, all of ours are exported; only our side is converted (to the exported form)
+    EXPORT_ALL = "export_all"
+    # compare in the bbox form
+    COMPARE_BBOXES = "compare_bboxes"
+    # compare in the pdfloc form
+    COMPARE_PDFLOCS = "compare_pdflocs"
+
+    # estimated cost of parsing a document relative to converting a single annotation
+    DOCUMENT_PARSE_COST = 200.0
+    ANNOTATION_CONVERSION_COST = 1.0
+
+    default = None
+
+    def plan(self, document, annotations, other_document, other_annotations, convert_to_bboxes):
+        """Choose the strategy for finding the annotations of `document` missing in `other_document`.
+
+        :param AnnotatedDocument document: The document whose annotations are to be exported.
+        :param AnnotationSet annotations: Its annotations.
+        :param AnnotatedDocument other_document: The document the annotations are exported to.
+        :param AnnotationSet other_annotations: Its annotations.
+        :param bool convert_to_bboxes: Whether the exported annotations have to be in the bbox form.
+        :return: One of the strategy constants of this class.
+        :rtype: basestring
+        """
+        if annotations.empty():
+            return self.SKIP
+
+        if other_annotations.empty() or annotations.pages().isdisjoint(other_annotations.pages()):
+            return self.EXPORT_ALL
+
+        # converting our leftovers to the exported form costs at most as much as converting all of our annotations
+        bboxes_cost = self.conversion_cost(document, annotations, True) + \
+            self.conversion_cost(other_document, other_annotations, True) + \
+            (0 if convert_to_bboxes else self.conversion_cost(document, annotations, False))
+        pdflocs_cost = self.conversion_cost(document, annotations, False) + \
+            self.conversion_cost(other_document, other_annotations, False) + \
+            (self.conversion_cost(document, annotations, True) if convert_to_bboxes else 0)
+
+        if bboxes_cost < pdflocs_cost or (bboxes_cost == pdflocs_cost and convert_to_bboxes):
+            return self.COMPARE_BBOXES
+        return self.COMPARE_PDFLOCS
+
+    def conversion_cost(self, document, annotations, to_bboxes):
+        """Estimate the cost of making the annotations available in the given form.
+
+        :param AnnotatedDocument document: The document the annotations belong to.
+        :param AnnotationSet annotations: The annotations.
+        :param bool to_bboxes: True for the bbox form, False for the pdfloc form.
+        :rtype: float
+        """
+        target = annotations.bbox_annotations if to_bboxes else annotations.pdfloc_annotations
+        if len(target) > 0 or annotations.empty():
+            return 0.0
+
+        source = annotations.pdfloc_annotations if to_bboxes else annotations.bbox_annotations
+        missing = count_unconverted(document, source, to_bboxes)
+        if missing == 0:
+            return 0.0
+
+        parse_cost = 0.0 if self.has_cached_layout(document) else self.DOCUMENT_PARSE_COST
+        return parse_cost + self.ANNOTATION_CONVERSION_COST * missing
+
+    def has_cached_layout(self, document):
+        """Return True if converting annotations of the document doesn't require parsing it.
+
+        :param AnnotatedDocument document: The document.
+        :rtype: bool
+        """
+        return False
+
+
+ConversionPlanner.default = ConversionPlanner()
+
+
 def pdfloc_to_bboxes(document, annotations):
-    converter = PDFLocConverter(document.full_path, pdflocs=annotations.pdfloc_annotations)
-    converter.parse_document()
-    for pdfloc in annotations.pdfloc_annotations:
-        annotations.bbox_annotations.append(PDFLocBoundingBoxes(
-            converter.pdfloc_pair_to_bboxes(pdfloc), pdfloc.start.page, pdfloc.comment)
-        )
+    if isinstance(annotations, AnnotationSubset) and annotations.parent is not None:
+        # the document is parsed anyway, so the whole set is converted and keeps the conversions
+        if len(annotations.parent.bbox_annotations) == 0:
+            pdfloc_to_bboxes(document, annotations.parent)
+        annotations.bbox_annotations.extend(annotations.parent.bbox_annotations[i] for i in annotations.indices)
+        return
+
+    annotations.bbox_annotations.extend(convert_pdflocs_to_bboxes(document, annotations.pdfloc_annotations))
+    _update_cached_size(document, annotations)
 
 
 def bboxes_to_pdfloc(document, annotations):
-    converter = PDFLocConverter(document.full_path, bboxes=annotations.bbox_annotations)
+    if isinstance(annotations, AnnotationSubset) and annotations.parent is not None:
+        if len(annotations.parent.pdfloc_annotations) == 0:
+            bboxes_to_pdfloc(document, annotations.parent)
+        annotations.pdfloc_annotations.extend(annotations.parent.pdfloc_annotations[i] for i in annotations.indices)
+        return
+
+    annotations.pdfloc_annotations.extend(convert_bboxes_to_pdflocs(document, annotations.bbox_annotations))
+    _update_cached_size(document, annotations)
+
+
+def _update_cached_size(document, annotations):
+    # the set may be cached, and the conversions make it larger
+    if getattr(document, 'annotation_cache', None) is not None:
+        document.annotation_cache.update_size(document.full_path, annotations)
+
+
+# persistent cache of converted annotations (a ConversionCache), or None
+_conversion_cache = None
+
+
+def set_conversion_cache(cache):
+    """Set the persistent cache used by the conversion functions.
+
+    :param ConversionCache cache: The cache, or None to disable caching of conversions.
+    """
+    global _conversion_cache
+    _conversion_cache = cache
+
+
+def get_conversion_cache():
+    return _conversion_cache
+
+
+# objects notified about the conversions that parse documents (see add_conversion_listener)
+_conversion_listeners = []
+
+
+def add_conversion_listener(listener):
+    """Register a listener of the conversions that parse documents.
+
+    The listener has to provide the methods ``conversion_started(document, count, to_bboxes)`` and
+    ``conversion_finished(document, count, to_bboxes, duration)``.
+    """
+    _conversion_listeners.append(listener)
+
+
+def remove_conversion_listener(listener):
+    if listener in _conversion_listeners:
+        _conversion_listeners.remove(listener)
+
+
+def document_fingerprint(document):
+    """Return a fingerprint of the document contents.
+
+    The fingerprint is always the SHA1 hash (computed if no library knows it), so that the same document has the same
+    fingerprint in every library.
+
+    :param AnnotatedDocument document: The document.
+    :rtype: str
+    """
+    return "sha1:%s" % document.get_filehash('sha1')
+
+
+def annotation_key(annotation):
+    """Return the key of the annotation in the conversion cache.
+
+    :rtype: str
+    """
+    return repr(annotation_fingerprint(annotation))
+
+
+def count_unconverted(document, annotations, to_bboxes):
+    """Return how many of the annotations would really have to be converted (are not in the conversion cache).
+
+    :param AnnotatedDocument document: The document.
+    :param list annotations: The annotations to convert.
+    :param bool to_bboxes: True if the annotations are pdflocs to be converted to bboxes, False for the opposite.
+    :rtype: int
+    """
+    if _conversion_cache is None or len(annotations) == 0:
+        return len(annotations)
+
+    direction = _conversion_cache.TO_BBOXES if to_bboxes else _conversion_cache.TO_PDFLOCS
+    keys = [annotation_key(annotation) for annotation in annotations]
+    cached_keys = _conversion_cache.get_cached_keys(document_fingerprint(document), direction, keys)
+    return sum(1 for key in keys if key not in cached_keys)
+
+
+def convert_pdflocs_to_bboxes(document, pdflocs):
+    """Convert the given pdfloc annotations of the document to the bbox form.
+
+    Conversions found in the conversion cache are reused; the document is parsed only if some are missing.
+
+    :param AnnotatedDocument document: The document.
+    :param pdflocs: The annotations to convert.
+    :type pdflocs: list of PDFLocPair
+    :return: The converted annotations (in the same order).
+    :rtype: list of PDFLocBoundingBoxes
+    """
+    converted = _convert_cached(document, pdflocs, True, _parse_and_convert_pdflocs)
+    return [set_annotation_text(PDFLocBoundingBoxes(bboxes.bboxes, bboxes.page, pdfloc.comment),
+                                getattr(pdfloc, 'text', None))
+            for (pdfloc, bboxes) in zip(pdflocs, converted)]
+
+
+def convert_bboxes_to_pdflocs(document, bboxes):
+    """Convert the given bbox annotations of the document to the pdfloc form.
+
+    Conversions found in the conversion cache are reused; the document is parsed only if some are missing.
+
+    :param AnnotatedDocument document: The document.
+    :param bboxes: The annotations to convert.
+    :type bboxes: list of PDFLocBoundingBoxes
+    :return: The converted annotations (in the same order).
+    :rtype: list of PDFLocPair
+    """
+    converted = _convert_cached(document, bboxes, False, _parse_and_convert_bboxes)
+    return [set_annotation_text(PDFLocPair(str(pdfloc.start), str(pdfloc.end), getattr(bbox, 'comment', None)),
+                                getattr(bbox, 'text', None))
+            for (bbox, pdfloc) in zip(bboxes, converted)]
+
+
+def _convert_cached(document, annotations, to_bboxes, convert):
+    cache = _conversion_cache
+    if cache is None or len(annotations) == 0:
+        return _convert_notifying(document, annotations, to_bboxes, convert)
+
+    direction = cache.TO_BBOXES if to_bboxes else cache.TO_PDFLOCS
+    fingerprint = document_fingerprint(document)
+    keys = [annotation_key(annotation) for annotation in annotations]
+
+    results = cache.get(fingerprint, direction, keys)
+    missing = [i for (i, key) in enumerate(keys) if key not in results]
+    if len(missing) > 0:
+        converted = _convert_notifying(document, [annotations[i] for i in missing], to_bboxes, convert)
+        new_results = [(keys[i], annotation) for (i, annotation) in zip(missing, converted)]
+        cache.put(fingerprint, direction, new_results)
+        results.update(new_results)
+
+    return [results[key] for key in keys]
+
+
+def _convert_notifying(document, annotations, to_bboxes, convert):
+    if len(_conversion_listeners) == 0 or len(annotations) == 0:
+        return convert(document, annotations)
+
+    for listener in list(_conversion_listeners):
+        listener.conversion_started(document, len(annotations), to_bboxes)
+    start_time = time.time()
+
+    converted = convert(document, annotations)
+
+    duration = time.time() - start_time
+    for listener in list(_conversion_listeners):
+        listener.conversion_finished(document, len(annotations), to_bboxes, duration)
+
+    return converted
+
+
+def _parse_and_convert_pdflocs(document, pdflocs):
+    converter = PDFLocConverter(document.full_path, pdflocs=pdflocs)
+    converter.parse_document()
+    return [PDFLocBoundingBoxes(converter.pdfloc_pair_to_bboxes(pdfloc), pdfloc.start.page, pdfloc.comment)
+            for pdfloc in pdflocs]
+
+
+def _parse_and_convert_bboxes(document, bboxes):
+    converter = PDFLocConverter(document.full_path, bboxes=bboxes)
     converter.parse_document()
-    for bbox in annotations.bbox_annotations:
-        annotations.pdfloc_annotations.append(converter.bboxes_to_pdfloc_pair(bbox))
+    return [converter.bboxes_to_pdfloc_pair(bbox) for bbox in bboxes]
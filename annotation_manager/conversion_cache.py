@@ -0,0 +1,102 @@
+"""
+Persistent cache of converted annotations.
+
+Converting annotations between the pdfloc and bbox forms requires parsing the document. The results are stored per
+annotation, keyed by the fingerprint of the document contents and the fingerprint of the annotation, so a document
+whose annotations changed only has its new annotations converted, and a document whose annotations were all
+converted before is not parsed at all.
+"""
+
+from annotation_manager.cache import content_key
+from annotation_manager.snapshot import encode_annotations, decode_annotations, FORMAT_VERSION
+
+
+class ConversionCache(object):
+    """
+    Store of converted annotations in a namespace of the :py:class:`Cache`.
+
+    The converted annotations are stored without their comments; the comments are taken over from the annotations
+    being converted.
+    """
+
+    TO_BBOXES = "bboxes"
+    TO_PDFLOCS = "pdflocs"
+
+    # namespace of the conversions in the cache
+    NAMESPACE = "conversions"
+
+    _namespace = None
+
+    def __init__(self, cache):
+        """
+        :param Cache cache: The cache to store the conversions in.
+        """
+        super(ConversionCache, self).__init__()
+
+        self._namespace = cache.namespace(self.NAMESPACE)
+
+    def get(self, document_fingerprint, direction, annotation_keys):
+        """Return the cached conversions of the given annotations.
+
+        :param basestring document_fingerprint: Fingerprint of the document contents.
+        :param basestring direction: TO_BBOXES or TO_PDFLOCS.
+        :param annotation_keys: Keys of the annotations (see :py:func:`annotation_key`).
+        :type annotation_keys: list of basestring
+        :return: Annotation key -> converted annotation, for the annotations found in the cache.
+        :rtype: dict
+        """
+        keys = self._get_keys(document_fingerprint, direction, annotation_keys)
+
+        results = {}
+        for key, value in self._namespace.get_many(list(keys)).items():
+            bbox_annotations, pdfloc_annotations = decode_annotations(value)
+            results[keys[key]] = (bbox_annotations if direction == self.TO_BBOXES else pdfloc_annotations)[0]
+
+        return results
+
+    def put(self, document_fingerprint, direction, conversions):
+        """Store conversions of annotations.
+
+        :param basestring document_fingerprint: Fingerprint of the document contents.
+        :param basestring direction: TO_BBOXES or TO_PDFLOCS.
+        :param conversions: Tuples (annotation key, converted annotation).
+        :type conversions: list of tuple
+        """
+        items = []
+        for annotation_key, annotation in conversions:
+            if direction == self.TO_BBOXES:
+                value = encode_annotations([annotation], [])
+            else:
+                value = encode_annotations([], [annotation])
+            items.append((self._get_key(document_fingerprint, direction, annotation_key), value))
+
+        self._namespace.put_many(items)
+
+    def get_cached_keys(self, document_fingerprint, direction, annotation_keys):
+        """Return the keys of the given annotations that have cached conversions, without decoding them.
+
+        :rtype: set
+        """
+        keys = self._get_keys(document_fingerprint, direction, annotation_keys)
+        return set(keys[key] for key in self._namespace.get_existing_keys(list(keys)))
+
+    def clear(self):
+        self._namespace.clear()
+
+    def close(self):
+        self._namespace.cache.close()
+
+    @property
+    def path(self):
+        return self._namespace.cache.path
+
+    @staticmethod
+    def _get_keys(document_fingerprint, direction, annotation_keys):
+        """Return the cache key -> annotation key."""
+        return dict((ConversionCache._get_key(document_fingerprint, direction, annotation_key), annotation_key)
+                    for annotation_key in annotation_keys)
+
+    @staticmethod
+    def _get_key(document_fingerprint, direction, annotation_key):
+        # the values are encoded like snapshots, so values of other encodings are never looked up
+        return content_key(FORMAT_VERSION, document_fingerprint, direction, annotation_key)
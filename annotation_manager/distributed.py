@@ -0,0 +1,428 @@
+"""
+Sync partitioned among several processes or machines through a work queue on shared storage.
+
+A coordinator matches the documents of the source and destination, stores the matched pairs with their annotations
+in an SQLite work queue and partitions them into shards by the fingerprints of the documents. Workers (on any
+machine that sees the queue file and the documents under the same paths) claim the shards one by one, compare the
+annotations (which is where the expensive PDF parsing happens) and store the annotations to export. The coordinator
+is the only writer to the destination; it exports the results as the shards get done.
+
+Claimed shards are leased; a shard whose worker didn't finish it within the lease time is claimed again by another
+worker. Workers keep waiting while other workers hold leases, so that they can take over the shards of a worker that
+died. A shard that failed (or whose lease expired) is retried up to :py:attr:`WorkQueue.MAX_ATTEMPTS` times in total,
+then it is reported as failed.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+
+from annotation_manager.common_representation import AnnotatedDocument, AnnotationSet
+from annotation_manager.snapshot import encode_annotations, decode_annotations
+
+log = logging.getLogger(__name__)
+
+
+class WorkQueue(object):
+    """
+    SQLite-based queue of sync shards.
+    """
+
+    STATE_PENDING = "pending"
+    STATE_CLAIMED = "claimed"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+    STATE_APPLIED = "applied"
+
+    # how long (in seconds) to wait for a lock held by another process
+    BUSY_TIMEOUT = 60.0
+
+    # number of claims of a shard after which it is not retried anymore
+    MAX_ATTEMPTS = 3
+
+    _path = None
+    _connection = None
+
+    def __init__(self, path):
+        super(WorkQueue, self).__init__()
+
+        self._path = path
+        # transactions are controlled explicitly, so that claiming a shard is atomic
+        self._connection = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, state TEXT, worker TEXT, claimed_at REAL, "
+            "attempts INTEGER DEFAULT 0, error TEXT);"
+            "CREATE TABLE IF NOT EXISTS pairs (id INTEGER PRIMARY KEY, shard_id INTEGER, "
+            "source_path TEXT, source_size INTEGER, source_annotations BLOB, "
+            "destination_path TEXT, destination_size INTEGER, destination_annotations BLOB, result BLOB);"
+            "CREATE INDEX IF NOT EXISTS pairs_shard ON pairs (shard_id);"
+            "CREATE INDEX IF NOT EXISTS shards_state ON shards (state);")
+
+    def reset(self):
+        """Remove all shards from the queue."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        self._connection.execute("DELETE FROM pairs")
+        self._connection.execute("DELETE FROM shards")
+        self._connection.execute("COMMIT")
+
+    def add_shards(self, shards):
+        """Add shards to the queue.
+
+        :param shards: Lists of document pairs; each pair is a tuple (source document, destination document).
+        :type shards: list of list
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            for pairs in shards:
+                if len(pairs) == 0:
+                    continue
+
+                shard_id = self._connection.execute("INSERT INTO shards (state) VALUES (?)",
+                                                    (self.STATE_PENDING,)).lastrowid
+                self._connection.executemany(
+                    "INSERT INTO pairs (shard_id,source_path,source_size,source_annotations,"
+                    "destination_path,destination_size,destination_annotations) VALUES (?,?,?,?,?,?,?)",
+                    [(shard_id,
+                      source_document.full_path, source_document.filesize, _encode_document(source_document),
+                      destination_document.full_path, destination_document.filesize,
+                      _encode_document(destination_document)) for (source_document, destination_document) in pairs])
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def claim_shard(self, worker, lease=600.0):
+        """Claim a pending shard (or one whose lease has expired).
+
+        :param basestring worker: Identification of the claiming worker.
+        :param float lease: Time (in seconds) after which the shard can be claimed by another worker.
+        :return: Id of the claimed shard, or None if there is no shard to claim.
+        :rtype: int
+        """
+        now = time.time()
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            # the workers of these shards died (or the shards kill their workers)
+            self._connection.execute(
+                "UPDATE shards SET state=?,error=? WHERE state=? AND claimed_at<? AND attempts>=?",
+                (self.STATE_FAILED, "The lease expired %i times" % self.MAX_ATTEMPTS, self.STATE_CLAIMED,
+                 now - lease, self.MAX_ATTEMPTS))
+
+            row = self._connection.execute(
+                "SELECT id FROM shards WHERE state=? OR (state=? AND claimed_at<?) ORDER BY id LIMIT 1",
+                (self.STATE_PENDING, self.STATE_CLAIMED, now - lease)).fetchone()
+            if row is None:
+                self._connection.execute("COMMIT")
+                return None
+
+            self._connection.execute(
+                "UPDATE shards SET state=?,worker=?,claimed_at=?,attempts=attempts+1 WHERE id=?",
+                (self.STATE_CLAIMED, worker, now, row[0]))
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+        return row[0]
+
+    def get_pairs(self, shard_id):
+        """Return the document pairs of the shard.
+
+        :return: Tuples (pair id, source path, source size, encoded source annotations, destination path, destination
+                 size, encoded destination annotations).
+        :rtype: list of tuple
+        """
+        return self._connection.execute(
+            "SELECT id,source_path,source_size,source_annotations,destination_path,destination_size,"
+            "destination_annotations FROM pairs WHERE shard_id=? ORDER BY id", (shard_id,)).fetchall()
+
+    def complete_shard(self, shard_id, worker, results):
+        """Store the results of a shard.
+
+        The results are only stored if the shard is still claimed by the worker (its lease didn't expire meanwhile).
+
+        :param int shard_id: Id of the shard.
+        :param basestring worker: Identification of the worker.
+        :param results: Tuples (pair id, encoded annotations to export).
+        :return: Whether the results were stored.
+        :rtype: bool
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            updated = self._connection.execute("UPDATE shards SET state=? WHERE id=? AND state=? AND worker=?",
+                                               (self.STATE_DONE, shard_id, self.STATE_CLAIMED, worker)).rowcount
+            if updated == 1:
+                self._connection.executemany("UPDATE pairs SET result=? WHERE id=?",
+                                             [(sqlite3.Binary(result), pair_id) for (pair_id, result) in results])
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+        return updated == 1
+
+    def fail_shard(self, shard_id, worker, error):
+        """Record a failure of the shard, which is then retried unless it was claimed MAX_ATTEMPTS times already.
+
+        :param int shard_id: Id of the shard.
+        :param basestring worker: Identification of the worker.
+        :param basestring error: Description of the failure.
+        """
+        self._connection.execute(
+            "UPDATE shards SET state=CASE WHEN attempts<? THEN ? ELSE ? END,error=? "
+            "WHERE id=? AND state=? AND worker=?",
+            (self.MAX_ATTEMPTS, self.STATE_PENDING, self.STATE_FAILED, error, shard_id, self.STATE_CLAIMED, worker))
+
+    def get_failed_shards(self):
+        """Return the shards that failed for good.
+
+        :return: Tuples (shard id, description of the last failure).
+        :rtype: list of tuple
+        """
+        return self._connection.execute("SELECT id,error FROM shards WHERE state=? ORDER BY id",
+                                        (self.STATE_FAILED,)).fetchall()
+
+    def get_done_results(self):
+        """Return the results of the done shards not applied yet.
+
+        :return: Tuples (shard id, list of tuples (destination path, encoded annotations to export)).
+        :rtype: list of tuple
+        """
+        results = []
+        for (shard_id,) in self._connection.execute("SELECT id FROM shards WHERE state=? ORDER BY id",
+                                                    (self.STATE_DONE,)).fetchall():
+            pairs = self._connection.execute("SELECT destination_path,result FROM pairs WHERE shard_id=? ORDER BY id",
+                                             (shard_id,)).fetchall()
+            results.append((shard_id, [(path, bytes(result)) for (path, result) in pairs if result is not None]))
+        return results
+
+    def mark_applied(self, shard_id):
+        self._connection.execute("UPDATE shards SET state=? WHERE id=?", (self.STATE_APPLIED, shard_id))
+
+    def count_shards(self, *states):
+        """Return the number of shards in any of the given states."""
+        return self._connection.execute("SELECT COUNT(*) FROM shards WHERE state IN (%s)" % ",".join("?" * len(states)),
+                                        states).fetchone()[0]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+
+class DistributedSyncCoordinator(object):
+    """
+    Coordinator of a sync partitioned into shards processed by workers.
+    """
+
+    _queue = None
+    _exporter = None
+    _destination_library = None
+
+    def __init__(self, queue_path, destination_library, exporter):
+        """
+        :param basestring queue_path: Path to the queue database (on storage shared with the workers).
+        :param DocumentLibrary destination_library: The library the annotations are exported to.
+        :param AnnotationExporter exporter: The exporter of the destination.
+        """
+        super(DistributedSyncCoordinator, self).__init__()
+
+        self._queue = WorkQueue(queue_path)
+        self._destination_library = destination_library
+        self._exporter = exporter
+
+    def submit(self, common_documents, shard_count):
+        """Partition the document pairs into shards and put them into the queue (replacing its contents).
+
+        :param common_documents: Tuples (source document, destination document).
+        :type common_documents: list of tuple
+        :param int shard_count: Number of shards.
+        """
+        shards = [[] for _ in range(shard_count)]
+        for pair in common_documents:
+            shards[shard_of(pair[0], shard_count)].append(pair)
+
+        self._queue.reset()
+        self._queue.add_shards(shards)
+
+    # default maximum time (in seconds) to wait for the workers
+    DEFAULT_TIMEOUT = 3600.0
+
+    def collect(self, timeout=DEFAULT_TIMEOUT, poll_interval=1.0):
+        """Export the results of the shards as the workers finish them, until all shards are processed.
+
+        The shards that failed for good are not waited for; see :py:meth:`get_failed_shards`.
+
+        :param float timeout: Maximum time to wait in seconds (None to wait until all shards are processed, even if
+                              no worker is left to process them).
+        :param float poll_interval: Interval of checking the queue for finished shards.
+        :return: Number of exported annotations.
+        :rtype: int
+        :raises RuntimeError: If the shards were not processed in time.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        exported = 0
+
+        while True:
+            applied = []
+            for shard_id, results in self._queue.get_done_results():
+                for destination_path, encoded_annotations in results:
+                    bbox_annotations, pdfloc_annotations = decode_annotations(encoded_annotations)
+                    annotations = bbox_annotations or pdfloc_annotations
+                    if len(annotations) == 0:
+                        continue
+
+                    document = self._destination_library.get_document_by_path(destination_path)
+                    if document is None:
+                        log.warning("Document %s disappeared from the destination", destination_path)
+                        continue
+
+                    exported += self._exporter.add_annotations_to_document(document, annotations)
+
+                applied.append(shard_id)
+
+            # the shards are only marked as applied once the exporter actually wrote their annotations
+            self._exporter.flush()
+            for shard_id in applied:
+                self._queue.mark_applied(shard_id)
+
+            if self._queue.count_shards(WorkQueue.STATE_PENDING, WorkQueue.STATE_CLAIMED,
+                                        WorkQueue.STATE_DONE) == 0:
+                break
+
+            if deadline is not None and time.time() >= deadline:
+                raise RuntimeError("Distributed sync didn't finish in %.0f s" % timeout)
+
+            time.sleep(poll_interval)
+
+        failed = self._queue.count_shards(WorkQueue.STATE_FAILED)
+        if failed > 0:
+            log.warning("%i shards failed, see the errors in %s", failed, self._queue.path)
+
+        return exported
+
+    def get_failed_shards(self):
+        """Return the shards that failed for good (see :py:meth:`WorkQueue.get_failed_shards`)."""
+        return self._queue.get_failed_shards()
+
+    def close(self):
+        self._queue.close()
+
+
+class _ShardAnnotatedDocument(AnnotatedDocument):
+    """
+    Document reconstructed by a worker from a shard.
+    """
+
+    def __init__(self, full_path, filesize, encoded_annotations):
+        super(_ShardAnnotatedDocument, self).__init__(full_path, filesize)
+
+        self._encoded_annotations = encoded_annotations
+
+    def _load_annotations(self):
+        bbox_annotations, pdfloc_annotations = decode_annotations(bytes(self._encoded_annotations))
+        return _ShardAnnotationSet(bbox_annotations, pdfloc_annotations)
+
+
+class _ShardAnnotationSet(AnnotationSet):
+
+    def __init__(self, bbox_annotations, pdfloc_annotations):
+        super(_ShardAnnotationSet, self).__init__()
+
+        self._bbox_annotations = bbox_annotations
+        self._pdfloc_annotations = pdfloc_annotations
+
+
+def run_worker(queue_path, worker=None, lease=600.0, poll_interval=5.0):
+    """Process shards from the queue until all the shards are processed.
+
+    While there is nothing to claim but other workers still hold shards, the worker waits, so that it can take over
+    the shards whose leases expire.
+
+    :param basestring queue_path: Path to the queue database.
+    :param basestring worker: Identification of this worker (defaults to host name and process id).
+    :param float lease: Time (in seconds) after which an unfinished shard of this worker can be claimed by another one.
+    :param float poll_interval: Interval (in seconds) of checking the queue for shards to claim.
+    :return: Number of processed shards.
+    :rtype: int
+    """
+    if worker is None:
+        worker = "%s:%i" % (socket.gethostname(), os.getpid())
+
+    queue = WorkQueue(queue_path)
+    processed = 0
+    try:
+        while True:
+            shard_id = queue.claim_shard(worker, lease)
+            if shard_id is None:
+                if queue.count_shards(WorkQueue.STATE_PENDING, WorkQueue.STATE_CLAIMED) == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            try:
+                results = []
+                for (pair_id, source_path, source_size, source_annotations,
+                     destination_path, destination_size, destination_annotations) in queue.get_pairs(shard_id):
+                    source_document = _ShardAnnotatedDocument(source_path, source_size, source_annotations)
+                    destination_document = _ShardAnnotatedDocument(destination_path, destination_size,
+                                                                    destination_annotations)
+
+                    _, only_source_annotations, _ = source_document.find_common_annotations(destination_document)
+                    results.append((pair_id, encode_annotations(only_source_annotations, [])))
+            except Exception as e:
+                log.exception("Shard %i failed", shard_id)
+                queue.fail_shard(shard_id, worker, str(e))
+                continue
+
+            if queue.complete_shard(shard_id, worker, results):
+                processed += 1
+    finally:
+        queue.close()
+
+    return processed
+
+
+def run_local_workers(queue_path, count, lease=600.0, poll_interval=5.0):
+    """Start worker processes on this machine.
+
+    :param basestring queue_path: Path to the queue database.
+    :param int count: Number of the workers.
+    :param float lease: Lease time of the shards (see :py:func:`run_worker`).
+    :param float poll_interval: Interval of checking the queue for shards to claim (see :py:func:`run_worker`).
+    :return: The started processes.
+    :rtype: list of multiprocessing.Process
+    """
+    processes = []
+    for _ in range(count):
+        process = multiprocessing.Process(target=run_worker, args=(queue_path, None, lease, poll_interval))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def shard_of(document, shard_count):
+    """Return the index of the shard the document belongs to, based on its fingerprint.
+
+    :param AnnotatedDocument document: The (source) document.
+    :param int shard_count: Number of shards.
+    :rtype: int
+    """
+    known_hashes = sorted((hash_method, hash) for (hash_method, hash) in document._filehashes.items()
+                          if hash is not None)
+    fingerprint = repr(known_hashes[0]) if len(known_hashes) > 0 else repr((document.filesize, document.filename))
+    return int(hashlib.sha1(fingerprint.encode('utf-8')).hexdigest(), 16) % shard_count
+
+
+def _encode_document(document):
+    annotations = document.get_annotations()
+    return sqlite3.Binary(encode_annotations(annotations.bbox_annotations, annotations.pdfloc_annotations))
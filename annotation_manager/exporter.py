@@ -31,6 +31,17 @@ class AnnotationExporter(object):
         :param AnnotatedDocument document: The document.
         :param annotations: A list of annotations to add.
         :type annotations: list of PDFLocPair|PDFLocBoundingBoxes
+        :return: The number of annotations added; annotations the destination can't hold (or already has) are
+                 skipped.
+        :rtype: int
+        """
+        pass
+
+    def flush(self):
+        """Write the annotations buffered by :py:meth:`add_annotations_to_document` to the destination.
+
+        Exporters that write the annotations immediately don't need to override this. It is called at the end of
+        every sync.
         """
         pass
 
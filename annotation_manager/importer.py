@@ -16,14 +16,37 @@ class AnnotationImporter(object):
         super(AnnotationImporter, self).__init__()
 
     @abstractmethod
-    def get_annotated_library(self):
+    def get_annotated_library(self, candidates=None):
         """Get the imported :py:class:`DocumentLibrary`.
 
+        :param LibraryCandidates candidates: If given, only documents that can match the candidates are needed.
+                                             Importers that can filter cheaply return a library restricted to them;
+                                             others may ignore the filter.
         :return: The imported :py:class:`DocumentLibrary`.
         :rtype: DocumentLibrary
         """
         pass
 
+    def get_watched_paths(self):
+        """Get the filesystem paths whose changes mean a change of the imported annotations.
+
+        A path may be either a directory (any change inside it counts) or a file.
+
+        :return: The paths to watch.
+        :rtype: list of basestring
+        """
+        return []
+
+    def notify_changed(self, paths):
+        """Notify the importer that some of its watched paths have changed.
+
+        Importers that do not see the changes through their already imported library should drop it here.
+
+        :param paths: The changed paths (a subset of :py:meth:`get_watched_paths`).
+        :type paths: set of basestring
+        """
+        pass
+
 
 class AnnotationImporterFactory(object):
     """
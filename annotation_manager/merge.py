@@ -0,0 +1,170 @@
+"""
+Merging of any number of document libraries into a single canonical library.
+"""
+
+from collections import OrderedDict
+
+from annotation_manager.common_representation import DocumentLibrary, AnnotatedDocument, AnnotationSet, \
+    pdfloc_to_bboxes, annotation_fingerprint, coalesce_all_bboxes, find_common_items
+
+
+class MergedDocumentLibrary(DocumentLibrary):
+    """
+    Canonical library containing the documents of all the given libraries, with each document found in several
+    libraries present only once.
+
+    The documents are matched in a single pass over all libraries: they are bucketed by file size, and only the
+    buckets with documents from more than one library are grouped further by filename and content hash.
+    """
+
+    _libraries = None
+
+    def __init__(self, libraries):
+        """
+        :param libraries: The libraries to merge.
+        :type libraries: list of DocumentLibrary
+        """
+        super(MergedDocumentLibrary, self).__init__()
+
+        self._libraries = list(libraries)
+
+        documents = OrderedDict()
+        for members in match_documents(self._libraries):
+            document = MergedAnnotatedDocument(members)
+            documents[document.full_path] = document
+
+        self.add_documents(**documents)
+
+    @property
+    def libraries(self):
+        return tuple(self._libraries)
+
+
+class MergedAnnotatedDocument(AnnotatedDocument):
+    """
+    A document merged from the matching documents of several libraries.
+
+    Its annotations are the union of the annotations of all its members, converted to the bbox form and coalesced.
+    An annotation of a member is left out if it matches an annotation already merged, compared the same way as by
+    :py:meth:`AnnotatedDocument.find_common_annotations` (by fingerprints and then by ``==``, which tolerates the
+    small differences between the rectangles stored by different programs).
+    """
+
+    _members = None
+
+    def __init__(self, members):
+        """
+        :param members: Tuples (index of the library, document) of the matching documents.
+        :type members: list of tuple
+        """
+        assert len(members) > 0
+
+        first_document = members[0][1]
+        super(MergedAnnotatedDocument, self).__init__(first_document.full_path, first_document.filesize)
+
+        self._members = list(members)
+
+        for _, document in self._members:
+            for hash_method, hash in document._filehashes.items():
+                if hash is not None:
+                    self._filehashes[hash_method] = hash
+
+    @property
+    def members(self):
+        """Tuples (index of the library, document) of the documents this document was merged from."""
+        return tuple(self._members)
+
+    def get_members_from(self, library_index):
+        """Return the member documents coming from the library with the given index.
+
+        :param int library_index: Index of the library (in the order the libraries were given to the merged library).
+        :rtype: list of AnnotatedDocument
+        """
+        return [document for (index, document) in self._members if index == library_index]
+
+    def get_annotations_version(self):
+        versions = tuple(document.get_annotations_version() for (_, document) in self._members)
+        return None if None in versions else versions
+
+    def _load_annotations(self):
+        annotations = []
+
+        for _, document in self._members:
+            member_annotations = document.get_annotations()
+            if len(member_annotations.bbox_annotations) == 0 and len(member_annotations.pdfloc_annotations) > 0:
+                pdfloc_to_bboxes(document, member_annotations)
+
+            _, new_annotations, _ = find_common_items(coalesce_all_bboxes(member_annotations.bbox_annotations),
+                                                      annotations, lambda annotation: annotation.page,
+                                                      annotation_fingerprint)
+            annotations.extend(new_annotations)
+
+        return MergedAnnotationSet(self, annotations)
+
+
+class MergedAnnotationSet(AnnotationSet):
+
+    _document = None
+
+    def __init__(self, document, annotations):
+        super(MergedAnnotationSet, self).__init__()
+
+        self._document = document
+        self._bbox_annotations = annotations
+
+
+def match_documents(libraries):
+    """Group the matching documents of all the given libraries.
+
+    Two documents match if they have the same size and either the same filename or the same contents (like
+    :py:meth:`AnnotatedDocument.__eq__`).
+
+    :param libraries: The libraries.
+    :type libraries: list of DocumentLibrary
+    :return: Groups of matching documents; each group is a list of tuples (index of the library, document).
+    :rtype: list of list
+    """
+    buckets = OrderedDict()
+    for index, library in enumerate(libraries):
+        for document in library.get_documents():
+            buckets.setdefault(document.filesize, []).append((index, document))
+
+    groups = []
+    for members in buckets.values():
+        if len(members) == 1 or len(set(index for (index, _) in members)) == 1:
+            groups.extend([member] for member in members)
+            continue
+
+        groups.extend(_group_bucket(members))
+
+    return groups
+
+
+def _group_bucket(members):
+    # union-find over the members of a single size bucket
+    parents = list(range(len(members)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union_by(key_function):
+        first_with_key = {}
+        for i, (_, document) in enumerate(members):
+            key = key_function(document)
+            if key in first_with_key:
+                parents[find(i)] = find(first_with_key[key])
+            else:
+                first_with_key[key] = i
+
+    union_by(lambda document: document.filename)
+    if len(set(find(i) for i in range(len(members)))) > 1:
+        union_by(lambda document: document.get_filehash('sha1'))
+
+    groups = OrderedDict()
+    for i, member in enumerate(members):
+        groups.setdefault(find(i), []).append(member)
+
+    return list(groups.values())
@@ -0,0 +1,265 @@
+"""
+Streaming export and lazy import of libraries as newline-delimited JSON.
+
+The source/destination is specified as u"jsonl" + os.pathsep + path_to_the_file. Every line of the file is a single
+record: a document record ``{"type": "document", "path": ..., "size": ..., "hashes": {...}}`` is followed by the
+annotation records ``{"type": "annotation", "annotation": {...}}`` of that document (in both the bbox and the pdfloc
+form, as far as they are available). A document may appear several times (e.g. once per export of new annotations);
+its annotations are then the union of all its records. A file that doesn't exist yet is an empty library.
+"""
+
+import io
+import json
+import os
+
+from annotation_manager.common_representation import DocumentLibrary, AnnotatedDocument, AnnotationSet
+from annotation_manager.exporter import AnnotationExporterFactory, AnnotationExporter
+from annotation_manager.importer import AnnotationImporterFactory, AnnotationImporter
+from annotation_manager.serialization import annotation_to_dict, annotation_from_dict, document_to_dict
+
+SCHEME = "jsonl"
+
+RECORD_DOCUMENT = "document"
+RECORD_ANNOTATION = "annotation"
+
+
+def iter_documents(path):
+    """Read the documents of a JSONL file one by one, holding only a single document in memory.
+
+    Unlike :py:class:`JsonlDocumentLibrary`, repeated records of the same document are not merged.
+
+    :param basestring path: Path to the file.
+    :return: Tuples (document record, list of annotations).
+    """
+    document = None
+    annotations = []
+    with io.open(path, 'rb') as jsonl_file:
+        for line in jsonl_file:
+            if len(line.strip()) == 0:
+                continue
+
+            record = json.loads(line.decode('utf-8'))
+            if record['type'] == RECORD_DOCUMENT:
+                if document is not None:
+                    yield document, annotations
+                document = record
+                annotations = []
+            elif record['type'] == RECORD_ANNOTATION and document is not None:
+                annotations.append(annotation_from_dict(record['annotation']))
+
+    if document is not None:
+        yield document, annotations
+
+
+def write_document(output, document, annotations):
+    """Write the records of a document and its annotations.
+
+    :param output: The binary file to write to.
+    :param AnnotatedDocument document: The document.
+    :param annotations: The annotations to write.
+    :type annotations: list of PDFLocPair|PDFLocBoundingBoxes
+    """
+    record = document_to_dict(document)
+    record['type'] = RECORD_DOCUMENT
+    output.write(_encode_record(record))
+
+    for annotation in annotations:
+        output.write(_encode_record({'type': RECORD_ANNOTATION, 'annotation': annotation_to_dict(annotation)}))
+
+
+def _encode_record(record):
+    return json.dumps(record, sort_keys=True).encode('utf-8') + b"\n"
+
+
+class JsonlDocumentLibrary(DocumentLibrary):
+    """
+    Library read from a JSONL file.
+
+    Only the document records are decoded when the library is loaded; for each document the offsets of its records are
+    kept, and its annotations are read from the file when they are first requested.
+    """
+
+    _path = None
+
+    def __init__(self, path):
+        super(JsonlDocumentLibrary, self).__init__()
+
+        self._path = path
+
+        records = {}
+        if os.path.isfile(path):
+            with io.open(path, 'rb') as jsonl_file:
+                offset = 0
+                for line in iter(jsonl_file.readline, b""):
+                    # document records start with the sorted keys, so the annotation records can be skipped undecoded
+                    if b'"type": "document"' in line:
+                        record = json.loads(line.decode('utf-8'))
+                        if record['path'] in records:
+                            records[record['path']][1].append(offset)
+                        else:
+                            records[record['path']] = (record, [offset])
+                    offset += len(line)
+
+        self.add_documents(**dict((path, JsonlAnnotatedDocument(self._path, record, offsets))
+                                  for (path, (record, offsets)) in records.items()))
+
+    @property
+    def path(self):
+        return self._path
+
+
+class JsonlAnnotatedDocument(AnnotatedDocument):
+
+    _jsonl_path = None
+    _offsets = None
+
+    def __init__(self, jsonl_path, record, offsets):
+        """
+        :param basestring jsonl_path: Path to the JSONL file.
+        :param dict record: The (first) document record.
+        :param offsets: Offsets of all the document records of this document in the file.
+        :type offsets: list of int
+        """
+        super(JsonlAnnotatedDocument, self).__init__(record['path'], record['size'])
+
+        self._jsonl_path = jsonl_path
+        self._offsets = offsets
+
+        self._filehashes.update(record.get('hashes', {}))
+
+    def get_annotations_version(self):
+        # records are only appended (and a replaced file means a new library), so the annotations of a document only
+        # change by a new record of the document
+        return tuple(self._offsets)
+
+    def _load_annotations(self):
+        bbox_annotations = []
+        pdfloc_annotations = []
+
+        with io.open(self._jsonl_path, 'rb') as jsonl_file:
+            for offset in self._offsets:
+                jsonl_file.seek(offset)
+                jsonl_file.readline()
+
+                for line in iter(jsonl_file.readline, b""):
+                    record = json.loads(line.decode('utf-8'))
+                    if record['type'] != RECORD_ANNOTATION:
+                        break
+
+                    annotation = annotation_from_dict(record['annotation'])
+                    if hasattr(annotation, 'bboxes'):
+                        bbox_annotations.append(annotation)
+                    else:
+                        pdfloc_annotations.append(annotation)
+
+        return JsonlAnnotationSet(self, bbox_annotations, pdfloc_annotations)
+
+
+class JsonlAnnotationSet(AnnotationSet):
+
+    _document = None
+
+    def __init__(self, document, bbox_annotations, pdfloc_annotations):
+        super(JsonlAnnotationSet, self).__init__()
+
+        self._document = document
+        self._bbox_annotations = bbox_annotations
+        self._pdfloc_annotations = pdfloc_annotations
+
+
+class JsonlAnnotationImporter(AnnotationImporter):
+
+    _path = None
+
+    _library = None
+
+    def __init__(self, path):
+        super(JsonlAnnotationImporter, self).__init__()
+
+        self._path = path
+
+    def get_annotated_library(self, candidates=None):
+        if self._library is None:
+            self._library = JsonlDocumentLibrary(self._path)
+
+        return self._library
+
+    def get_watched_paths(self):
+        return [self._path]
+
+    def notify_changed(self, paths):
+        if len(paths) > 0:
+            self._library = None
+
+
+class JsonlExporter(AnnotationExporter):
+    """
+    Exporter writing the records to a JSONL file as the documents are processed.
+
+    :py:meth:`export_library` writes the whole library to a temporary file (one document at a time), which then
+    replaces the file by a rename, so readers never see a partially written library;
+    :py:meth:`add_annotations_to_document` appends the records of the new annotations.
+    """
+
+    def __init__(self, path):
+        super(JsonlExporter, self).__init__()
+
+        self._path = path
+
+    def export_library(self, library):
+        directory, filename = os.path.split(self._path)
+        temporary_path = os.path.join(directory, "." + filename + ".tmp")
+        try:
+            with io.open(temporary_path, 'wb') as output:
+                for document in library.get_documents():
+                    annotations = document.get_annotations()
+                    write_document(output, document,
+                                   list(annotations.bbox_annotations) + list(annotations.pdfloc_annotations))
+                    output.flush()
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        if os.name == 'nt' and os.path.exists(self._path):
+            # rename doesn't replace existing files on Windows
+            os.remove(self._path)
+        os.rename(temporary_path, self._path)
+
+    def add_annotations_to_document(self, document, annotations):
+        with io.open(self._path, 'ab') as output:
+            write_document(output, document, annotations)
+
+        return len(annotations)
+
+
+def _location_to_path(location):
+    if not isinstance(location, str) and not isinstance(location, unicode):
+        return None
+
+    parts = location.split(os.pathsep, 1)
+    if len(parts) != 2 or parts[0] != SCHEME or len(parts[1]) == 0:
+        return None
+
+    return parts[1]
+
+
+class JsonlImporterFactory(AnnotationImporterFactory):
+
+    def get_importer_for_source(self, source):
+        path = _location_to_path(source)
+        if path is None or os.path.isdir(path):
+            return None
+
+        # a missing file is an empty library (e.g. a destination not exported to yet)
+        return JsonlAnnotationImporter(path)
+
+
+class JsonlExporterFactory(AnnotationExporterFactory):
+
+    def get_exporter_for_destination(self, destination):
+        path = _location_to_path(destination)
+        if path is None:
+            return None
+
+        return JsonlExporter(path)
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import logging
 import os
 import sys
 import sqlite3
@@ -8,7 +9,8 @@ from datetime import datetime
 import urllib
 
 from pdfloc_converter.pdfloc import BoundingBoxOnPage, PDFLocBoundingBoxes
-from annotation_manager.common_representation import DocumentLibrary, AnnotatedDocument, AnnotationSet
+from annotation_manager.common_representation import DocumentLibrary, AnnotatedDocument, AnnotationSet, \
+    annotation_fingerprint, coalesce_bboxes
 from annotation_manager.exporter import AnnotationExporterFactory, AnnotationExporter
 from annotation_manager.importer import AnnotationImporterFactory, AnnotationImporter
 
@@ -18,6 +20,8 @@ In order for this plugin to work on Windows, you must replace your Python/DLLs/s
 newest version from http://www.sqlite.org/download.html .
 """
 
+log = logging.getLogger(__name__)
+
 
 class MendeleyDocumentLibrary(DocumentLibrary):
 
@@ -26,15 +30,32 @@ class MendeleyDocumentLibrary(DocumentLibrary):
 
     _documents = {}
 
-    def __init__(self, sqlite_connection):
+    def __init__(self, sqlite_connection, candidates=None):
+        """
+        :param sqlite3.Connection sqlite_connection: Connection to the Mendeley database.
+        :param LibraryCandidates candidates: If given, only the documents that can match the candidates are loaded:
+                                             those with the SHA1 hash or the filename of a candidate (and its size).
+                                             The file size is not in the database, so a renamed copy of a candidate
+                                             is only found if the candidate's SHA1 hash is known.
+        """
         super(MendeleyDocumentLibrary, self).__init__()
 
         self._sqlite_connection = sqlite_connection
         self._sqlite_cursor = cursor = sqlite_connection.cursor()
 
-        cursor.execute("SELECT df.documentId,df.hash,f.localUrl "
-                       "FROM DocumentFiles df JOIN Files f ON df.hash=f.hash "
-                       "WHERE unlinked='false' AND f.localUrl!=''")
+        query = "SELECT df.documentId,df.hash,f.localUrl " \
+                "FROM DocumentFiles df JOIN Files f ON df.hash=f.hash " \
+                "WHERE unlinked='false' AND f.localUrl!=''"
+
+        # only the rows passing the filter are turned into documents, which needs a stat of every file
+        if candidates is not None:
+            if not candidates.is_hash_complete('sha1'):
+                log.info("Not all candidates have SHA1 hashes, their renamed copies in Mendeley won't be found")
+            self._create_candidate_tables(candidates)
+            query += " AND (df.hash IN (SELECT hash FROM temp.candidate_hashes) " \
+                     "OR url_filename(f.localUrl) IN (SELECT name FROM temp.candidate_names))"
+
+        cursor.execute(query)
         result = cursor.fetchall()
 
         documents = {}
@@ -45,6 +66,8 @@ class MendeleyDocumentLibrary(DocumentLibrary):
 
             try:
                 document = MendeleyAnnotatedDocument(document_id, file_hash, file_url, cursor)
+                if candidates is not None and not candidates.may_match(document.filesize):
+                    continue
                 documents[document.full_path] = document
             except Exception as e:
                 print(e)
@@ -52,6 +75,28 @@ class MendeleyDocumentLibrary(DocumentLibrary):
 
         self.add_documents(**documents)
 
+    def _create_candidate_tables(self, candidates):
+        connection = self._sqlite_connection
+        connection.create_function("url_filename", 1, MendeleyPlugin.url_to_filename)
+
+        # temporary tables don't change the database, but query_only forbids them as well
+        query_only = connection.execute("PRAGMA query_only").fetchone()[0]
+        if query_only:
+            connection.execute("PRAGMA query_only=0")
+        try:
+            connection.execute("DROP TABLE IF EXISTS temp.candidate_hashes")
+            connection.execute("DROP TABLE IF EXISTS temp.candidate_names")
+            connection.execute("CREATE TEMP TABLE candidate_hashes (hash TEXT PRIMARY KEY)")
+            connection.execute("CREATE TEMP TABLE candidate_names (name TEXT PRIMARY KEY)")
+            connection.executemany("INSERT OR IGNORE INTO temp.candidate_hashes VALUES (?)",
+                                   ((hash,) for hash in candidates.get_hashes('sha1')))
+            connection.executemany("INSERT OR IGNORE INTO temp.candidate_names VALUES (?)",
+                                   ((filename,) for filename in candidates.filenames))
+            connection.commit()
+        finally:
+            if query_only:
+                connection.execute("PRAGMA query_only=1")
+
 
 class MendeleyAnnotatedDocument(AnnotatedDocument):
 
@@ -62,10 +107,7 @@ class MendeleyAnnotatedDocument(AnnotatedDocument):
     _sqlite_cursor = None
 
     def __init__(self, document_id, file_hash, file_url, sqlite_cursor):
-        full_path = urllib.unquote(file_url.encode('ascii')[len("file:///"):]).replace("//", "/").decode('utf-8')
-        if sys.platform.startswith(u"win32"):
-            full_path = full_path.replace(u"/", u"\\")
-
+        full_path = MendeleyPlugin.url_to_path(file_url)
         filesize = os.path.getsize(full_path)
 
         super(MendeleyAnnotatedDocument, self).__init__(full_path, filesize)
@@ -85,7 +127,13 @@ class MendeleyAnnotatedDocument(AnnotatedDocument):
     def file_hash(self):
         return self._file_hash
 
-    def get_annotations(self):
+    def get_annotations_version(self):
+        # highlights are never edited in place, they are only added or unlinked
+        self._sqlite_cursor.execute("SELECT COUNT(*),MAX(id) FROM FileHighlights "
+                                    "WHERE unlinked='false' AND documentId=?", (self._document_id,))
+        return tuple(self._sqlite_cursor.fetchone())
+
+    def _load_annotations(self):
         self._sqlite_cursor.execute("SELECT h.id,h.createdTime,hr.id,hr.page,hr.x1,hr.y1,hr.x2,hr.y2 "
                                     "FROM FileHighlights h JOIN FileHighlightRects hr ON h.id=hr.highlightId "
                                     "WHERE h.unlinked='false' AND h.documentId=?", (self._document_id,))
@@ -124,33 +172,165 @@ class MendeleyAnnotationSet(AnnotationSet):
 class MendeleyAnnotationImporter(AnnotationImporter):
 
     _sqlite_path = None
+    _open_mode = None
 
+    # connection shared by the full library and the filtered ones
+    _connection = None
     _library = None
-
-    def __init__(self, sqlite_path):
+    # tuple (candidates, library filtered by them) of the last filtered import
+    _filtered_library = None
+
+    def __init__(self, sqlite_path, open_mode=None):
+        """
+        :param basestring sqlite_path: Path to the Mendeley Desktop SQLite database.
+        :param basestring open_mode: How to open the database, one of the MendeleyPlugin.OPEN_MODE_* constants.
+                                     Defaults to MendeleyPlugin.OPEN_MODE_READ_WRITE.
+        """
         super(MendeleyAnnotationImporter, self).__init__()
 
         self._sqlite_path = sqlite_path
+        self._open_mode = open_mode if open_mode is not None else MendeleyPlugin.OPEN_MODE_READ_WRITE
+
+    def get_annotated_library(self, candidates=None):
+        if candidates is not None:
+            # a filtered library is only useful for the sync it was requested for, so only the last one is kept
+            if self._filtered_library is None or self._filtered_library[0] is not candidates:
+                self._filtered_library = (candidates, MendeleyDocumentLibrary(self._get_connection(), candidates))
+            return self._filtered_library[1]
 
-    def get_annotated_library(self):
         if self._library is None:
-            self._library = MendeleyDocumentLibrary(sqlite3.connect(self._sqlite_path))
+            self._library = MendeleyDocumentLibrary(self._get_connection())
 
         return self._library
 
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = MendeleyPlugin.open_database(self._sqlite_path, self._open_mode)
+        return self._connection
+
+    def reload(self):
+        """Drop the imported library, so that the next :py:meth:`get_annotated_library` call re-reads the database.
+
+        In the snapshot mode, this is the only way to see changes made to the database after the import.
+        """
+        self._library = None
+        self._filtered_library = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_watched_paths(self):
+        return [self._sqlite_path]
+
+    def notify_changed(self, paths):
+        # a snapshot doesn't see the changes, the live connections do
+        if self._open_mode == MendeleyPlugin.OPEN_MODE_SNAPSHOT and len(paths) > 0:
+            self.reload()
+
+    @property
+    def open_mode(self):
+        return self._open_mode
+
 
 class MendeleyImporterFactory(AnnotationImporterFactory):
 
+    # the mode in which importers created by this factory open the database
+    open_mode = None
+
     def get_importer_for_source(self, source):
         sqlite_full_path = MendeleyPlugin.location_to_sqlite_path(source)
         if sqlite_full_path is None:
             return None
 
-        return MendeleyAnnotationImporter(sqlite_full_path)
+        return MendeleyAnnotationImporter(sqlite_full_path, self.open_mode)
 
 
 class MendeleyPlugin(object):
 
+    # plain connection to the live database (the original behavior)
+    OPEN_MODE_READ_WRITE = "rw"
+    # read-only, query-only and memory-mapped connection to the live database
+    OPEN_MODE_READ_ONLY = "ro"
+    # in-memory copy of the database taken at import time; the live database is only locked while copying
+    OPEN_MODE_SNAPSHOT = "snapshot"
+
+    # size of the memory map used by read-only connections
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    @staticmethod
+    def open_database(sqlite_path, open_mode=OPEN_MODE_READ_WRITE):
+        """Open a connection to the Mendeley database in the given mode.
+
+        :param basestring sqlite_path: Path to the SQLite database.
+        :param basestring open_mode: One of the OPEN_MODE_* constants.
+        :return: The connection.
+        :rtype: sqlite3.Connection
+        """
+        if open_mode == MendeleyPlugin.OPEN_MODE_READ_WRITE:
+            return sqlite3.connect(sqlite_path)
+
+        if open_mode == MendeleyPlugin.OPEN_MODE_READ_ONLY:
+            return MendeleyPlugin._connect_read_only(sqlite_path)
+
+        if open_mode == MendeleyPlugin.OPEN_MODE_SNAPSHOT:
+            return MendeleyPlugin._take_snapshot(sqlite_path)
+
+        raise ValueError("Unknown Mendeley database open mode '%s'" % open_mode)
+
+    @staticmethod
+    def _connect_read_only(sqlite_path):
+        if sys.version_info >= (3, 4):
+            from urllib.request import pathname2url
+            connection = sqlite3.connect(u"file:%s?mode=ro" % pathname2url(sqlite_path), uri=True)
+        else:
+            # the sqlite3 module of Python 2 doesn't support URI filenames; query_only still guarantees we never
+            # take a write lock
+            connection = sqlite3.connect(sqlite_path)
+
+        connection.execute("PRAGMA query_only=1")
+        connection.execute("PRAGMA mmap_size=%d" % MendeleyPlugin.MMAP_SIZE)
+
+        return connection
+
+    @staticmethod
+    def _take_snapshot(sqlite_path):
+        source = MendeleyPlugin._connect_read_only(sqlite_path)
+        snapshot = sqlite3.connect(":memory:")
+
+        try:
+            if hasattr(source, "backup"):
+                source.backup(snapshot)
+            else:
+                # no backup API before Python 3.7; dump the database in a single read transaction instead
+                source.execute("BEGIN")
+                snapshot.executescript(u"\n".join(source.iterdump()))
+        finally:
+            source.close()
+
+        snapshot.execute("PRAGMA query_only=1")
+
+        return snapshot
+
+    @staticmethod
+    def url_to_path(file_url):
+        """Convert a file URL stored in the database to the filesystem path.
+
+        :param unicode file_url: The URL (file:///...).
+        :rtype: unicode
+        """
+        full_path = urllib.unquote(file_url.encode('ascii')[len("file:///"):]).replace("//", "/").decode('utf-8')
+        if sys.platform.startswith(u"win32"):
+            full_path = full_path.replace(u"/", u"\\")
+        return full_path
+
+    @staticmethod
+    def url_to_filename(file_url):
+        """Return the filename of the file at the given URL (as :py:attr:`AnnotatedDocument.filename`), or None."""
+        try:
+            return MendeleyPlugin.url_to_path(file_url).split(os.sep)[-1]
+        except (UnicodeError, AttributeError):
+            return None
+
     @staticmethod
     def location_to_sqlite_path(location):
 
@@ -235,8 +415,21 @@ class MendeleyExporter(AnnotationExporter):
             pdf_hash = document.file_hash
             date = self.get_current_date_string()
 
+            # never insert a highlight the document already has (e.g. when the same export is repeated)
+            existing_fingerprints = self.get_highlight_fingerprints(cursor, document_id)
+            added = 0
+
             for annotation in annotations:
                 assert isinstance(annotation, PDFLocBoundingBoxes)
+
+                # write a single rectangle per line instead of one per fragment
+                annotation = coalesce_bboxes(annotation)
+
+                fingerprint = annotation_fingerprint(annotation)
+                if fingerprint in existing_fingerprints:
+                    continue
+                existing_fingerprints.add(fingerprint)
+
                 guid = self.create_guid()
 
                 cursor.execute(
@@ -256,6 +449,29 @@ class MendeleyExporter(AnnotationExporter):
                         (annotation_id, bbox.page, bbox.bbox[0], bbox.bbox[1], bbox.bbox[2], bbox.bbox[3])
                     )
 
+                added += 1
+
+        return added
+
+    @staticmethod
+    def get_highlight_fingerprints(cursor, document_id):
+        """Return the fingerprints of the highlights the document has in the database.
+
+        :param sqlite3.Cursor cursor: Cursor to the database.
+        :param int document_id: Id of the document.
+        :rtype: set of tuple
+        """
+        cursor.execute("SELECT h.id,hr.page,hr.x1,hr.y1,hr.x2,hr.y2 "
+                       "FROM FileHighlights h JOIN FileHighlightRects hr ON h.id=hr.highlightId "
+                       "WHERE h.unlinked='false' AND h.documentId=?", (document_id,))
+
+        highlights = {}
+        for row in cursor.fetchall():
+            highlights.setdefault(row[0], []).append(BoundingBoxOnPage(row[2:6], row[1]))
+
+        return set(annotation_fingerprint(coalesce_bboxes(PDFLocBoundingBoxes(bboxes)))
+                   for bboxes in highlights.values())
+
     @staticmethod
     def create_guid():
         return str(uuid.uuid4())
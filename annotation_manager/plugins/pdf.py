@@ -20,4 +20,4 @@ class PdfExporter(AnnotationExporter):
         pass
 
     def add_annotations_to_document(self, document, annotations):
-        pass
+        return 0
@@ -1,20 +1,174 @@
 import os
 import hashlib
+import json
+import logging
 import re
+import sqlite3
 from collections import OrderedDict
 
 from annotation_manager.importer import AnnotationImporterFactory, AnnotationImporter
-from annotation_manager.common_representation import AnnotatedDocument, DocumentLibrary, AnnotationSet
+from annotation_manager.exporter import AnnotationExporterFactory, AnnotationExporter
+from annotation_manager.common_representation import AnnotatedDocument, DocumentLibrary, AnnotationSet, \
+    convert_bboxes_to_pdflocs, set_annotation_text
+from annotation_manager.plugins.utils import tail_lines
 from pdfloc_converter.pdfloc import PDFLocPair
 
+log = logging.getLogger(__name__)
+
+
+class IncrementalAnnotationReader(object):
+    """
+    Reader of Pocketbook annotation files that only parses the entries appended since the previous read of a file.
+
+    The reader remembers the byte offset just after the last complete entry of each file together with the entries
+    parsed so far. The reader appends new entries to the file, so on the next read only the lines after the
+    remembered offset are read (from the end of the file). If the file got shorter or the bytes before the offset
+    changed, the file is parsed from the beginning.
+    """
+
+    # number of bytes before the remembered offset used to check that the already parsed part didn't change
+    ANCHOR_SIZE = 64
+
+    _states = None
+
+    def __init__(self):
+        super(IncrementalAnnotationReader, self).__init__()
+
+        self._states = {}
+
+    def read(self, annotations_file):
+        """Return all annotations from the given file.
+
+        :param basestring annotations_file: Path to the annotation file.
+        :return: The annotations.
+        :rtype: list of PDFLocPair
+        """
+        try:
+            stat = os.stat(annotations_file)
+        except OSError:
+            # no annotation file means the document has not been annotated yet
+            self._states.pop(annotations_file, None)
+            return []
+
+        state = self._states.get(annotations_file)
+
+        if state is not None and state.mtime == stat.st_mtime and state.size == stat.st_size:
+            return state.annotations + state.pending_annotations
+
+        with open(annotations_file, 'rb') as f:
+            if state is None or stat.st_size < state.offset or self._read_anchor(f, state.offset) != state.anchor:
+                state = _AnnotationFileState()
+
+            new_annotations, pending_annotations, offset = self._parse_lines(tail_lines(f, state.offset))
+
+            state.annotations = state.annotations + new_annotations
+            state.pending_annotations = pending_annotations
+            if offset is not None:
+                state.offset = offset
+                state.anchor = self._read_anchor(f, offset)
+            state.mtime = stat.st_mtime
+            state.size = stat.st_size
+
+        self._states[annotations_file] = state
+
+        return state.annotations + state.pending_annotations
+
+    def get_annotation_count(self, annotations_file):
+        """Return the number of complete annotations read from the given file so far.
+
+        :param basestring annotations_file: Path to the annotation file.
+        :rtype: int
+        """
+        state = self._states.get(annotations_file)
+        return len(state.annotations) if state is not None else 0
+
+    def forget(self, annotations_file=None):
+        """Forget the state of the given file (or all files), so that it is parsed from the beginning next time."""
+        if annotations_file is None:
+            self._states.clear()
+        else:
+            self._states.pop(annotations_file, None)
+
+    def _read_anchor(self, f, offset):
+        start = max(0, offset - self.ANCHOR_SIZE)
+        f.seek(start)
+        return f.read(offset - start)
+
+    @staticmethod
+    def _parse_lines(lines):
+        """Parse annotation entries from the given lines.
+
+        :param lines: Tuples (offset, line) as returned by :py:func:`tail_lines`.
+        :return: Tuple (complete annotations, annotations of an entry cut off at the end of the file, offset after the
+                 last complete entry or None if no entry is complete).
+        """
+        annotations = []
+        offset = None
+
+        i = 0
+        while i < len(lines):
+            match = re.match(PocketbookAnnotatedDocument._pdfloc_regex, lines[i][1])
+            if match is None:
+                i += 1
+                continue
+
+            start = match.group(1)
+            end = match.group(2)
+
+            # the comment is stored two lines further
+            if i + 2 >= len(lines):
+                return annotations, [PDFLocPair(start, end, None)], offset
+
+            comment = None
+            comment_match = re.match(PocketbookAnnotatedDocument._pdfloc_comment_regex, lines[i + 2][1])
+            if comment_match is not None:
+                comment = AnnotationStorage.unescape_comment(comment_match.group(1))
+
+            annotations.append(PDFLocPair(start, end, comment))
+
+            offset = lines[i + 2][0] + len(lines[i + 2][1])
+            i += 3
+
+        return annotations, [], offset
+
+
+class _AnnotationFileState(object):
+    offset = 0
+    anchor = b''
+    mtime = None
+    size = None
+
+    def __init__(self):
+        self.annotations = []
+        self.pending_annotations = []
+
 
 class AnnotationStorage(object):
     _annotations_dir = None
+    _reader = None
+
+    # name of an annotation file: <filename of the document>_A_<file hash of the document>.html
+    _annotation_file_regex = re.compile(r'^(.*)_A_([0-9a-f]{32})\.html$')
+
+    # beginning and end of a new annotation file
+    _file_header = b'<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>\n'
+    _file_footer = b'</body></html>\n'
+    # number of bytes at the end of an annotation file searched for its closing tags
+    FOOTER_SEARCH_SIZE = 256
+    # an entry is three lines: the position, the highlighted text (not read back) and the comment
+    _entry_template = u'<!-- type="32" level="1" position="%s" endposition="%s" --!>\n' \
+                      u'<font color="#000000" size="2" face="Arial"></font><br>\n' \
+                      u'<font color="#000000" size="3" face="Arial">%s</font><br>\n'
 
     def __init__(self, annotations_dir):
         super(AnnotationStorage, self).__init__()
 
         self._annotations_dir = annotations_dir
+        self._reader = IncrementalAnnotationReader()
+
+    @property
+    def reader(self):
+        return self._reader
 
     def get_annotation_file(self, document_file):
         assert isinstance(document_file, PocketbookAnnotatedDocument)
@@ -26,6 +180,112 @@ class AnnotationStorage(object):
 
         return "%s%s%s_A_%s.files" % (self._annotations_dir, os.sep, document_file.filename, document_file.file_hash)
 
+    def list_annotated_documents(self):
+        """List the documents that have an annotation file, without looking for the documents themselves.
+
+        :return: Filename of the document -> set of file hashes (see :py:attr:`PocketbookAnnotatedDocument.file_hash`)
+                 of the documents with that filename.
+        :rtype: dict
+        """
+        documents = {}
+        if not os.path.isdir(self._annotations_dir):
+            return documents
+
+        for entry in os.listdir(self._annotations_dir):
+            match = self._annotation_file_regex.match(entry)
+            if match is not None:
+                documents.setdefault(match.group(1), set()).add(match.group(2))
+
+        return documents
+
+    @property
+    def annotations_dir(self):
+        return self._annotations_dir
+
+    @classmethod
+    def format_entry(cls, annotation):
+        """Format an annotation as an entry of an annotation file.
+
+        :param PDFLocPair annotation: The annotation.
+        :return: The UTF-8 encoded entry.
+        :rtype: bytes
+        """
+        comment = annotation.comment
+        if isinstance(comment, bytes):
+            comment = comment.decode('utf-8')
+        # the comment has to stay on its line to be read back
+        comment = u" ".join((comment or u"").splitlines())
+        comment = comment.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+        return (cls._entry_template % (PocketbookDatabase._to_pdfloc(str(annotation.start)),
+                                       PocketbookDatabase._to_pdfloc(str(annotation.end)), comment)).encode('utf-8')
+
+    @staticmethod
+    def unescape_comment(comment):
+        """Return the comment of an entry as it was before :py:meth:`format_entry` (or the reader) escaped it.
+
+        :param basestring comment: The comment as stored in the annotation file (UTF-8 encoded if bytes).
+        :rtype: unicode
+        """
+        if isinstance(comment, bytes):
+            comment = comment.decode('utf-8', 'replace')
+        for entity, character in ((u"&lt;", u"<"), (u"&gt;", u">"), (u"&quot;", u'"'), (u"&#39;", u"'"),
+                                  (u"&amp;", u"&")):
+            comment = comment.replace(entity, character)
+        return comment
+
+    def write_entries(self, annotations_file, entries, fsync=True):
+        """Add the entries to the end of the annotation file with a single write.
+
+        A new file is written with the header and the closing tags. In an existing file the entries are inserted
+        before its closing tags (or appended if it has none), so only its end is rewritten, however large it is.
+
+        :param basestring annotations_file: Path to the annotation file (created if it doesn't exist).
+        :param entries: The entries created by :py:meth:`format_entry`.
+        :type entries: list of bytes
+        :param bool fsync: Whether to flush the file to the disk.
+        :return: True if the file was created.
+        :rtype: bool
+        """
+        try:
+            f = open(annotations_file, 'r+b')
+        except IOError:
+            f = None
+
+        if f is None:
+            with open(annotations_file, 'wb') as f:
+                f.write(self._file_header + b"".join(entries) + self._file_footer)
+                self._sync_file(f, fsync)
+            return True
+
+        with f:
+            f.seek(0, os.SEEK_END)
+            tail_offset = max(0, f.tell() - self.FOOTER_SEARCH_SIZE)
+            f.seek(tail_offset)
+            tail = f.read()
+
+            footer_start = tail.rfind(b"</body>")
+            if footer_start < 0 or b"".join(tail[footer_start:].split()) != self._file_footer.strip():
+                # no closing tags, the entries are simply appended
+                footer_start = len(tail)
+            footer = tail[footer_start:]
+
+            # the entries have to start on their own line to be read back
+            separator = b"\n" if footer_start > 0 and not tail[:footer_start].endswith(b"\n") else b""
+
+            f.seek(tail_offset + footer_start)
+            f.write(separator + b"".join(entries) + footer)
+            f.truncate()
+            self._sync_file(f, fsync)
+
+        return False
+
+    @staticmethod
+    def _sync_file(f, fsync):
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
 
 class PocketbookDocumentLibrary(DocumentLibrary):
 
@@ -45,7 +305,7 @@ class PocketbookDocumentLibrary(DocumentLibrary):
 
         self._annotation_storage = AnnotationStorage(self._annotations_dir)
 
-        self._document_roots.append(self._system_drive_path)
+        self._document_roots = [self._system_drive_path]
         if self._external_drive_path is not None:
             self._document_roots.append(self._external_drive_path)
 
@@ -63,6 +323,276 @@ class PocketbookDocumentLibrary(DocumentLibrary):
 
         self.add_documents(**documents)
 
+    def _get_drive_dir(self, folder):
+        """Return the local path of a folder recorded in the book database, or None if its drive isn't available.
+
+        :param basestring folder: The folder on the device (e.g. /mnt/ext1/Books).
+        :rtype: basestring
+        """
+        drive_paths = {
+            PocketbookDatabase.SYSTEM_DRIVE_MOUNT: self._system_drive_path,
+            PocketbookDatabase.EXTERNAL_DRIVE_MOUNT: self._external_drive_path,
+        }
+
+        for mount, drive_path in drive_paths.items():
+            if drive_path is not None and (folder == mount or folder.startswith(mount + "/")):
+                relative_parts = [part for part in folder[len(mount):].split("/") if len(part) > 0]
+                return os.path.join(drive_path.rstrip(os.sep), *relative_parts)
+
+        return None
+
+
+class PocketbookAnnotatedOnlyDocumentLibrary(PocketbookDocumentLibrary):
+    """
+    Pocketbook library containing only the documents that have annotation files in Active Contents.
+
+    The annotation files are listed first and the filenames and hashes of their documents are parsed from their names.
+    Each document is then looked for where it is expected: in the directory where it was found before (`known_dirs`)
+    and in the folders the reader's book database records for its filename. Only the documents not found there are
+    searched for by walking the drives, for files with those names (without creating documents for the other files),
+    and the walk stops as soon as all of them are found. The documents a walk doesn't find (e.g. the annotation files
+    of deleted documents) are not remembered, so a document that appears later is found by the next library.
+    """
+
+    _database = None
+    # (filename, file hash) -> directory of the document
+    _known_dirs = None
+
+    def __init__(self, system_drive_path, annotations_dir, external_drive_path=None, database=None, known_dirs=None):
+        """
+        :param PocketbookDatabase database: The book database, used only to find the documents (or None).
+        :param dict known_dirs: Directories of the documents found by the previous libraries, updated by this one.
+        """
+        self._database = database
+        self._known_dirs = known_dirs if known_dirs is not None else {}
+
+        super(PocketbookAnnotatedOnlyDocumentLibrary, self).__init__(system_drive_path, annotations_dir,
+                                                                     external_drive_path)
+
+    def _seek_for_documents(self):
+        wanted = self._annotation_storage.list_annotated_documents()
+        documents = OrderedDict()
+
+        for filename, dirpath in self._get_expected_locations(wanted):
+            if filename in wanted and os.path.isfile(os.path.join(dirpath, filename)):
+                self._add_if_wanted(filename, dirpath, wanted, documents)
+
+        for root in self._document_roots:
+            if len(wanted) == 0:
+                break
+
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    if filename in wanted:
+                        self._add_if_wanted(filename, dirpath, wanted, documents)
+
+                if len(wanted) == 0:
+                    break
+
+        if len(wanted) > 0:
+            log.debug("%i annotated documents were not found on the drives", sum(len(h) for h in wanted.values()))
+
+        self.add_documents(**documents)
+
+    def _get_expected_locations(self, wanted):
+        """Return tuples (filename, directory) of the places where the wanted documents are expected."""
+        locations = []
+        for filename, file_hashes in wanted.items():
+            for file_hash in file_hashes:
+                if (filename, file_hash) in self._known_dirs:
+                    locations.append((filename, self._known_dirs[(filename, file_hash)]))
+
+        if self._database is not None:
+            for _, folder, filename, _ in self._database.get_pdf_files():
+                if filename in wanted:
+                    dirpath = self._get_drive_dir(folder)
+                    if dirpath is not None:
+                        locations.append((filename, dirpath))
+
+        return locations
+
+    def _add_if_wanted(self, filename, dirpath, wanted, documents):
+        document = PocketbookAnnotatedDocument(filename, dirpath, self._annotation_storage)
+        if document.full_path in documents:
+            return
+
+        try:
+            file_hash = document.file_hash
+        except (IOError, OSError):
+            return
+
+        if file_hash in wanted[filename]:
+            documents[document.full_path] = document
+            self._known_dirs[(filename, file_hash)] = dirpath
+
+            wanted[filename].discard(file_hash)
+            if len(wanted[filename]) == 0:
+                del wanted[filename]
+
+
+class PocketbookSQLiteDocumentLibrary(PocketbookDocumentLibrary):
+    """
+    Pocketbook library whose documents are listed by the reader's book database instead of walking the drives.
+    """
+
+    _database = None
+
+    def __init__(self, system_drive_path, annotations_dir, database, external_drive_path=None):
+        assert isinstance(database, PocketbookDatabase)
+
+        self._database = database
+
+        super(PocketbookSQLiteDocumentLibrary, self).__init__(system_drive_path, annotations_dir, external_drive_path)
+
+    @property
+    def database(self):
+        return self._database
+
+    def _seek_for_documents(self):
+        documents = OrderedDict()
+
+        for book_id, folder, filename, filesize in self._database.get_pdf_files():
+            dirpath = self._get_drive_dir(folder)
+            if dirpath is None:
+                continue
+
+            document = PocketbookSQLiteAnnotatedDocument(filename, dirpath, self._annotation_storage, book_id,
+                                                         self._database, filesize)
+            documents[document.full_path] = document
+
+        self.add_documents(**documents)
+
+
+class PocketbookDatabase(object):
+    """
+    Reader of the SQLite database in which current Pocketbook firmware keeps its books and their annotations.
+
+    Annotations are stored as items whose parent is the book; the properties of each item are stored as tags.
+    """
+
+    # locations of the database relative to the system drive, in the order of preference
+    DATABASE_PATHS = (
+        ('system', 'config', 'books.db'),
+        ('system', 'explorer-3', 'explorer-3.db'),
+    )
+
+    # mount points of the drives as recorded in the database
+    SYSTEM_DRIVE_MOUNT = "/mnt/ext1"
+    EXTERNAL_DRIVE_MOUNT = "/mnt/ext2"
+
+    # state of items that were not deleted
+    ITEM_STATE_ACTIVE = 0
+
+    # names of the tags holding the highlight position, the highlighted text and the attached note
+    TAG_BOOKMARK = "bm.book_mark"
+    TAG_QUOTATION = "bm.quotation"
+    TAG_NOTE = "bm.note"
+
+    _path = None
+    _connection = None
+
+    def __init__(self, path):
+        super(PocketbookDatabase, self).__init__()
+
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA query_only=1")
+
+    @staticmethod
+    def find(system_drive_path):
+        """Find the book database on the given system drive.
+
+        :param basestring system_drive_path: Path to the root of the system drive of the reader.
+        :return: Path to the database, or None if the reader doesn't keep one (or it has an unknown format).
+        :rtype: basestring
+        """
+        for parts in PocketbookDatabase.DATABASE_PATHS:
+            path = os.path.join(system_drive_path, *parts)
+            if not os.path.isfile(path):
+                continue
+
+            try:
+                connection = sqlite3.connect(path)
+                try:
+                    tables = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master "
+                                                                      "WHERE type='table'"))
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                continue
+
+            if {'files', 'folders', 'items', 'tags', 'tagnames'}.issubset(tables):
+                return path
+
+        return None
+
+    def get_pdf_files(self):
+        """Return all PDF files known to the reader.
+
+        :return: Tuples (book id, folder on the device, filename, file size).
+        :rtype: list of tuple
+        """
+        return self._connection.execute(
+            "SELECT f.book_id,fo.name,f.filename,f.size "
+            "FROM files f JOIN folders fo ON f.folder_id=fo.id "
+            "WHERE f.filename LIKE '%.pdf'").fetchall()
+
+    def get_annotations_version(self, book_id):
+        """Return a token that changes whenever the annotations of the given book change.
+
+        :param int book_id: Id of the book.
+        :rtype: tuple
+        """
+        return tuple(self._connection.execute(
+            "SELECT COUNT(*),MAX(t.timeedt) FROM items i JOIN tags t ON t.itemid=i.id "
+            "WHERE i.parentid=? AND i.state=?", (book_id, self.ITEM_STATE_ACTIVE)).fetchone())
+
+    def get_highlights(self, book_id):
+        """Return the highlights of the given book.
+
+        :param int book_id: Id of the book.
+        :return: Tuples (start pdfloc, end pdfloc, highlighted text, note) in the order they were created; the text
+                 and the note are None if missing.
+        :rtype: list of tuple
+        """
+        rows = self._connection.execute(
+            "SELECT i.id,tn.name,t.val FROM items i JOIN tags t ON t.itemid=i.id JOIN tagnames tn ON tn.id=t.tagid "
+            "WHERE i.parentid=? AND i.state=? AND tn.name IN (?,?,?) ORDER BY i.id",
+            (book_id, self.ITEM_STATE_ACTIVE, self.TAG_BOOKMARK, self.TAG_QUOTATION, self.TAG_NOTE)).fetchall()
+
+        items = OrderedDict()
+        for item_id, tag_name, value in rows:
+            if item_id not in items:
+                items[item_id] = {}
+            items[item_id][tag_name] = value
+
+        highlights = []
+        for tags in items.values():
+            try:
+                position = json.loads(tags.get(self.TAG_BOOKMARK) or "{}")
+            except ValueError:
+                continue
+
+            start = position.get("begin")
+            end = position.get("end")
+            # bookmarks only have an anchor
+            if not start or not end:
+                continue
+
+            highlights.append((self._to_pdfloc(start), self._to_pdfloc(end),
+                               tags.get(self.TAG_QUOTATION) or None, tags.get(self.TAG_NOTE) or None))
+
+        return highlights
+
+    @staticmethod
+    def _to_pdfloc(position):
+        # the annotation files prefix the positions with a hash, the database doesn't
+        return position if position.startswith("#") else "#" + position
+
+    @property
+    def path(self):
+        return self._path
+
 
 class PocketbookAnnotatedDocument(AnnotatedDocument):
 
@@ -74,11 +604,12 @@ class PocketbookAnnotatedDocument(AnnotatedDocument):
     _pdfloc_regex = r'<!-- type="32" level="1" position="(#pdfloc\([^)]+\))" endposition="(#pdfloc\([^)]+\))" --!>'
     _pdfloc_comment_regex = r'<font color="#000000" size="3" face="Arial">(.*)</font><br>'
 
-    def __init__(self, document_file, document_dir, annotation_storage):
+    def __init__(self, document_file, document_dir, annotation_storage, filesize=None):
         assert isinstance(annotation_storage, AnnotationStorage)
 
         full_path = document_dir + os.sep + document_file
-        filesize = os.path.getsize(full_path)
+        if filesize is None:
+            filesize = os.path.getsize(full_path)
 
         super(PocketbookAnnotatedDocument, self).__init__(full_path, filesize)
 
@@ -89,6 +620,10 @@ class PocketbookAnnotatedDocument(AnnotatedDocument):
     def dir(self):
         return self._dir
 
+    @property
+    def annotation_storage(self):
+        return self._annotation_storage
+
     @property
     def file_hash(self):
         if self._file_hash is None:
@@ -108,36 +643,53 @@ class PocketbookAnnotatedDocument(AnnotatedDocument):
                 h.update("%i" % size)
 
             self._file_hash = h.hexdigest()
-            self._filehashes['md5pb'] = self._file_hash
+            self._set_filehash('md5pb', self._file_hash)
 
         return self._file_hash
 
-    def get_annotations(self):
+    def get_annotations_version(self):
+        try:
+            stat = os.stat(self._annotation_storage.get_annotation_file(self))
+        except OSError:
+            # not annotated yet
+            return ()
+
+        return stat.st_mtime, stat.st_size
+
+    def _load_annotations(self):
         annotations_file = self._annotation_storage.get_annotation_file(self)
 
-        annotations = []
+        annotations = self._annotation_storage.reader.read(annotations_file)
+
+        return PocketbookAnnotationSet(self, annotations)
+
+
+class PocketbookSQLiteAnnotatedDocument(PocketbookAnnotatedDocument):
+    """
+    Pocketbook document whose annotations are read from the reader's book database.
+    """
 
-        with open(annotations_file, 'r') as f:
-            line = f.readline()
-            while len(line) > 0:
-                match = re.match(self._pdfloc_regex, line)
-                if match is not None:
-                    start = match.group(1)
-                    end = match.group(2)
-                    comment = None
+    _book_id = None
+    _database = None
 
-                    # the comment is stored two lines further
-                    line = f.readline()
-                    if len(line) > 0:
-                        line = f.readline()
-                        if len(line) > 0:
-                            comment_match = re.match(self._pdfloc_comment_regex, line)
-                            if comment_match is not None:
-                                comment = comment_match.group(1)
+    def __init__(self, document_file, document_dir, annotation_storage, book_id, database, filesize=None):
+        super(PocketbookSQLiteAnnotatedDocument, self).__init__(document_file, document_dir, annotation_storage,
+                                                                filesize)
 
-                    annotations.append(PDFLocPair(start, end, comment))
+        self._book_id = book_id
+        self._database = database
+
+    @property
+    def book_id(self):
+        return self._book_id
 
-                line = f.readline()
+    def get_annotations_version(self):
+        return self._database.get_annotations_version(self._book_id)
+
+    def _load_annotations(self):
+        # the note is the comment (as in the annotation files), the highlighted text is kept separately
+        annotations = [set_annotation_text(PDFLocPair(start, end, note), text) for (start, end, text, note)
+                       in self._database.get_highlights(self._book_id)]
 
         return PocketbookAnnotationSet(self, annotations)
 
@@ -159,48 +711,216 @@ class PocketbookAnnotationImporter(AnnotationImporter):
     _external_drive_path = None
     _annotations_dir = None
 
-    _library = None
+    # all PDF files on the drives are documents of the library
+    DISCOVERY_ALL_DOCUMENTS = "all"
+    # only the documents with annotation files are looked for (see PocketbookAnnotatedOnlyDocumentLibrary)
+    DISCOVERY_ANNOTATED_DOCUMENTS = "annotated"
 
-    def __init__(self, system_drive_path, annotations_dir, external_drive_path=None):
+    _use_database = True
+    _discovery_mode = DISCOVERY_ALL_DOCUMENTS
+
+    _library = None
+    # where the libraries of DISCOVERY_ANNOTATED_DOCUMENTS found the documents
+    _known_dirs = None
+
+    def __init__(self, system_drive_path, annotations_dir, external_drive_path=None, use_database=True,
+                 discovery_mode=None):
+        """
+        :param basestring system_drive_path: Path to the root of the system drive of the reader.
+        :param basestring annotations_dir: Path to the Active Contents directory.
+        :param basestring external_drive_path: Path to the root of the external drive (SD card), if any.
+        :param bool use_database: If True and the reader keeps a book database, read the documents and annotations
+                                  from it instead of walking the drives and parsing the annotation files.
+        :param basestring discovery_mode: How the documents are found when the drives are searched (not the database),
+                                          one of the DISCOVERY_* constants. Defaults to DISCOVERY_ALL_DOCUMENTS.
+        """
         super(PocketbookAnnotationImporter, self).__init__()
 
         self._system_drive_path = system_drive_path
         self._external_drive_path = external_drive_path
         self._annotations_dir = annotations_dir
+        self._use_database = use_database
+        if discovery_mode is not None:
+            self._discovery_mode = discovery_mode
+        self._known_dirs = {}
 
-    def get_annotated_library(self):
+    def get_annotated_library(self, candidates=None):
         if self._library is None:
-            self._library = PocketbookDocumentLibrary(self._system_drive_path, self._annotations_dir,
-                                                      self._external_drive_path)
+            database_path = PocketbookDatabase.find(self._system_drive_path) if self._use_database else None
+
+            if database_path is not None:
+                self._library = PocketbookSQLiteDocumentLibrary(self._system_drive_path, self._annotations_dir,
+                                                                PocketbookDatabase(database_path),
+                                                                self._external_drive_path)
+            elif self._discovery_mode == self.DISCOVERY_ANNOTATED_DOCUMENTS:
+                # even if its annotations are not used, the database knows where the documents are
+                if not self._use_database:
+                    database_path = PocketbookDatabase.find(self._system_drive_path)
+                self._library = PocketbookAnnotatedOnlyDocumentLibrary(
+                    self._system_drive_path, self._annotations_dir, self._external_drive_path,
+                    PocketbookDatabase(database_path) if database_path is not None else None, self._known_dirs)
+            else:
+                self._library = PocketbookDocumentLibrary(self._system_drive_path, self._annotations_dir,
+                                                          self._external_drive_path)
 
         return self._library
 
+    def get_watched_paths(self):
+        paths = [self._annotations_dir]
+
+        library = self.get_annotated_library()
+        if isinstance(library, PocketbookSQLiteDocumentLibrary):
+            paths.append(library.database.path)
+
+        return paths
+
+    def notify_changed(self, paths):
+        # a new annotation file means a new document of the library; finding it again is cheap, as the directories of
+        # the other documents are known
+        if self._annotations_dir in paths and isinstance(self._library, PocketbookAnnotatedOnlyDocumentLibrary):
+            self._library = None
+
+
+class PocketbookExporter(AnnotationExporter):
+    """
+    Exporter appending the annotations to the annotation files in Active Contents.
+
+    The reader is typically mounted as slow USB mass storage, so the annotations are only buffered by
+    :py:meth:`add_annotations_to_document` and grouped by their annotation files. :py:meth:`flush` then writes every
+    annotation file once (see :py:meth:`AnnotationStorage.write_entries`), with a single fsync per file and one per
+    directory with new files, however many documents and annotations were exported to it.
+
+    Documents of readers keeping their annotations in the book database are skipped (and their annotations are not
+    counted as exported), as the reader doesn't read the annotation files then and the database is never written.
+    """
+
+    _annotations_dir = None
+    _fsync = True
+
+    # annotation file -> (AnnotationStorage, list of entries)
+    _pending = None
+
+    def __init__(self, annotations_dir, fsync=True):
+        """
+        :param basestring annotations_dir: Path to the Active Contents directory.
+        :param bool fsync: Whether to flush the written files to the disk.
+        """
+        super(PocketbookExporter, self).__init__()
+
+        self._annotations_dir = annotations_dir
+        self._fsync = fsync
+        self._pending = OrderedDict()
+
+    def export_library(self, library):
+        pass
+
+    def add_annotations_to_document(self, document, annotations):
+        assert isinstance(document, PocketbookAnnotatedDocument)
+
+        if isinstance(document, PocketbookSQLiteAnnotatedDocument):
+            log.warning("Not exporting %i annotations to %s, the reader keeps its annotations in its book database",
+                        len(annotations), document.full_path)
+            return 0
+
+        bbox_annotations = [annotation for annotation in annotations if hasattr(annotation, 'bboxes')]
+        pdfloc_annotations = [annotation for annotation in annotations if not hasattr(annotation, 'bboxes')]
+        if len(bbox_annotations) > 0:
+            pdfloc_annotations.extend(convert_bboxes_to_pdflocs(document, bbox_annotations))
+
+        storage = document.annotation_storage
+        annotations_file = storage.get_annotation_file(document)
+        if annotations_file not in self._pending:
+            self._pending[annotations_file] = (storage, [])
+        self._pending[annotations_file][1].extend(storage.format_entry(annotation)
+                                                  for annotation in pdfloc_annotations)
+
+        return len(pdfloc_annotations)
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+
+        pending = self._pending
+        self._pending = OrderedDict()
+
+        directories = set()
+        for annotations_file, (storage, entries) in pending.items():
+            directory = os.path.dirname(annotations_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            if storage.write_entries(annotations_file, entries, self._fsync):
+                directories.add(directory)
+
+        if self._fsync and os.name != 'nt':
+            # make the new files durable
+            for directory in directories:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        log.info("Wrote %i annotation files", len(pending))
+
+    @property
+    def annotations_dir(self):
+        return self._annotations_dir
+
+
+def _parse_location(location):
+    """Parse a source/destination u"pocketbook" + os.pathsep + system drive [+ os.pathsep + external drive].
+
+    :return: Tuple (system drive path, external drive path or None, Active Contents path), or None if the location
+             isn't a Pocketbook location or the system drive doesn't exist.
+    :rtype: tuple
+    """
+    if not isinstance(location, str) and not isinstance(location, unicode):
+        return None
+
+    location_parts = location.split(os.pathsep)
+    if not (2 <= len(location_parts) <= 3):
+        return None
+
+    if location_parts[0] != "pocketbook":
+        return None
+
+    system_path = location_parts[1]
+    external_path = location_parts[2] if len(location_parts) == 3 else None
+
+    if not os.path.exists(system_path):
+        return None
+
+    if external_path is not None and not os.path.exists(external_path):
+        # not a critical problem if external storage is defined but not found
+        external_path = None
+
+    return system_path, external_path, os.path.join(system_path, 'system', 'config', 'Active Contents')
+
 
 class PocketbookImporterFactory(AnnotationImporterFactory):
 
-    def get_importer_for_source(self, source):
-        if not isinstance(source, str) and not isinstance(source, unicode):
-            return None
+    # the discovery mode of the importers created by this factory
+    discovery_mode = None
 
-        source_parts = source.split(os.pathsep)
-        if not (2 <= len(source_parts) <= 3):
+    def get_importer_for_source(self, source):
+        location = _parse_location(source)
+        if location is None:
             return None
 
-        if source_parts[0] != "pocketbook":
+        system_path, external_path, annotations_dir = location
+        if not os.path.exists(annotations_dir) and PocketbookDatabase.find(system_path) is None:
             return None
 
-        system_path = source_parts[1]
-        external_path = source_parts[2] if len(source_parts) == 3 else None
+        return PocketbookAnnotationImporter(system_path, annotations_dir, external_path,
+                                            discovery_mode=self.discovery_mode)
 
-        if not os.path.exists(system_path):
-            return None
 
-        if external_path is not None and not os.path.exists(external_path):
-            # not a critical problem if external storage is defined but not found
-            external_path = None
+class PocketbookExporterFactory(AnnotationExporterFactory):
 
-        annotations_dir = os.path.join(system_path, 'system', 'config', 'Active Contents')
-        if not os.path.exists(annotations_dir):
+    def get_exporter_for_destination(self, destination):
+        location = _parse_location(destination)
+        if location is None:
             return None
 
-        return PocketbookAnnotationImporter(system_path, annotations_dir, external_path)
+        return PocketbookExporter(location[2])
@@ -0,0 +1,57 @@
+import os
+
+from annotation_manager.importer import AnnotationImporterFactory, AnnotationImporter
+from annotation_manager.snapshot import SnapshotDocumentLibrary, MAGIC
+
+
+class SnapshotAnnotationImporter(AnnotationImporter):
+
+    _snapshot_path = None
+
+    _library = None
+
+    def __init__(self, snapshot_path):
+        super(SnapshotAnnotationImporter, self).__init__()
+
+        self._snapshot_path = snapshot_path
+
+    def get_annotated_library(self, candidates=None):
+        if self._library is None:
+            self._library = SnapshotDocumentLibrary(self._snapshot_path)
+
+        return self._library
+
+    def get_watched_paths(self):
+        return [self._snapshot_path]
+
+    def notify_changed(self, paths):
+        # snapshots are replaced as a whole when they are refreshed
+        if len(paths) > 0 and self._library is not None:
+            self._library.snapshot.close()
+            self._library = None
+
+
+class SnapshotImporterFactory(AnnotationImporterFactory):
+    """
+    Factory for importers of library snapshots written by :py:func:`annotation_manager.snapshot.write_snapshot`.
+
+    The source is specified as u"snapshot" + os.pathsep + path_to_the_snapshot_file.
+    """
+
+    def get_importer_for_source(self, source):
+        if not isinstance(source, str) and not isinstance(source, unicode):
+            return None
+
+        source_parts = source.split(os.pathsep, 1)
+        if len(source_parts) != 2 or source_parts[0] != "snapshot":
+            return None
+
+        snapshot_path = source_parts[1]
+        if not os.path.isfile(snapshot_path):
+            return None
+
+        with open(snapshot_path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(MAGIC)) != MAGIC:
+                return None
+
+        return SnapshotAnnotationImporter(snapshot_path)
@@ -7,41 +7,110 @@ import os
 import hashlib
 
 
-def reversed_lines(file_or_path, encoding='utf-8'):
+def reversed_lines(file_or_path, encoding='utf-8', stop_offset=0):
     """Generate the lines of file in reverse order.
 
-    :param file_or_path: Either
+    The file is read from its end in binary blocks which are split into lines by searching for the newline bytes, so
+    the cost is linear in the number of bytes read regardless of the line lengths.
+
+    :param file_or_path: Either a file opened in binary mode, or a path to the file.
     :type file_or_path: file | basestring
-    :param str encoding: Encoding of the strings read from the file.
+    :param str encoding: Encoding of the strings read from the file. If None, the lines are returned as bytes.
+    :param int stop_offset: Byte offset where reading stops. It should point to the beginning of a line.
 
-    :return: Lines from the file in reversed order.
+    :return: Lines from the file in reversed order (including their line endings).
     :rtype: list of unicode
     """
-    part = ''
-    with io.open(file_or_path, encoding=encoding) as file:
-        for block in reversed_blocks(file):
-            for c in reversed(block):
-                if c == '\n' and part:
-                    yield part[::-1]
-                    part = ''
-                part += c
-        if part:
-            yield part[::-1]
-
-
-def reversed_blocks(file, blocksize=io.DEFAULT_BUFFER_SIZE):
+    for _, line in reversed_lines_with_offsets(file_or_path, stop_offset):
+        yield line.decode(encoding) if encoding is not None else line
+
+
+def reversed_lines_with_offsets(file_or_path, stop_offset=0, blocksize=io.DEFAULT_BUFFER_SIZE):
+    """Generate the lines of file in reverse order together with the byte offsets at which they start.
+
+    :param file_or_path: Either a file opened in binary mode, or a path to the file.
+    :type file_or_path: file | basestring
+    :param int stop_offset: Byte offset where reading stops. It should point to the beginning of a line.
+    :param int blocksize: Size of the reading buffer.
+
+    :return: Tuples (offset, line) in reversed order; the lines are bytes including their line endings.
+    :rtype: list of tuple
+    """
+    if isinstance(file_or_path, basestring):
+        with io.open(file_or_path, 'rb') as file:
+            for offset_and_line in reversed_lines_with_offsets(file, stop_offset, blocksize):
+                yield offset_and_line
+        return
+
+    # parts of the line being assembled, from its end towards its beginning
+    pending = []
+
+    file_or_path.seek(0, os.SEEK_END)
+    block_offset = file_or_path.tell()
+
+    for block in reversed_blocks(file_or_path, blocksize, stop_offset):
+        block_offset -= len(block)
+
+        search_end = segment_end = len(block)
+        while True:
+            newline = block.rfind(b'\n', 0, search_end)
+            if newline < 0:
+                break
+
+            part = block[newline + 1:segment_end]
+            if len(part) > 0 or len(pending) > 0:
+                pending.append(part)
+                yield block_offset + newline + 1, b''.join(reversed(pending))
+                pending = []
+
+            # the newline is the last byte of the preceding line
+            segment_end = newline + 1
+            search_end = newline
+
+        pending.append(block[:segment_end])
+
+    line = b''.join(reversed(pending))
+    if len(line) > 0:
+        yield block_offset, line
+
+
+def tail_lines(file_or_path, start_offset=0, count=None):
+    """Return the lines of file starting at the given offset, in their natural order.
+
+    Only the part of the file after start_offset is read, so this is cheap for reading data appended to a file.
+
+    :param file_or_path: Either a file opened in binary mode, or a path to the file.
+    :type file_or_path: file | basestring
+    :param int start_offset: Byte offset of the first line to return.
+    :param int count: If not None, only return this number of the last lines.
+
+    :return: Tuples (offset, line); the lines are bytes including their line endings.
+    :rtype: list of tuple
+    """
+    lines = []
+    for offset_and_line in reversed_lines_with_offsets(file_or_path, start_offset):
+        if count is not None and len(lines) >= count:
+            break
+        lines.append(offset_and_line)
+
+    lines.reverse()
+    return lines
+
+
+def reversed_blocks(file, blocksize=io.DEFAULT_BUFFER_SIZE, stop_offset=0):
     """Generate blocks of file's contents in reverse order.
 
-    :param io.TextIOBase file: The file to read blocks from.
+    :param file file: The file to read blocks from (opened in binary mode).
     :param int blocksize: Size of the reading buffer.
+    :param int stop_offset: Byte offset where reading stops.
 
-    :return: Blocks of size blocksize.
-    :rtype: list of unicode
+    :return: Blocks of size blocksize (the last one may be shorter).
+    :rtype: list of bytes
     """
     file.seek(0, os.SEEK_END)
     here = file.tell()
-    while 0 < here:
-        delta = min(blocksize, here)
+    while stop_offset < here:
+        delta = min(blocksize, here - stop_offset)
         here -= delta
         file.seek(here, os.SEEK_SET)
         yield file.read(delta)
@@ -0,0 +1,279 @@
+"""
+Structured progress events of syncs, with throughput and ETA estimates and a watchdog for slow documents.
+
+Events are delivered to callbacks subscribed to a :py:class:`ProgressReporter` (in the thread that emitted them) or
+can be consumed as a generator from another thread through :py:meth:`ProgressReporter.events`.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+
+class ProgressEvent(object):
+    """
+    A single progress event.
+    """
+
+    SYNC_STARTED = "sync_started"
+    SYNC_FINISHED = "sync_finished"
+    DOCUMENT_DISCOVERED = "document_discovered"
+    DOCUMENT_MATCHED = "document_matched"
+    DOCUMENT_STARTED = "document_started"
+    DOCUMENT_FINISHED = "document_finished"
+    # a document has been processed for longer than the timeout of the watchdog
+    DOCUMENT_SLOW = "document_slow"
+    CONVERSION_STARTED = "conversion_started"
+    CONVERSION_FINISHED = "conversion_finished"
+    ANNOTATIONS_EXPORTED = "annotations_exported"
+    ERROR = "error"
+
+    def __init__(self, kind, document=None, count=None, duration=None, error=None, details=None):
+        """
+        :param basestring kind: One of the event kind constants of this class.
+        :param AnnotatedDocument document: The document the event concerns, if any.
+        :param int count: Number of annotations (for conversions and exports) or documents (for discovery).
+        :param float duration: Duration of the finished operation in seconds.
+        :param basestring error: Description of the error.
+        :param details: Any additional information (e.g. the source and destination of a sync).
+        """
+        super(ProgressEvent, self).__init__()
+
+        self.kind = kind
+        self.document = document
+        self.count = count
+        self.duration = duration
+        self.error = error
+        self.details = details
+        self.timestamp = time.time()
+
+        # aggregates of the running sync, filled in by the reporter
+        self.documents_done = 0
+        self.documents_total = 0
+        self.throughput = None
+        self.eta = None
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        parts = [self.kind]
+        if self.document is not None:
+            parts.append(self.document.full_path)
+        if self.count is not None:
+            parts.append("count=%i" % self.count)
+        if self.duration is not None:
+            parts.append("duration=%.2fs" % self.duration)
+        if self.error is not None:
+            parts.append("error=%s" % self.error)
+        if self.details is not None:
+            parts.append(unicode(self.details))
+        parts.append("[%i/%i" % (self.documents_done, self.documents_total))
+        if self.throughput is not None:
+            parts.append("%.2f docs/s" % self.throughput)
+        if self.eta is not None:
+            parts.append("ETA %.0fs" % self.eta)
+        return u" ".join(parts) + u"]"
+
+
+class ThroughputTracker(object):
+    """
+    Rolling throughput of finished documents over a time window.
+    """
+
+    def __init__(self, window=60.0):
+        """
+        :param float window: Length of the window in seconds.
+        """
+        super(ThroughputTracker, self).__init__()
+
+        self._window = window
+        self._finished = collections.deque()
+        self._started_at = None
+
+    def reset(self):
+        self._finished.clear()
+        self._started_at = time.time()
+
+    def add(self, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        self._finished.append(timestamp)
+        self._expire(timestamp)
+
+    def rate(self, now=None):
+        """Return the number of documents finished per second in the window, or None if unknown yet."""
+        now = now if now is not None else time.time()
+        self._expire(now)
+
+        if self._started_at is None or len(self._finished) == 0:
+            return None
+
+        span = min(self._window, now - self._started_at)
+        return len(self._finished) / span if span > 0 else None
+
+    def eta(self, remaining, now=None):
+        """Return the estimated time (in seconds) to finish the remaining documents, or None if unknown."""
+        rate = self.rate(now)
+        if rate is None or rate == 0:
+            return None
+        return remaining / rate
+
+    def _expire(self, now):
+        while len(self._finished) > 0 and self._finished[0] < now - self._window:
+            self._finished.popleft()
+
+
+class ProgressReporter(object):
+    """
+    Publisher of the progress events of syncs.
+
+    It keeps the counts of matched and finished documents of the running sync and fills them, together with the
+    throughput and ETA, into every event. If `slow_document_timeout` is set, a watchdog thread emits a
+    DOCUMENT_SLOW event for each document processed longer than the timeout.
+    """
+
+    def __init__(self, slow_document_timeout=None, throughput_window=60.0):
+        """
+        :param float slow_document_timeout: Time in seconds after which a document is reported as slow (None to
+                                            disable the watchdog).
+        :param float throughput_window: Length of the window of the rolling throughput in seconds.
+        """
+        super(ProgressReporter, self).__init__()
+
+        self._callbacks = []
+        self._lock = threading.RLock()
+        self._throughput = ThroughputTracker(throughput_window)
+
+        self._documents_done = 0
+        self._documents_total = 0
+        # ids of the documents being processed -> [document, start time, whether it was already reported as slow]
+        self._active = {}
+
+        self._slow_document_timeout = slow_document_timeout
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+
+    def subscribe(self, callback):
+        """Register a callable called with every :py:class:`ProgressEvent`.
+
+        Exceptions raised by the callback are logged and otherwise ignored.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def events(self, timeout=None):
+        """Generate the events emitted from now on (typically by a sync running in another thread).
+
+        The generator stops after the SYNC_FINISHED event, or after no event came for `timeout` seconds.
+
+        :param float timeout: Maximum time to wait for the next event (None to wait indefinitely).
+        :rtype: generator of ProgressEvent
+        """
+        events = queue.Queue()
+        # subscribe right away, not when the generator is first advanced, so that no event is missed
+        self.subscribe(events.put)
+        return self._generate_events(events, timeout)
+
+    def _generate_events(self, events, timeout):
+        try:
+            while True:
+                try:
+                    # waiting with a timeout keeps the wait interruptible
+                    event = events.get(timeout=timeout if timeout is not None else 3600 * 24 * 365)
+                except queue.Empty:
+                    return
+                yield event
+                if event.kind == ProgressEvent.SYNC_FINISHED:
+                    return
+        finally:
+            self.unsubscribe(events.put)
+
+    def emit(self, kind, document=None, **fields):
+        """Emit an event (see :py:class:`ProgressEvent` for the fields)."""
+        with self._lock:
+            event = ProgressEvent(kind, document, **fields)
+
+            if kind == ProgressEvent.SYNC_STARTED:
+                self._documents_done = 0
+                self._documents_total = 0
+                self._active.clear()
+                self._throughput.reset()
+            elif kind == ProgressEvent.DOCUMENT_MATCHED:
+                self._documents_total += 1
+            elif kind == ProgressEvent.DOCUMENT_STARTED:
+                self._active[id(document)] = [document, event.timestamp, False]
+                self._start_watchdog()
+            elif kind == ProgressEvent.DOCUMENT_FINISHED:
+                self._active.pop(id(document), None)
+                self._documents_done += 1
+                self._throughput.add(event.timestamp)
+
+            event.documents_done = self._documents_done
+            event.documents_total = self._documents_total
+            event.throughput = self._throughput.rate(event.timestamp)
+            event.eta = self._throughput.eta(max(self._documents_total - self._documents_done, 0), event.timestamp)
+
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                log.exception("Progress callback failed")
+
+        return event
+
+    # listener interface of the conversion functions (see add_conversion_listener)
+
+    def conversion_started(self, document, count, to_bboxes):
+        self.emit(ProgressEvent.CONVERSION_STARTED, document, count=count,
+                  details="to bboxes" if to_bboxes else "to pdflocs")
+
+    def conversion_finished(self, document, count, to_bboxes, duration):
+        self.emit(ProgressEvent.CONVERSION_FINISHED, document, count=count, duration=duration,
+                  details="to bboxes" if to_bboxes else "to pdflocs")
+
+    def close(self):
+        """Stop the watchdog."""
+        self._watchdog_stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _start_watchdog(self):
+        if self._slow_document_timeout is None or self._watchdog is not None:
+            return
+
+        self._watchdog_stop.clear()
+        self._watchdog = threading.Thread(target=self._watch_slow_documents, name="progress-watchdog")
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _watch_slow_documents(self):
+        check_interval = min(self._slow_document_timeout / 4.0, 1.0)
+
+        while not self._watchdog_stop.wait(check_interval):
+            now = time.time()
+            with self._lock:
+                slow = []
+                for state in self._active.values():
+                    if not state[2] and now - state[1] > self._slow_document_timeout:
+                        state[2] = True
+                        slow.append((state[0], now - state[1]))
+
+            for document, duration in slow:
+                log.warning("%s is being processed for %.1f s", document.full_path, duration)
+                self.emit(ProgressEvent.DOCUMENT_SLOW, document, duration=duration)
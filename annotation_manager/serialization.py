@@ -0,0 +1,81 @@
+"""
+Conversion of annotations and documents to and from JSON-compatible dicts.
+"""
+
+from annotation_manager.common_representation import set_annotation_text
+from pdfloc_converter.pdfloc import BoundingBoxOnPage, PDFLocBoundingBoxes, PDFLocPair
+
+
+def annotation_to_dict(annotation):
+    """Convert an annotation to a JSON-compatible dict.
+
+    :param annotation: The annotation.
+    :type annotation: PDFLocBoundingBoxes|PDFLocPair
+    :rtype: dict
+    """
+    if isinstance(annotation, PDFLocBoundingBoxes):
+        data = {
+            'type': 'bboxes',
+            'page': annotation.page,
+            'comment': getattr(annotation, 'comment', None),
+            'bboxes': [{'page': bbox.page, 'bbox': list(bbox.bbox)} for bbox in annotation.bboxes],
+        }
+    elif isinstance(annotation, PDFLocPair):
+        data = {
+            'type': 'pdfloc',
+            'start': str(annotation.start),
+            'end': str(annotation.end),
+            'comment': annotation.comment,
+        }
+    else:
+        raise TypeError("Unsupported annotation type %s" % type(annotation))
+
+    if getattr(annotation, 'text', None) is not None:
+        data['text'] = annotation.text
+
+    return data
+
+
+def annotation_from_dict(data):
+    """Convert a dict created by :py:func:`annotation_to_dict` back to the annotation.
+
+    :param dict data: The dict.
+    :rtype: PDFLocBoundingBoxes|PDFLocPair
+    """
+    if data['type'] == 'bboxes':
+        bboxes = [BoundingBoxOnPage(tuple(bbox['bbox']), bbox['page']) for bbox in data['bboxes']]
+        annotation = PDFLocBoundingBoxes(bboxes, data['page'], data.get('comment'))
+    elif data['type'] == 'pdfloc':
+        annotation = PDFLocPair(data['start'], data['end'], data.get('comment'))
+    else:
+        raise ValueError("Unsupported annotation type %s" % data['type'])
+
+    if data.get('text') is not None:
+        set_annotation_text(annotation, data['text'])
+
+    return annotation
+
+
+def annotation_set_to_dict(annotations):
+    """Convert both forms of the annotations of an :py:class:`AnnotationSet` to a JSON-compatible dict.
+
+    :rtype: dict
+    """
+    return {
+        'bbox_annotations': [annotation_to_dict(annotation) for annotation in annotations.bbox_annotations],
+        'pdfloc_annotations': [annotation_to_dict(annotation) for annotation in annotations.pdfloc_annotations],
+    }
+
+
+def document_to_dict(document):
+    """Describe a document by a JSON-compatible dict (without its annotations).
+
+    :param AnnotatedDocument document: The document.
+    :rtype: dict
+    """
+    return {
+        'path': document.full_path,
+        'size': document.filesize,
+        'hashes': dict((hash_method, hash) for (hash_method, hash) in document._filehashes.items() if hash is not None),
+        'version': repr(document.get_annotations_version()),
+    }
@@ -0,0 +1,283 @@
+"""
+Server keeping imported libraries resident and answering queries about them over a Unix domain socket.
+
+The protocol is line-based JSON: every request is a single line with an object ``{"method": ..., "params": {...}}``
+and is answered by a single line with either ``{"result": ...}`` or ``{"error": ...}``. Every connection carries a
+single request, after whose answer the server closes it. Requests are served one at a time, so the libraries (and
+their database connections) are only ever used from the serving thread; a client that connects without sending its
+request holds the others up for at most :py:attr:`LibraryServer.request_timeout`.
+
+Before a library is used, the server checks whether the paths watched by its importer (see
+:py:meth:`AnnotationImporter.get_watched_paths`) changed since the previous request, and notifies the importer, so
+that the answers reflect the current files.
+"""
+
+import json
+import logging
+import os
+import socket
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from annotation_manager.serialization import annotation_from_dict, annotation_set_to_dict, document_to_dict
+from annotation_manager.watcher import create_watcher
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = os.path.join(os.environ["HOME"], ".annotation_manager", "server.sock")
+
+
+class LibraryServer(socketserver.UnixStreamServer):
+    """
+    Unix socket server answering queries about the libraries of an :py:class:`AnnotationManager`.
+
+    The libraries are imported on their first use and kept (with their indexes and annotation caches) until their
+    files change or the server stops.
+    """
+
+    # how long (in seconds) a connection may take to send its request
+    request_timeout = 10.0
+
+    def __init__(self, manager, socket_path=DEFAULT_SOCKET_PATH):
+        """
+        :param AnnotationManager manager: The manager importing the libraries and running the syncs.
+        :param basestring socket_path: Path to the socket.
+        """
+        self.manager = manager
+        self.socket_path = socket_path
+        self._stopping = False
+        # source -> (its importer, watcher of the paths watched by the importer)
+        self._watchers = {}
+
+        directory = os.path.dirname(socket_path)
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+        _remove_stale_socket(socket_path)
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+    def serve(self):
+        """Serve the requests until the shutdown method is called."""
+        log.info("Serving on %s", self.socket_path)
+        try:
+            while not self._stopping:
+                self.handle_request()
+        finally:
+            for _, watcher in self._watchers.values():
+                watcher.close()
+            self._watchers.clear()
+
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def dispatch(self, method, params):
+        handler = getattr(self, "_method_" + method, None) if isinstance(method, basestring) else None
+        if handler is None:
+            raise ValueError("Unknown method %s" % method)
+        return handler(**params)
+
+    def _method_ping(self):
+        return "pong"
+
+    def _method_shutdown(self):
+        self._stopping = True
+        return True
+
+    def get_library(self, source):
+        """Return the library of the source, refreshed if its files changed since the previous request."""
+        self.refresh(source)
+        return self.manager.get_library(source)
+
+    def refresh(self, source):
+        """Notify the importer of the source about the changes of its watched paths since the previous call.
+
+        The first call for an importer only starts watching its paths.
+        """
+        importer = self.manager.get_importer(source)
+        if importer is None:
+            return
+
+        importer_watcher = self._watchers.get(source)
+        if importer_watcher is None or importer_watcher[0] is not importer:
+            if importer_watcher is not None:
+                importer_watcher[1].close()
+            self._watchers[source] = (importer, create_watcher(importer.get_watched_paths()))
+            return
+
+        changed = importer_watcher[1].wait(0)
+        if len(changed) > 0:
+            log.info("Changed: %s", ", ".join(sorted(changed)))
+            importer.notify_changed(changed)
+
+    def _method_list_documents(self, source):
+        return [document_to_dict(document) for document in self.get_library(source).get_documents()]
+
+    def _method_get_annotations(self, source, path):
+        document = self.get_library(source).get_document_by_path(path, normalized=True)
+        if document is None:
+            raise KeyError("No document %s in %s" % (path, source))
+        return annotation_set_to_dict(document.get_annotations())
+
+    def _method_find_documents_by_hash(self, source, hash, hash_method='sha1'):
+        library = self.get_library(source)
+        return [document_to_dict(document) for document in library.get_documents_by_hash(hash, hash_method)]
+
+    def _method_find_documents_by_filename(self, source, filename):
+        library = self.get_library(source)
+        return [document_to_dict(document) for document in library.get_documents_by_filename(filename)]
+
+    def _method_sync(self, source, destination):
+        self.refresh(source)
+        self.refresh(destination)
+        statistics = self.manager.sync(source, destination)
+        return dict(vars(statistics))
+
+    def _method_reload(self, source=None):
+        self.manager.forget_libraries(source)
+        return True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        socketserver.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            log.warning("A client didn't send its request in %.1f s", self.server.request_timeout)
+            return
+
+        if len(line.strip()) == 0:
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+            response = {'result': self.server.dispatch(request.get('method'), request.get('params') or {})}
+        except Exception as e:
+            log.exception("Request failed")
+            response = {'error': "%s: %s" % (type(e).__name__, e)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+
+class LibraryServerError(Exception):
+    pass
+
+
+class LibraryClient(object):
+    """
+    Client of a :py:class:`LibraryServer`, connecting to it for every call.
+    """
+
+    _socket_path = None
+    _timeout = None
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None):
+        """
+        :param basestring socket_path: Path to the socket of the server.
+        :param float timeout: Timeout of the socket operations in seconds (None for no timeout).
+        """
+        super(LibraryClient, self).__init__()
+
+        self._socket_path = socket_path
+        self._timeout = timeout
+
+    def call(self, method, **params):
+        """Call a method of the server.
+
+        :raises LibraryServerError: If the server failed to handle the request.
+        :return: The result of the method.
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(self._timeout)
+            connection.connect(self._socket_path)
+            connection_file = connection.makefile('rwb')
+            try:
+                connection_file.write(json.dumps({'method': method, 'params': params}).encode('utf-8') + b"\n")
+                connection_file.flush()
+                line = connection_file.readline()
+            finally:
+                connection_file.close()
+        finally:
+            connection.close()
+
+        if len(line) == 0:
+            raise LibraryServerError("The server closed the connection")
+
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise LibraryServerError(response['error'])
+        return response['result']
+
+    def ping(self):
+        return self.call('ping')
+
+    def list_documents(self, source):
+        """Return the descriptions (dicts with the path, size, hashes and annotation version) of the documents."""
+        return self.call('list_documents', source=source)
+
+    def get_annotations(self, source, path):
+        """Return the annotations of the document.
+
+        :return: Tuple (list of PDFLocBoundingBoxes, list of PDFLocPair).
+        :rtype: tuple
+        """
+        result = self.call('get_annotations', source=source, path=path)
+        return [annotation_from_dict(data) for data in result['bbox_annotations']], \
+            [annotation_from_dict(data) for data in result['pdfloc_annotations']]
+
+    def find_documents_by_hash(self, source, hash, hash_method='sha1'):
+        return self.call('find_documents_by_hash', source=source, hash=hash, hash_method=hash_method)
+
+    def find_documents_by_filename(self, source, filename):
+        return self.call('find_documents_by_filename', source=source, filename=filename)
+
+    def sync(self, source, destination):
+        """Run a sync in the server.
+
+        :return: The statistics of the sync (the attributes of :py:class:`SyncStatistics`).
+        :rtype: dict
+        """
+        return self.call('sync', source=source, destination=destination)
+
+    def reload(self, source=None):
+        """Make the server import the given source (or all sources) again on the next request."""
+        return self.call('reload', source=source)
+
+    def shutdown(self):
+        return self.call('shutdown')
+
+    def close(self):
+        # no connection is kept between the calls
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error:
+        # nobody is listening
+        os.remove(socket_path)
+    else:
+        raise LibraryServerError("A server is already running on %s" % socket_path)
+    finally:
+        probe.close()
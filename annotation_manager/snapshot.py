@@ -0,0 +1,420 @@
+"""
+Compact binary snapshots of fully loaded :py:class:`DocumentLibrary`-es.
+
+A snapshot stores the documents of a library (paths, sizes, known file hashes, annotation versions) and their
+annotation sets in both the bbox and pdfloc forms (as far as they are available), including the highlighted texts of
+the annotations. The file is memory-mapped when
+loaded; only the document index is decoded up front, the annotations of a document are decoded when they are first
+requested.
+
+Layout of the file (all numbers little-endian):
+
+- header: magic, format version, number of documents, offset of the index
+- annotation blobs, one per document
+- index: for each document its path, size, hashes, annotation version and the position of its blob
+"""
+
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+from annotation_manager.common_representation import DocumentLibrary, AnnotatedDocument, AnnotationSet, \
+    pdfloc_to_bboxes, bboxes_to_pdfloc, set_annotation_text
+from pdfloc_converter.pdfloc import BoundingBoxOnPage, PDFLocBoundingBoxes, PDFLocPair
+
+MAGIC = b"AMSNAP\0\0"
+FORMAT_VERSION = 2
+
+_HEADER = struct.Struct("<8sIIQ")
+_UINT8 = struct.Struct("<B")
+_UINT32 = struct.Struct("<I")
+_INT32 = struct.Struct("<i")
+_UINT64 = struct.Struct("<Q")
+_RECTANGLE = struct.Struct("<i4d")
+
+# length marking a missing string
+_NONE_LENGTH = 0xFFFFFFFF
+# page number marking a missing page
+_NONE_PAGE = -1
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+class SnapshotEntry(object):
+    """
+    Index entry of a single document in a snapshot.
+    """
+
+    def __init__(self, full_path, filesize, filehashes, version, blob_offset, blob_length):
+        super(SnapshotEntry, self).__init__()
+
+        self.full_path = full_path
+        self.filesize = filesize
+        self.filehashes = filehashes
+        self.version = version
+        self.blob_offset = blob_offset
+        self.blob_length = blob_length
+
+
+class SnapshotFile(object):
+    """
+    A memory-mapped snapshot file.
+    """
+
+    _path = None
+    _file = None
+    _map = None
+    _entries = None
+
+    def __init__(self, path):
+        super(SnapshotFile, self).__init__()
+
+        self._path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            raise SnapshotFormatError("%s is not an annotation snapshot" % path)
+
+        magic, version, document_count, index_offset = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise SnapshotFormatError("%s is not an annotation snapshot" % path)
+        if version != FORMAT_VERSION:
+            raise SnapshotFormatError("Unsupported snapshot format version %i in %s" % (version, path))
+
+        self._entries = OrderedDict()
+        reader = _Reader(self._map, index_offset)
+        for _ in range(document_count):
+            full_path = reader.string()
+            filesize = reader.uint64()
+            filehashes = {}
+            for _ in range(reader.uint8()):
+                hash_method = reader.string()
+                filehashes[hash_method] = reader.string()
+            version = reader.string()
+            blob_offset = reader.uint64()
+            blob_length = reader.uint32()
+
+            self._entries[full_path] = SnapshotEntry(full_path, filesize, filehashes, version, blob_offset,
+                                                     blob_length)
+
+    def get_entries(self):
+        return tuple(self._entries.values())
+
+    def get_entry(self, full_path):
+        return self._entries.get(full_path)
+
+    def get_blob(self, entry):
+        """Return the raw (encoded) annotations of the given entry.
+
+        :param SnapshotEntry entry: The entry.
+        :rtype: bytes
+        """
+        return self._map[entry.blob_offset:entry.blob_offset + entry.blob_length]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def path(self):
+        return self._path
+
+
+class SnapshotDocumentLibrary(DocumentLibrary):
+    """
+    Library loaded from a snapshot file.
+    """
+
+    _snapshot = None
+
+    def __init__(self, path):
+        super(SnapshotDocumentLibrary, self).__init__()
+
+        self._snapshot = SnapshotFile(path)
+
+        documents = OrderedDict()
+        for entry in self._snapshot.get_entries():
+            documents[entry.full_path] = SnapshotAnnotatedDocument(self._snapshot, entry)
+
+        self.add_documents(**documents)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+
+class SnapshotAnnotatedDocument(AnnotatedDocument):
+    """
+    Document loaded from a snapshot; its annotations are decoded on first use.
+    """
+
+    _snapshot = None
+    _entry = None
+
+    def __init__(self, snapshot, entry):
+        super(SnapshotAnnotatedDocument, self).__init__(entry.full_path, entry.filesize)
+
+        self._snapshot = snapshot
+        self._entry = entry
+
+        self._filehashes.update(entry.filehashes)
+
+    def get_annotations_version(self):
+        return self._entry.version
+
+    def _load_annotations(self):
+        bbox_annotations, pdfloc_annotations = decode_annotations(self._snapshot.get_blob(self._entry))
+        return SnapshotAnnotationSet(self, bbox_annotations, pdfloc_annotations)
+
+
+class SnapshotAnnotationSet(AnnotationSet):
+
+    _document = None
+
+    def __init__(self, document, bbox_annotations, pdfloc_annotations):
+        super(SnapshotAnnotationSet, self).__init__()
+
+        self._document = document
+        self._bbox_annotations = bbox_annotations
+        self._pdfloc_annotations = pdfloc_annotations
+
+
+def write_snapshot(library, path, convert_forms=False):
+    """Write the library to a snapshot file.
+
+    If the file already contains a snapshot, the annotations of the documents whose annotation versions didn't change
+    are copied from it without loading them from the library.
+
+    :param DocumentLibrary library: The library to write.
+    :param basestring path: Path to the snapshot file.
+    :param bool convert_forms: If True, annotations missing in the bbox or pdfloc form are converted, so that the
+                               snapshot contains both forms of all annotations.
+    :return: Number of documents whose annotations had to be (re)loaded.
+    :rtype: int
+    """
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = SnapshotFile(path)
+        except (SnapshotFormatError, ValueError, IOError):
+            previous = None
+
+    temporary_path = path + ".tmp"
+    refreshed = 0
+
+    try:
+        with open(temporary_path, 'wb') as output:
+            output.write(b"\0" * _HEADER.size)
+
+            index = []
+            for document in library.get_documents():
+                version = document.get_annotations_version()
+                version = _version_to_string(version) if version is not None else None
+
+                previous_entry = previous.get_entry(document.full_path) if previous is not None else None
+                if version is not None and previous_entry is not None and previous_entry.version == version:
+                    blob = previous.get_blob(previous_entry)
+                else:
+                    annotations = document.get_annotations()
+                    if convert_forms and not annotations.empty():
+                        if len(annotations.bbox_annotations) == 0:
+                            pdfloc_to_bboxes(document, annotations)
+                        if len(annotations.pdfloc_annotations) == 0:
+                            bboxes_to_pdfloc(document, annotations)
+                    blob = encode_annotations(annotations.bbox_annotations, annotations.pdfloc_annotations)
+                    refreshed += 1
+
+                filehashes = dict((hash_method, hash) for (hash_method, hash) in document._filehashes.items()
+                                  if hash is not None)
+                index.append((document.full_path, document.filesize, filehashes, version, output.tell(), len(blob)))
+                output.write(blob)
+
+            index_offset = output.tell()
+            writer = _Writer()
+            for full_path, filesize, filehashes, version, blob_offset, blob_length in index:
+                writer.string(full_path)
+                writer.uint64(filesize)
+                writer.uint8(len(filehashes))
+                for hash_method, hash in sorted(filehashes.items()):
+                    writer.string(hash_method)
+                    writer.string(hash)
+                writer.string(version)
+                writer.uint64(blob_offset)
+                writer.uint32(blob_length)
+            output.write(writer.getvalue())
+
+            output.seek(0)
+            output.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(index), index_offset))
+    finally:
+        if previous is not None:
+            previous.close()
+
+    _replace_file(temporary_path, path)
+
+    return refreshed
+
+
+def encode_annotations(bbox_annotations, pdfloc_annotations):
+    """Encode the annotations to the binary form used in snapshots.
+
+    :param bbox_annotations: The annotations in the bbox form.
+    :type bbox_annotations: list of PDFLocBoundingBoxes
+    :param pdfloc_annotations: The annotations in the pdfloc form.
+    :type pdfloc_annotations: list of PDFLocPair
+    :rtype: bytes
+    """
+    writer = _Writer()
+
+    writer.uint32(len(bbox_annotations))
+    for annotation in bbox_annotations:
+        writer.int32(annotation.page if annotation.page is not None else _NONE_PAGE)
+        writer.string(getattr(annotation, 'comment', None))
+        writer.string(getattr(annotation, 'text', None))
+        writer.uint32(len(annotation.bboxes))
+        for bbox in annotation.bboxes:
+            writer.rectangle(bbox.page, bbox.bbox)
+
+    writer.uint32(len(pdfloc_annotations))
+    for annotation in pdfloc_annotations:
+        writer.string(str(annotation.start))
+        writer.string(str(annotation.end))
+        writer.string(annotation.comment)
+        writer.string(getattr(annotation, 'text', None))
+
+    return writer.getvalue()
+
+
+def decode_annotations(data):
+    """Decode annotations encoded by :py:func:`encode_annotations`.
+
+    :param bytes data: The encoded annotations.
+    :return: Tuple (list of PDFLocBoundingBoxes, list of PDFLocPair).
+    :rtype: tuple
+    """
+    reader = _Reader(data, 0)
+
+    bbox_annotations = []
+    for _ in range(reader.uint32()):
+        page = reader.int32()
+        comment = reader.string()
+        text = reader.string()
+        bboxes = []
+        for _ in range(reader.uint32()):
+            bbox_page, bbox = reader.rectangle()
+            bboxes.append(BoundingBoxOnPage(bbox, bbox_page))
+        bbox_annotations.append(_with_text(PDFLocBoundingBoxes(bboxes, page if page != _NONE_PAGE else None, comment),
+                                           text))
+
+    pdfloc_annotations = []
+    for _ in range(reader.uint32()):
+        start = reader.string()
+        end = reader.string()
+        comment = reader.string()
+        text = reader.string()
+        pdfloc_annotations.append(_with_text(PDFLocPair(start, end, comment), text))
+
+    return bbox_annotations, pdfloc_annotations
+
+
+def _with_text(annotation, text):
+    # only the annotations that had a highlighted text get the attribute back
+    return set_annotation_text(annotation, text) if text is not None else annotation
+
+
+def _version_to_string(version):
+    return version if isinstance(version, basestring) else repr(version)
+
+
+def _replace_file(source, destination):
+    if sys.platform.startswith("win32") and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class _Writer(object):
+
+    def __init__(self):
+        super(_Writer, self).__init__()
+
+        self._parts = []
+
+    def uint8(self, value):
+        self._parts.append(_UINT8.pack(value))
+
+    def uint32(self, value):
+        self._parts.append(_UINT32.pack(value))
+
+    def int32(self, value):
+        self._parts.append(_INT32.pack(value))
+
+    def uint64(self, value):
+        self._parts.append(_UINT64.pack(value))
+
+    def string(self, value):
+        if value is None:
+            self.uint32(_NONE_LENGTH)
+            return
+
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.uint32(len(value))
+        self._parts.append(value)
+
+    def rectangle(self, page, bbox):
+        self._parts.append(_RECTANGLE.pack(page if page is not None else _NONE_PAGE, *bbox))
+
+    def getvalue(self):
+        return b"".join(self._parts)
+
+
+class _Reader(object):
+
+    def __init__(self, buffer, offset):
+        super(_Reader, self).__init__()
+
+        self._buffer = buffer
+        self._offset = offset
+
+    def _unpack(self, structure):
+        try:
+            values = structure.unpack_from(self._buffer, self._offset)
+        except struct.error:
+            raise SnapshotFormatError("Truncated snapshot data")
+        self._offset += structure.size
+        return values
+
+    def uint8(self):
+        return self._unpack(_UINT8)[0]
+
+    def uint32(self):
+        return self._unpack(_UINT32)[0]
+
+    def int32(self):
+        return self._unpack(_INT32)[0]
+
+    def uint64(self):
+        return self._unpack(_UINT64)[0]
+
+    def string(self):
+        length = self.uint32()
+        if length == _NONE_LENGTH:
+            return None
+
+        value = self._buffer[self._offset:self._offset + length]
+        if len(value) != length:
+            raise SnapshotFormatError("Truncated snapshot data")
+        self._offset += length
+        return value.decode('utf-8')
+
+    def rectangle(self):
+        values = self._unpack(_RECTANGLE)
+        return (values[0] if values[0] != _NONE_PAGE else None), values[1:]
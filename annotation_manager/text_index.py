@@ -0,0 +1,181 @@
+"""
+Full-text index over the texts and comments of the annotations of document libraries.
+
+The index is an SQLite FTS5 table in a local file. It is updated incrementally: only the documents whose annotation
+versions (see :py:meth:`AnnotatedDocument.get_annotations_version`) changed since the last update are reindexed.
+"""
+
+import json
+import os
+import sqlite3
+
+from annotation_manager.serialization import annotation_to_dict, annotation_from_dict
+
+DEFAULT_INDEX_PATH = os.path.join(os.environ["HOME"], ".annotation_manager", "text_index.sqlite")
+
+
+class SearchResult(object):
+    """
+    A single annotation found by :py:meth:`AnnotationTextIndex.search`.
+    """
+
+    def __init__(self, library, path, page, annotation, text, comment, score):
+        super(SearchResult, self).__init__()
+
+        self.library = library
+        self.path = path
+        self.page = page
+        self.annotation = annotation
+        self.text = text
+        self.comment = comment
+        # bm25 score, the lower the better
+        self.score = score
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        return u"%s (page %s): %s" % (self.path, self.page, self.text or self.comment)
+
+
+class AnnotationTextIndex(object):
+    """
+    Searchable index of annotation texts and comments of any number of libraries.
+
+    Each library is indexed under a name (typically its source), so that several libraries share one index.
+    """
+
+    _path = None
+    _connection = None
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        """
+        :param basestring path: Path to the index database (created if it doesn't exist).
+        """
+        super(AnnotationTextIndex, self).__init__()
+
+        directory = os.path.dirname(path)
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        try:
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, library TEXT, path TEXT, version TEXT, "
+                "UNIQUE (library, path));"
+                # rowids of the annotations of each document, so that they can be deleted without scanning the index
+                "CREATE TABLE IF NOT EXISTS annotation_documents (annotation_id INTEGER PRIMARY KEY, "
+                "document_id INTEGER);"
+                "CREATE INDEX IF NOT EXISTS annotation_documents_document ON annotation_documents (document_id);"
+                "CREATE VIRTUAL TABLE IF NOT EXISTS annotations USING fts5(text, comment, document_id UNINDEXED, "
+                "page UNINDEXED, annotation UNINDEXED, tokenize='unicode61 remove_diacritics 2');")
+        except sqlite3.OperationalError as e:
+            self._connection.close()
+            raise RuntimeError("The text index needs SQLite with the FTS5 extension (%s)" % e)
+
+    def update(self, library, library_name):
+        """Reindex the documents of the library whose annotations changed since the last update.
+
+        Documents no longer in the library are removed from the index. Documents that don't know their annotation
+        versions are always reindexed.
+
+        :param DocumentLibrary library: The library.
+        :param unicode library_name: Name of the library in the index.
+        :return: Number of reindexed documents.
+        :rtype: int
+        """
+        indexed = dict((path, (document_id, version)) for (document_id, path, version) in self._connection.execute(
+            "SELECT id,path,version FROM documents WHERE library=?", (library_name,)))
+
+        reindexed = 0
+        with self._connection:
+            for document in library.get_documents():
+                version = document.get_annotations_version()
+                version = repr(version) if version is not None else None
+
+                document_id, indexed_version = indexed.pop(document.full_path, (None, None))
+                if document_id is not None and version is not None and version == indexed_version:
+                    continue
+
+                if document_id is not None:
+                    self._remove_annotations(document_id)
+                    self._connection.execute("UPDATE documents SET version=? WHERE id=?", (version, document_id))
+                else:
+                    document_id = self._connection.execute(
+                        "INSERT INTO documents (library,path,version) VALUES (?,?,?)",
+                        (library_name, document.full_path, version)).lastrowid
+
+                self._index_annotations(document_id, document.get_annotations())
+                reindexed += 1
+
+            for document_id, _ in indexed.values():
+                self._remove_annotations(document_id)
+                self._connection.execute("DELETE FROM documents WHERE id=?", (document_id,))
+
+        return reindexed
+
+    def search(self, query, limit=20, library_name=None, raw=False):
+        """Find the annotations best matching the query.
+
+        :param unicode query: The words to look for (all of them have to be present), or an FTS5 query if `raw`.
+        :param int limit: Maximum number of results.
+        :param unicode library_name: If given, only search the library indexed under this name.
+        :param bool raw: Whether the query is in the FTS5 query syntax.
+        :return: The results, best first.
+        :rtype: list of SearchResult
+        """
+        if not raw:
+            query = u" ".join(u'"%s"' % word.replace(u'"', u'""') for word in query.split())
+            if len(query) == 0:
+                return []
+
+        sql = "SELECT d.library,d.path,a.page,a.annotation,a.text,a.comment,bm25(annotations) " \
+              "FROM annotations a JOIN documents d ON d.id=a.document_id WHERE annotations MATCH ?"
+        parameters = [query]
+        if library_name is not None:
+            sql += " AND d.library=?"
+            parameters.append(library_name)
+        sql += " ORDER BY bm25(annotations) LIMIT ?"
+        parameters.append(limit)
+
+        return [SearchResult(library, path, page, annotation_from_dict(json.loads(annotation)), text, comment, score)
+                for (library, path, page, annotation, text, comment, score)
+                in self._connection.execute(sql, parameters)]
+
+    def remove_library(self, library_name):
+        with self._connection:
+            for (document_id,) in self._connection.execute("SELECT id FROM documents WHERE library=?",
+                                                           (library_name,)).fetchall():
+                self._remove_annotations(document_id)
+            self._connection.execute("DELETE FROM documents WHERE library=?", (library_name,))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def _index_annotations(self, document_id, annotations):
+        for annotation in list(annotations.bbox_annotations) + list(annotations.pdfloc_annotations):
+            text = _to_unicode(getattr(annotation, 'text', None))
+            comment = _to_unicode(getattr(annotation, 'comment', None))
+            if not text and not comment:
+                continue
+
+            annotation_id = self._connection.execute(
+                "INSERT INTO annotations (text,comment,document_id,page,annotation) VALUES (?,?,?,?,?)",
+                (text, comment, document_id, annotation.page, json.dumps(annotation_to_dict(annotation)))).lastrowid
+            self._connection.execute("INSERT INTO annotation_documents VALUES (?,?)", (annotation_id, document_id))
+
+    def _remove_annotations(self, document_id):
+        self._connection.execute("DELETE FROM annotations WHERE rowid IN "
+                                 "(SELECT annotation_id FROM annotation_documents WHERE document_id=?)", (document_id,))
+        self._connection.execute("DELETE FROM annotation_documents WHERE document_id=?", (document_id,))
+
+
+def _to_unicode(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
@@ -0,0 +1,240 @@
+"""
+Watchers of filesystem changes used by the watch mode of :py:class:`AnnotationManager`.
+
+On Linux, changes are reported by inotify; elsewhere (or if inotify is not available) the watched paths are polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from abc import ABCMeta, abstractmethod
+from six import add_metaclass
+
+log = logging.getLogger(__name__)
+
+
+@add_metaclass(ABCMeta)
+class FileSystemWatcher(object):
+    """
+    Watcher of a set of files and directories.
+
+    A watched directory is reported as changed when any entry in it changes. A watched file is reported as changed
+    when it or its SQLite journal changes.
+    """
+
+    # suffixes of the files whose changes are reported as changes of the watched file
+    COMPANION_SUFFIXES = ("", "-journal", "-wal")
+
+    _paths = None
+
+    def __init__(self, paths):
+        super(FileSystemWatcher, self).__init__()
+
+        self._paths = list(paths)
+
+    @abstractmethod
+    def wait(self, timeout=None):
+        """Wait for changes of the watched paths.
+
+        :param float timeout: Maximum time to wait in seconds (None to wait until a change occurs).
+        :return: The changed watched paths (empty if the timeout has elapsed).
+        :rtype: set of basestring
+        """
+        pass
+
+    def wait_debounced(self, debounce, timeout=None):
+        """Wait for changes and then for a quiet period, so that a burst of changes is reported only once.
+
+        :param float debounce: Length of the quiet period in seconds.
+        :param float timeout: Maximum time to wait for the first change in seconds (None to wait indefinitely).
+        :return: All the watched paths changed during the burst (empty if the timeout has elapsed).
+        :rtype: set of basestring
+        """
+        changed = self.wait(timeout)
+        if len(changed) == 0:
+            return changed
+
+        while True:
+            more = self.wait(debounce)
+            if len(more) == 0:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+    @property
+    def paths(self):
+        return tuple(self._paths)
+
+    def _split(self, path):
+        """Return the directory to watch for the given path and the names in it that matter (None for all)."""
+        if os.path.isdir(path):
+            return path, None
+
+        directory, name = os.path.split(path)
+        return directory, set(name + suffix for suffix in self.COMPANION_SUFFIXES)
+
+
+class PollingWatcher(FileSystemWatcher):
+    """
+    Watcher that periodically compares the modification times and sizes of the watched paths.
+    """
+
+    _poll_interval = None
+    _signatures = None
+
+    def __init__(self, paths, poll_interval=1.0):
+        super(PollingWatcher, self).__init__(paths)
+
+        self._poll_interval = poll_interval
+        self._signatures = dict((path, self._signature(path)) for path in self._paths)
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while True:
+            changed = set()
+            for path in self._paths:
+                signature = self._signature(path)
+                if signature != self._signatures[path]:
+                    self._signatures[path] = signature
+                    changed.add(path)
+
+            if len(changed) > 0:
+                return changed
+
+            remaining = deadline - time.time() if deadline is not None else self._poll_interval
+            if remaining <= 0:
+                return changed
+
+            time.sleep(min(self._poll_interval, remaining))
+
+    def _signature(self, path):
+        directory, names = self._split(path)
+
+        try:
+            entries = os.listdir(directory) if names is None else [name for name in names
+                                                                   if os.path.exists(os.path.join(directory, name))]
+        except OSError:
+            return None
+
+        signature = []
+        for name in sorted(entries):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            signature.append((name, stat.st_mtime, stat.st_size))
+
+        return tuple(signature)
+
+
+class InotifyWatcher(FileSystemWatcher):
+    """
+    Watcher using the Linux inotify API (through ctypes, so that no extension module is needed).
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    _libc = None
+    _fd = None
+    # watch descriptor -> list of (watched path, names that matter or None)
+    _watches = None
+
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self._watches = {}
+        for path in self._paths:
+            directory, names = self._split(path)
+
+            encoded_directory = directory.encode(sys.getfilesystemencoding()) \
+                if isinstance(directory, unicode) else directory
+            watch_descriptor = self._libc.inotify_add_watch(self._fd, encoded_directory, self.WATCH_MASK)
+            if watch_descriptor < 0:
+                error = ctypes.get_errno()
+                self.close()
+                raise OSError(error, "cannot watch %s" % directory)
+
+            self._watches.setdefault(watch_descriptor, []).append((path, names))
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while True:
+            remaining = max(0, deadline - time.time()) if deadline is not None else None
+            try:
+                readable, _, _ = select.select([self._fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if len(readable) == 0:
+                return set()
+
+            changed = self._read_events()
+            if len(changed) > 0:
+                return changed
+
+    def _read_events(self):
+        data = os.read(self._fd, 64 * 1024)
+
+        changed = set()
+        position = 0
+        while position + self._EVENT_HEADER.size <= len(data):
+            watch_descriptor, _, _, name_length = self._EVENT_HEADER.unpack_from(data, position)
+            position += self._EVENT_HEADER.size
+            name = data[position:position + name_length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            position += name_length
+
+            for path, names in self._watches.get(watch_descriptor, ()):
+                if names is None or name in names:
+                    changed.add(path)
+
+        return changed
+
+    def close(self):
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+
+
+def create_watcher(paths, poll_interval=1.0):
+    """Create the best watcher available on this system for the given paths.
+
+    :param paths: The files and directories to watch.
+    :type paths: list of basestring
+    :param float poll_interval: Polling interval in seconds used if inotify is not available.
+    :return: The watcher.
+    :rtype: FileSystemWatcher
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError, TypeError) as e:
+            log.warning("inotify is not available (%s), falling back to polling", e)
+
+    return PollingWatcher(paths, poll_interval)
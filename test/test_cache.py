@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import os
+import sqlite3
+import tempfile
+
+from annotation_manager.cache import Cache, content_key
+from annotation_manager.conversion_cache import ConversionCache
+from pdfloc_converter.pdfloc import BoundingBoxOnPage, PDFLocBoundingBoxes
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "cache.sqlite")
+
+    assert content_key("ab", "c") != content_key("a", "bc")
+    assert content_key(u"š", 1) == content_key(u"š".encode('utf-8'), "1")
+
+    # the small namespace has its own budget, both share the global one
+    cache = Cache(path, budget=3000, namespace_budgets={"small": 1000})
+    small = cache.namespace("small")
+    large = cache.namespace("large")
+
+    for i in range(5):
+        small.put("key%i" % i, b"s" * 300)
+    # the least recently used values were evicted down to 90 % of the budget
+    assert cache.get_size("small") == 900
+    assert small.get("key4") is not None and small.get("key0") is None
+    assert [namespace_statistics.evictions for namespace_statistics in cache.get_statistics()] == [2]
+    assert small.clear() == 3
+
+    large.put("key0", b"l" * 1100)
+    large.put("key1", b"l" * 1100)
+    assert large.get("key0") is not None
+    # key1 is now the least recently used value
+    large.put("key2", b"l" * 1100)
+    assert cache.get_size() == 2200
+    assert large.get("key1") is None and large.get("key0") is not None and large.get("key2") is not None
+
+    statistics = cache.get_statistics()
+    print("\n".join(str(namespace_statistics) for namespace_statistics in statistics))
+    assert len(statistics) == 1 and statistics[0].namespace == "large" and statistics[0].budget is None
+    assert (statistics[0].hits, statistics[0].misses, statistics[0].evictions) == (3, 1, 1)
+
+    # another process (here another connection) sees the same values and sizes
+    other = Cache(path, budget=3000, namespace_budgets={"small": 1000})
+    assert other.namespace("large").get("key2") == b"l" * 1100
+    assert other.get_size() == cache.get_size()
+    other.close()
+
+    assert cache.verify() == []
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("UPDATE entries SET value=? WHERE namespace='large' AND key='key2'",
+                           (sqlite3.Binary(b"x" * 1100),))
+    connection.close()
+    assert len(cache.verify()) == 1
+    assert large.get("key2") is None
+
+    # with a negative age, all the values are too old
+    remaining = sum(namespace_statistics.entries for namespace_statistics in cache.get_statistics())
+    assert cache.prune(-1) == remaining
+    assert cache.get_size() == 0
+
+    # conversions are keyed by the document fingerprint and the annotation
+    conversions = ConversionCache(cache)
+    converted = PDFLocBoundingBoxes([BoundingBoxOnPage((1.0, 2.0, 3.0, 4.0), 1)], 1, None)
+    conversions.put("sha1:abc", ConversionCache.TO_BBOXES, [("annotation", converted)])
+    assert conversions.get_cached_keys("sha1:abc", ConversionCache.TO_BBOXES, ["annotation", "other"]) == \
+        {"annotation"}
+    assert conversions.get_cached_keys("sha1:def", ConversionCache.TO_BBOXES, ["annotation"]) == set()
+    assert conversions.get_cached_keys("sha1:abc", ConversionCache.TO_PDFLOCS, ["annotation"]) == set()
+    assert conversions.get("sha1:abc", ConversionCache.TO_BBOXES, ["annotation"])["annotation"].bboxes == \
+        converted.bboxes
+
+    assert cache.clear(ConversionCache.NAMESPACE) == 1
+    assert conversions.get("sha1:abc", ConversionCache.TO_BBOXES, ["annotation"]) == {}
+
+    cache.close()
+
+    print("OK")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+
+from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.distributed import WorkQueue
+
+if __name__ == '__main__':
+    this_script_path = unicode(os.path.dirname(os.path.realpath(__file__)), sys.getfilesystemencoding())
+
+    pocketbook_path = os.path.join(this_script_path, u'resources', u'pocketbook')
+
+    source = u"pocketbook%s%s%s%s%s%s" % (
+        os.pathsep, os.path.join(pocketbook_path, u"system"), os.sep,
+        os.pathsep, os.path.join(pocketbook_path, u"external"), os.sep
+    )
+
+    queue_path = os.path.join(tempfile.mkdtemp(), "queue.sqlite")
+
+    manager = AnnotationManager()
+
+    # what a sync in a single process would do
+    common, _, _ = manager.get_library(source).find_common_documents(manager.get_library(u"mendeley"))
+    expected_annotations = sum(len(source_document.find_common_annotations(destination_document)[1])
+                               for (source_document, destination_document) in common)
+
+    statistics = manager.distributed_sync(source, u"mendeley", queue_path, shard_count=4, local_workers=3)
+    print(statistics)
+
+    assert statistics.error is None
+    assert statistics.documents_matched == len(common) > 0
+    assert statistics.annotations_exported == expected_annotations
+
+    # every shard was done by a worker and its annotations written by the coordinator
+    queue = WorkQueue(queue_path)
+    try:
+        assert queue.count_shards(WorkQueue.STATE_PENDING, WorkQueue.STATE_CLAIMED, WorkQueue.STATE_DONE,
+                                  WorkQueue.STATE_FAILED) == 0
+        assert 0 < queue.count_shards(WorkQueue.STATE_APPLIED) <= 4
+    finally:
+        queue.close()
+
+    # nothing is missing in the destination any more
+    manager.forget_libraries()
+    statistics = manager.distributed_sync(source, u"mendeley", queue_path, shard_count=4, local_workers=3)
+    print(statistics)
+    assert statistics.error is None and statistics.annotations_exported == 0
+
+    print("OK")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+from annotation_manager.AnnotationManager import AnnotationManager
+
+
+def annotation_record(position, text=None, comment=None):
+    annotation = {'type': 'bboxes', 'page': 1, 'comment': comment,
+                  'bboxes': [{'page': 1, 'bbox': [72.0, position, 300.0, position + 12.0]}]}
+    if text is not None:
+        annotation['text'] = text
+    return {'type': 'annotation', 'annotation': annotation}
+
+
+def describe(library):
+    return dict((document.full_path, sorted((annotation.bboxes[0].bbox[1], getattr(annotation, 'text', None),
+                                             annotation.comment)
+                                            for annotation in document.get_annotations().bbox_annotations))
+                for document in library.get_documents())
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    document_paths = []
+    for name in (u"first.pdf", u"second.pdf"):
+        document_paths.append(os.path.join(directory, name))
+        with open(document_paths[-1], 'wb') as document_file:
+            document_file.write(b"%PDF-1.4\n" + name.encode('utf-8') * (100 * len(document_paths)))
+
+    source_path = os.path.join(directory, "source.jsonl")
+    with open(source_path, 'wb') as jsonl_file:
+        for document_path, records in ((document_paths[0], [annotation_record(100, u"Entropy", u"a <note> & more"),
+                                                            annotation_record(300)]),
+                                       (document_paths[1], [annotation_record(200, comment=u"Škola")])):
+            jsonl_file.write(json.dumps({'type': 'document', 'path': document_path,
+                                         'size': os.path.getsize(document_path), 'hashes': {}}, sort_keys=True) + "\n")
+            for record in records:
+                jsonl_file.write(json.dumps(record, sort_keys=True) + "\n")
+    source = u"jsonl" + os.pathsep + source_path
+
+    # a file that doesn't exist yet is an empty library
+    copy_path = os.path.join(directory, "copy.jsonl")
+    copy = u"jsonl" + os.pathsep + copy_path
+    manager = AnnotationManager()
+    assert len(manager.get_library(copy).get_documents()) == 0
+
+    manager.export_library(source, copy)
+    assert sorted(os.listdir(directory)) == sorted([u"first.pdf", u"second.pdf", u"source.jsonl", u"copy.jsonl"])
+
+    manager.forget_libraries()
+    expected = describe(manager.get_library(source))
+    print(expected)
+    assert describe(manager.get_library(copy)) == expected
+    assert expected[document_paths[0]][0] == (100.0, u"Entropy", u"a <note> & more")
+
+    # appending records of one document changes only its annotation version
+    library = manager.get_library(copy)
+    versions = dict((document.full_path, document.get_annotations_version()) for document in library.get_documents())
+    manager.find_exporter(copy).add_annotations_to_document(library.get_document_by_path(document_paths[1]), [])
+    manager.forget_libraries()
+    library = manager.get_library(copy)
+    assert library.get_document_by_path(document_paths[0]).get_annotations_version() == versions[document_paths[0]]
+    assert library.get_document_by_path(document_paths[1]).get_annotations_version() != versions[document_paths[1]]
+    assert describe(library) == expected
+
+    # exporting again replaces the file instead of appending to it
+    manager.export_library(source, copy)
+    manager.forget_libraries()
+    assert describe(manager.get_library(copy)) == expected
+    assert len(manager.get_library(copy).get_document_by_path(document_paths[1]).get_annotations_version()) == 1
+
+    print("OK")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.server import LibraryServer, LibraryClient
+
+
+def write_records(jsonl_file, document_path, positions):
+    jsonl_file.write(json.dumps({'type': 'document', 'path': document_path,
+                                 'size': os.path.getsize(document_path), 'hashes': {}}, sort_keys=True) + "\n")
+    for position in positions:
+        jsonl_file.write(json.dumps({'type': 'annotation', 'annotation': {
+            'type': 'bboxes', 'page': 1, 'comment': u"note %i" % position,
+            'bboxes': [{'page': 1, 'bbox': [72.0, position, 300.0, position + 12.0]}]}}) + "\n")
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    document_path = os.path.join(directory, u"paper.pdf")
+    with open(document_path, 'wb') as document_file:
+        document_file.write(b"%PDF-1.4\n" + b"0" * 10000)
+
+    source_path = os.path.join(directory, "source.jsonl")
+    destination_path = os.path.join(directory, "destination.jsonl")
+    with open(source_path, 'wb') as jsonl_file:
+        write_records(jsonl_file, document_path, [100])
+    with open(destination_path, 'wb') as jsonl_file:
+        write_records(jsonl_file, document_path, [])
+    source = u"jsonl" + os.pathsep + source_path
+    destination = u"jsonl" + os.pathsep + destination_path
+
+    socket_path = os.path.join(directory, "server.sock")
+    server = LibraryServer(AnnotationManager(), socket_path)
+    server.request_timeout = 1.0
+    server_thread = threading.Thread(target=server.serve)
+    # a failing test must not be kept alive by the server
+    server_thread.daemon = True
+    server_thread.start()
+
+    try:
+        with LibraryClient(socket_path, timeout=30.0) as client:
+            assert client.ping() == "pong"
+
+            # a client doesn't hold its connection between the calls, so other clients are served
+            with LibraryClient(socket_path, timeout=5.0) as other_client:
+                assert other_client.ping() == "pong"
+            assert client.ping() == "pong"
+
+            # a client that keeps its connection open without a request holds the others up only until the timeout
+            idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            idle.connect(socket_path)
+            start_time = time.time()
+            try:
+                assert client.ping() == "pong"
+            finally:
+                idle.close()
+            assert time.time() - start_time < 10.0
+
+            documents = client.list_documents(source)
+            assert [document['path'] for document in documents] == [document_path]
+
+            bbox_annotations, pdfloc_annotations = client.get_annotations(source, document_path)
+            assert [annotation.comment for annotation in bbox_annotations] == [u"note 100"]
+            assert pdfloc_annotations == []
+
+            # the server sees a change of the source made behind its back
+            time.sleep(0.1)
+            with open(source_path, 'ab') as jsonl_file:
+                write_records(jsonl_file, document_path, [300])
+            bbox_annotations, _ = client.get_annotations(source, document_path)
+            assert sorted(annotation.comment for annotation in bbox_annotations) == [u"note 100", u"note 300"]
+
+            statistics = client.sync(source, destination)
+            print(statistics)
+            assert statistics['documents_matched'] == 1 and statistics['annotations_exported'] == 2
+
+            # the destination was changed by the sync itself
+            bbox_annotations, _ = client.get_annotations(destination, document_path)
+            assert len(bbox_annotations) == 2
+            assert client.sync(source, destination)['annotations_exported'] == 0
+
+            assert client.find_documents_by_filename(destination, u"paper.pdf")[0]['path'] == document_path
+
+            client.shutdown()
+    finally:
+        server_thread.join(30.0)
+
+    assert not server_thread.is_alive()
+    assert not os.path.exists(socket_path)
+
+    print("OK")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import os
+import sqlite3
+import tempfile
+
+from annotation_manager.common_representation import LibraryCandidates
+from annotation_manager.plugins import mendeley
+from annotation_manager.plugins.mendeley import MendeleyAnnotationImporter
+
+
+class CountingGetsize(object):
+    """Counts the files whose sizes were read."""
+
+    def __init__(self, getsize):
+        self.getsize = getsize
+        self.paths = []
+
+    def __call__(self, path):
+        self.paths.append(path)
+        return self.getsize(path)
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    rows = []
+    for document_id, (name, file_hash) in enumerate(((u"hashed.pdf", "1" * 40), (u"named.pdf", "2" * 40),
+                                                     (u"other.pdf", "3" * 40), (u"renamed.pdf", "4" * 40)), 1):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as document_file:
+            document_file.write(b"%PDF-1.4\n" + b"0" * 1000)
+        rows.append((document_id, file_hash, u"file:///" + path))
+
+    sqlite_path = os.path.join(directory, "mendeley.sqlite")
+    connection = sqlite3.connect(sqlite_path)
+    with connection:
+        connection.execute("CREATE TABLE DocumentFiles (documentId INTEGER, hash TEXT, unlinked TEXT)")
+        connection.execute("CREATE TABLE Files (hash TEXT, localUrl TEXT)")
+        connection.executemany("INSERT INTO DocumentFiles VALUES (?,?,'false')", [row[:2] for row in rows])
+        connection.executemany("INSERT INTO Files VALUES (?,?)", [row[1:] for row in rows])
+    connection.close()
+
+    size = os.path.getsize(os.path.join(directory, u"hashed.pdf"))
+    getsize = CountingGetsize(os.path.getsize)
+    mendeley.os.path.getsize = getsize
+    try:
+        importer = MendeleyAnnotationImporter(sqlite_path)
+
+        # the hash of one candidate is unknown, so only its filename can be matched
+        candidates = LibraryCandidates([size], [u"copy.pdf", u"named.pdf"], {'sha1': ["1" * 40]})
+        library = importer.get_annotated_library(candidates)
+        print(sorted(document.filename for document in library.get_documents()))
+        assert sorted(document.filename for document in library.get_documents()) == [u"hashed.pdf", u"named.pdf"]
+        # the other documents were filtered out before their files were looked at
+        assert sorted(os.path.basename(path) for path in getsize.paths) == [u"hashed.pdf", u"named.pdf"]
+
+        # all libraries of the importer share its connection
+        connection = library._sqlite_connection
+        library = importer.get_annotated_library(LibraryCandidates([size], [u"renamed.pdf"], {'sha1': []}, ['sha1']))
+        assert [document.filename for document in library.get_documents()] == [u"renamed.pdf"]
+        assert library._sqlite_connection is connection
+        assert importer.get_annotated_library()._sqlite_connection is connection
+        assert len(importer.get_annotated_library().get_documents()) == 4
+
+        importer.reload()
+        try:
+            connection.execute("SELECT 1")
+            assert False
+        except sqlite3.ProgrammingError:
+            pass
+    finally:
+        mendeley.os.path.getsize = getsize.getsize
+
+    print("OK")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+from annotation_manager.AnnotationManager import AnnotationManager
+
+
+def write_library(path, document_path, bbox):
+    with open(path, 'wb') as jsonl_file:
+        jsonl_file.write(json.dumps({'type': 'document', 'path': document_path,
+                                     'size': os.path.getsize(document_path), 'hashes': {}}, sort_keys=True) + "\n")
+        jsonl_file.write(json.dumps({'type': 'annotation', 'annotation': {
+            'type': 'bboxes', 'page': 1, 'comment': None, 'bboxes': [{'page': 1, 'bbox': bbox}]}}) + "\n")
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    document_path = os.path.join(directory, u"paper.pdf")
+    with open(document_path, 'wb') as document_file:
+        document_file.write(b"%PDF-1.4\n" + b"0" * 10000)
+
+    # the same highlight, once converted from a pdfloc and once stored by another program: the rectangles differ by
+    # less than a point, but more than the quantization step of the fingerprints
+    pocketbook_path = os.path.join(directory, "pocketbook.jsonl")
+    mendeley_path = os.path.join(directory, "mendeley.jsonl")
+    write_library(pocketbook_path, document_path, [72.2, 700.2, 300.0, 712.0])
+    write_library(mendeley_path, document_path, [72.5, 700.5, 300.3, 712.2])
+
+    sources = [u"jsonl" + os.pathsep + pocketbook_path, u"jsonl" + os.pathsep + mendeley_path]
+    sizes = [os.path.getsize(path) for path in (pocketbook_path, mendeley_path)]
+
+    manager = AnnotationManager()
+    library = manager.merge_sources(sources, fan_out=True)
+
+    documents = library.get_documents()
+    assert len(documents) == 1
+    assert len(documents[0].members) == 2
+
+    annotations = documents[0].get_annotations().bbox_annotations
+    print(annotations)
+    assert len(annotations) == 1
+
+    # nothing was missing in either source, so nothing was exported back
+    assert [os.path.getsize(path) for path in (pocketbook_path, mendeley_path)] == sizes
+
+    print("OK")
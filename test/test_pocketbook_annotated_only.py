@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import os
+import tempfile
+
+from annotation_manager.plugins import pocketbook
+from annotation_manager.plugins.pocketbook import PocketbookAnnotationImporter, PocketbookAnnotatedDocument
+
+
+def write_document(directory, filename, content):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, filename), 'wb') as document_file:
+        document_file.write(b"%PDF-1.4\n" + content * 5000)
+
+
+class CountingWalk(object):
+    """Counts the walks of the given root (os.walk calls itself for the subdirectories)."""
+
+    def __init__(self, walk, root):
+        self.walk = walk
+        self.root = root
+        self.count = 0
+
+    def __call__(self, top, *args, **kwargs):
+        if top == self.root:
+            self.count += 1
+        return self.walk(top, *args, **kwargs)
+
+
+if __name__ == '__main__':
+    system_path = tempfile.mkdtemp()
+    annotations_dir = os.path.join(system_path, u"system", u"config", u"Active Contents")
+    os.makedirs(annotations_dir)
+
+    books_dir = os.path.join(system_path, u"Books")
+    write_document(os.path.join(books_dir, u"Papers"), u"annotated.pdf", b"a")
+    write_document(books_dir, u"plain.pdf", b"p")
+
+    storage = pocketbook.AnnotationStorage(annotations_dir)
+    annotated = PocketbookAnnotatedDocument(u"annotated.pdf", os.path.join(books_dir, u"Papers"), storage)
+    for name in (u"annotated.pdf_A_%s.html" % annotated.file_hash,
+                 # the annotation file of a deleted document
+                 u"deleted.pdf_A_%s.html" % ("0" * 32)):
+        with open(os.path.join(annotations_dir, name), 'wb') as annotations_file:
+            annotations_file.write(b"<html></html>\n")
+
+    walk = CountingWalk(os.walk, system_path)
+    pocketbook.os.walk = walk
+    try:
+        importer = PocketbookAnnotationImporter(
+            system_path, annotations_dir, use_database=False,
+            discovery_mode=PocketbookAnnotationImporter.DISCOVERY_ANNOTATED_DOCUMENTS)
+
+        library = importer.get_annotated_library()
+        assert [document.full_path for document in library.get_documents()] == [annotated.full_path]
+        # the deleted document made the first library walk the drive
+        assert walk.count == 1
+
+        # the annotation file of a document copied to the reader only later
+        write_document(books_dir, u"late.pdf", b"l")
+        late = PocketbookAnnotatedDocument(u"late.pdf", books_dir, storage)
+        with open(storage.get_annotation_file(late), 'wb') as annotations_file:
+            annotations_file.write(b"<html></html>\n")
+        os.remove(late.full_path)
+
+        importer.notify_changed({annotations_dir})
+        library = importer.get_annotated_library()
+        assert len(library.get_documents()) == 1
+        assert walk.count == 2
+
+        # the document that was missing is found once it appears, the known one where it was
+        write_document(books_dir, u"late.pdf", b"l")
+        importer.notify_changed({annotations_dir})
+        library = importer.get_annotated_library()
+        assert sorted(document.full_path for document in library.get_documents()) == \
+            sorted([annotated.full_path, late.full_path])
+        assert walk.count == 3
+
+        # without a change the library is kept
+        assert importer.get_annotated_library() is library
+        assert walk.count == 3
+    finally:
+        pocketbook.os.walk = walk.walk
+
+    print("OK")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import sqlite3
+import tempfile
+
+from annotation_manager.plugins.pocketbook import PocketbookAnnotationImporter, PocketbookExporter, \
+    PocketbookSQLiteAnnotatedDocument
+from pdfloc_converter.pdfloc import PDFLocPair
+
+
+def create_drive(with_database):
+    system_path = tempfile.mkdtemp()
+    annotations_dir = os.path.join(system_path, u"system", u"config", u"Active Contents")
+    os.makedirs(annotations_dir)
+
+    books_dir = os.path.join(system_path, u"Books")
+    os.makedirs(books_dir)
+    with open(os.path.join(books_dir, u"paper.pdf"), 'wb') as document_file:
+        document_file.write(b"%PDF-1.4\n" + b"0" * 10000)
+
+    if with_database:
+        connection = sqlite3.connect(os.path.join(system_path, u"system", u"config", u"books.db"))
+        with connection:
+            connection.executescript(
+                "CREATE TABLE folders (id INTEGER PRIMARY KEY, name TEXT);"
+                "CREATE TABLE files (id INTEGER PRIMARY KEY, book_id INTEGER, folder_id INTEGER, filename TEXT, "
+                "size INTEGER);"
+                "CREATE TABLE items (id INTEGER PRIMARY KEY, parentid INTEGER, state INTEGER);"
+                "CREATE TABLE tagnames (id INTEGER PRIMARY KEY, name TEXT);"
+                "CREATE TABLE tags (id INTEGER PRIMARY KEY, itemid INTEGER, tagid INTEGER, val TEXT, "
+                "timeedt INTEGER);"
+                "INSERT INTO folders VALUES (1, '/mnt/ext1/Books');"
+                "INSERT INTO files VALUES (1, 7, 1, 'paper.pdf', 10009);"
+                "INSERT INTO items VALUES (100, 7, 0);"
+                "INSERT INTO tagnames VALUES (1, 'bm.book_mark'), (2, 'bm.quotation'), (3, 'bm.note');")
+            connection.executemany("INSERT INTO tags (itemid,tagid,val,timeedt) VALUES (100,?,?,1)", [
+                (1, json.dumps({'begin': "pdfloc(1,1,0,0,0)", 'end': "pdfloc(1,1,10,0,0)"})),
+                (2, u"highlighted"), (3, u"a note")])
+        connection.close()
+
+    return system_path, annotations_dir
+
+
+def get_document(system_path, annotations_dir):
+    library = PocketbookAnnotationImporter(system_path, annotations_dir).get_annotated_library()
+    return library.get_document_by_path(os.path.join(system_path, u"Books", u"paper.pdf"))
+
+
+def comments(document):
+    return [annotation.comment for annotation in document.get_annotations().pdfloc_annotations]
+
+
+if __name__ == '__main__':
+    exported = [PDFLocPair("#pdfloc(2,1,0,0,0)", "#pdfloc(2,1,10,0,0)", u"x < y && \"z\" > 'w'"),
+                PDFLocPair("#pdfloc(3,1,0,0,0)", "#pdfloc(3,1,10,0,0)", u"two\nlines")]
+
+    # the comments are read back as they were exported
+    system_path, annotations_dir = create_drive(False)
+    document = get_document(system_path, annotations_dir)
+    assert comments(document) == []
+
+    exporter = PocketbookExporter(annotations_dir, fsync=False)
+    assert exporter.add_annotations_to_document(document, exported) == 2
+    assert not os.listdir(annotations_dir)
+    exporter.flush()
+
+    document = get_document(system_path, annotations_dir)
+    print(comments(document))
+    assert comments(document) == [u"x < y && \"z\" > 'w'", u"two lines"]
+
+    # a new file is well-formed, the next entries are inserted before its closing tags
+    annotations_path = document.annotation_storage.get_annotation_file(document)
+    with open(annotations_path, 'rb') as annotations_file:
+        content = annotations_file.read()
+    assert content.startswith(b"<html>") and content.endswith(b"</body></html>\n")
+
+    exporter.add_annotations_to_document(document, [
+        PDFLocPair("#pdfloc(4,1,0,0,0)", "#pdfloc(4,1,10,0,0)", u"Příliš <žluťoučký>")])
+    exporter.flush()
+    with open(annotations_path, 'rb') as annotations_file:
+        appended = annotations_file.read()
+    footer_start = content.rindex(b"</body>")
+    assert appended.startswith(content[:footer_start]) and appended.endswith(b"</body></html>\n")
+    assert appended.count(b"</body>") == 1
+    # only the inserted entry is parsed again
+    assert comments(document) == [u"x < y && \"z\" > 'w'", u"two lines", u"Příliš <žluťoučký>"]
+
+    # the device writes the non-ASCII comments UTF-8 encoded, and its files may have no closing tags
+    with open(annotations_path, 'wb') as annotations_file:
+        annotations_file.write(appended[:appended.rindex(b"</body>")])
+        annotations_file.write(u'<!-- type="32" level="1" position="#pdfloc(5,1,0,0,0)" '
+                               u'endposition="#pdfloc(5,1,10,0,0)" '
+                               u'--!>\n<font color="#000000" size="2" face="Arial"></font><br>\n'
+                               u'<font color="#000000" size="3" face="Arial">Škola &amp; život</font><br>'
+                               .encode('utf-8'))
+    exporter.add_annotations_to_document(document, exported[:1])
+    exporter.flush()
+
+    document = get_document(system_path, annotations_dir)
+    assert comments(document)[2:] == [u"Příliš <žluťoučký>", u"Škola & život", u"x < y && \"z\" > 'w'"]
+
+    # the reader with a book database doesn't read the annotation files, so nothing is exported to its documents
+    system_path, annotations_dir = create_drive(True)
+    document = get_document(system_path, annotations_dir)
+    assert isinstance(document, PocketbookSQLiteAnnotatedDocument)
+    assert comments(document) == [u"a note"]
+    assert document.get_annotations().pdfloc_annotations[0].text == u"highlighted"
+
+    exporter = PocketbookExporter(annotations_dir, fsync=False)
+    assert exporter.add_annotations_to_document(document, exported) == 0
+    exporter.flush()
+    assert not os.listdir(annotations_dir)
+
+    print("OK")
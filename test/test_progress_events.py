@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+import threading
+
+from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.progress import ProgressEvent
+
+
+def write_library(path, documents):
+    with open(path, 'wb') as jsonl_file:
+        for document_path, positions in documents:
+            jsonl_file.write(json.dumps({'type': 'document', 'path': document_path,
+                                         'size': os.path.getsize(document_path), 'hashes': {}}, sort_keys=True) + "\n")
+            for position in positions:
+                jsonl_file.write(json.dumps({'type': 'annotation', 'annotation': {
+                    'type': 'bboxes', 'page': 1, 'comment': None,
+                    'bboxes': [{'page': 1, 'bbox': [72.0, position, 300.0, position + 12.0]}]}}) + "\n")
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    document_paths = []
+    for name in (u"first.pdf", u"second.pdf"):
+        document_paths.append(os.path.join(directory, name))
+        with open(document_paths[-1], 'wb') as document_file:
+            document_file.write(b"%PDF-1.4\n" + name.encode('utf-8') * (100 * len(document_paths)))
+
+    source_path = os.path.join(directory, "source.jsonl")
+    destination_path = os.path.join(directory, "destination.jsonl")
+    write_library(source_path, [(document_paths[0], [100, 500]), (document_paths[1], [300])])
+    write_library(destination_path, [(document_paths[0], [100]), (document_paths[1], [])])
+    source = u"jsonl" + os.pathsep + source_path
+    destination = u"jsonl" + os.pathsep + destination_path
+
+    manager = AnnotationManager()
+
+    received = []
+    manager.progress.subscribe(received.append)
+
+    # the generator is consumed by another thread while the sync runs
+    generated = []
+    events = manager.progress.events(timeout=10.0)
+    consumer = threading.Thread(target=lambda: generated.extend(events))
+    consumer.start()
+
+    statistics = manager.sync(source, destination)
+    consumer.join()
+
+    print("\n".join(str(event) for event in received))
+
+    assert statistics.documents_matched == 2 and statistics.annotations_exported == 2
+    assert [event.kind for event in generated] == [event.kind for event in received]
+
+    kinds = [event.kind for event in received]
+    assert kinds[0] == ProgressEvent.SYNC_STARTED and kinds[-1] == ProgressEvent.SYNC_FINISHED
+    assert kinds.count(ProgressEvent.DOCUMENT_DISCOVERED) == 4
+    assert kinds.count(ProgressEvent.DOCUMENT_MATCHED) == 2
+    assert kinds.count(ProgressEvent.DOCUMENT_FINISHED) == 2
+    # both sides are in the bbox form, so nothing has to be converted
+    assert ProgressEvent.CONVERSION_STARTED not in kinds and ProgressEvent.ERROR not in kinds
+
+    exported = [event for event in received if event.kind == ProgressEvent.ANNOTATIONS_EXPORTED]
+    assert sorted(event.count for event in exported) == [1, 1]
+
+    # the aggregates of the running sync are filled into every event
+    finished = received[-1]
+    assert finished.documents_done == 2 and finished.documents_total == 2
+    assert finished.throughput > 0 and finished.eta == 0
+
+    manager.progress.close()
+
+    print("OK")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.plugins.snapshot import SnapshotAnnotationImporter
+from annotation_manager.snapshot import write_snapshot
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    document_path = os.path.join(directory, u"paper.pdf")
+    with open(document_path, 'wb') as document_file:
+        document_file.write(b"%PDF-1.4\n" + b"0" * 10000)
+
+    source_path = os.path.join(directory, "source.jsonl")
+    with open(source_path, 'wb') as jsonl_file:
+        jsonl_file.write(json.dumps({'type': 'document', 'path': document_path,
+                                     'size': os.path.getsize(document_path), 'hashes': {}}, sort_keys=True) + "\n")
+        for position, text in ((100, u"Entropy of a źdźbło"), (300, None)):
+            annotation = {'type': 'bboxes', 'page': 1, 'comment': u"note %i" % position,
+                          'bboxes': [{'page': 1, 'bbox': [72.0, position, 300.0, position + 12.0]}]}
+            if text is not None:
+                annotation['text'] = text
+            jsonl_file.write(json.dumps({'type': 'annotation', 'annotation': annotation}, sort_keys=True) + "\n")
+
+    snapshot_path = os.path.join(directory, "library.snapshot")
+    manager = AnnotationManager()
+    assert write_snapshot(manager.get_library(u"jsonl" + os.pathsep + source_path), snapshot_path) == 1
+
+    # the highlighted texts are kept, the annotations without one don't get it
+    importer = SnapshotAnnotationImporter(snapshot_path)
+    library = importer.get_annotated_library()
+    annotations = library.get_document_by_path(document_path).get_annotations().bbox_annotations
+    print([(annotation.comment, getattr(annotation, 'text', None)) for annotation in annotations])
+    assert [annotation.comment for annotation in annotations] == [u"note 100", u"note 300"]
+    assert annotations[0].text == u"Entropy of a źdźbło" and not hasattr(annotations[1], 'text')
+
+    # a changed snapshot closes the mapping of the previous one
+    snapshot = library.snapshot
+    importer.notify_changed({snapshot_path})
+    assert snapshot._map is None and snapshot._file is None
+    assert importer.get_annotated_library() is not library
+
+    print("OK")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+from annotation_manager.AnnotationManager import AnnotationManager
+from annotation_manager.text_index import AnnotationTextIndex
+
+
+def write_records(jsonl_file, document_path, annotations):
+    jsonl_file.write(json.dumps({'type': 'document', 'path': document_path, 'size': 1000, 'hashes': {}},
+                                sort_keys=True) + "\n")
+    for page, text, comment in annotations:
+        annotation = {'type': 'pdfloc', 'start': "#pdfloc(%x,1,0,0,0)" % page, 'end': "#pdfloc(%x,1,10,0,0)" % page,
+                      'comment': comment}
+        if text is not None:
+            annotation['text'] = text
+        jsonl_file.write(json.dumps({'type': 'annotation', 'annotation': annotation}, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+
+    library_path = os.path.join(directory, "library.jsonl")
+    with open(library_path, 'wb') as jsonl_file:
+        write_records(jsonl_file, u"/books/entropy.pdf", [(1, u"Relative entropy search", None),
+                                                          (3, u"entropy", u"compare with REPS")])
+        write_records(jsonl_file, u"/books/planning.pdf", [(2, u"Stochastic planning", None),
+                                                           (4, None, None)])
+    source = u"jsonl" + os.pathsep + library_path
+
+    manager = AnnotationManager()
+    index = AnnotationTextIndex(os.path.join(directory, "index.sqlite"))
+    try:
+        assert manager.update_text_index([source], index) == 2
+        # nothing changed, nothing is reindexed
+        assert manager.update_text_index([source], index) == 0
+
+        results = index.search(u"entropy")
+        print([unicode(result) for result in results])
+        assert len(results) == 2
+        assert set(result.page for result in results) == {1, 3}
+        assert all(result.path == u"/books/entropy.pdf" and result.library == source for result in results)
+
+        # comments are indexed too, and the stored annotation is returned
+        results = index.search(u"REPS")
+        assert len(results) == 1
+        assert results[0].comment == u"compare with REPS" and results[0].annotation.text == u"entropy"
+
+        # all the words have to be present
+        assert index.search(u"stochastic entropy") == []
+        assert len(index.search(u"stochastic", library_name=u"other")) == 0
+
+        # new annotations appended to the library are found after the update
+        with open(library_path, 'ab') as jsonl_file:
+            write_records(jsonl_file, u"/books/planning.pdf", [(5, u"Monte Carlo tree search", None)])
+        manager.forget_libraries(source)
+        assert manager.update_text_index([source], index) >= 1
+        assert [result.page for result in index.search(u"carlo")] == [5]
+
+        index.remove_library(source)
+        assert index.search(u"entropy") == []
+    finally:
+        index.close()
+
+    print("OK")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import print_function
+
+from annotation_manager.common_representation import AnnotatedDocument, AnnotationSet, AnnotationSetCache, \
+    AnnotationSubset, match_annotations_by_text, set_annotation_text
+from pdfloc_converter.pdfloc import PDFLocPair
+
+
+class Document(AnnotatedDocument):
+    """A document with fixed pdfloc annotations, counting how many times they were loaded."""
+
+    def __init__(self, full_path, pdflocs):
+        super(Document, self).__init__(full_path, 1000)
+        self.pdflocs = pdflocs
+        self.loads = 0
+
+    def get_annotations_version(self):
+        return 1
+
+    def _load_annotations(self):
+        self.loads += 1
+        annotations = AnnotationSet()
+        annotations.pdfloc_annotations.extend(self.pdflocs)
+        return annotations
+
+
+def highlight(page, position, text=None, comment=None):
+    start = "#pdfloc(%x,1,%i,0,0)" % (page, position)
+    end = "#pdfloc(%x,1,%i,0,0)" % (page, position + 10)
+    return set_annotation_text(PDFLocPair(start, end, comment), text)
+
+
+if __name__ == '__main__':
+    # the same phrase highlighted twice on one page, and once on the other side
+    mine = AnnotationSubset([highlight(1, 10, u"Entropy"), highlight(1, 50, u"entropy"),
+                             highlight(2, 10, u"Stochastic  search")], [])
+    other = AnnotationSubset([highlight(1, 10, u"entropy"), highlight(2, 12, u"stochastic search")], [])
+
+    common, unresolved_mine, unresolved_other = match_annotations_by_text(mine, other)
+    print(common)
+
+    # only the unambiguous highlight is matched by its text
+    assert len(common) == 1
+    assert common[0][0] is mine.pdfloc_annotations[2] and common[0][1] is other.pdfloc_annotations[1]
+
+    # both duplicates are left to the geometric comparison, so the second one can still be exported
+    assert unresolved_mine.pdfloc_annotations == mine.pdfloc_annotations[:2]
+    assert unresolved_other.pdfloc_annotations == other.pdfloc_annotations[:1]
+
+    # different highlights sharing a note are not matched by the note
+    mine = AnnotationSubset([highlight(3, 10, comment=u"important")], [])
+    other = AnnotationSubset([highlight(3, 80, comment=u"important")], [])
+
+    common, unresolved_mine, unresolved_other = match_annotations_by_text(mine, other)
+    assert len(common) == 0
+    assert len(unresolved_mine.pdfloc_annotations) == 1 and len(unresolved_other.pdfloc_annotations) == 1
+
+    # documents have to implement the loading of their annotations
+    try:
+        type('Incomplete', (AnnotatedDocument,), {})(u"/paper.pdf", 1000)
+        assert False
+    except TypeError:
+        pass
+
+    # the conversions of the part left after the text matching are kept by the cached set of the document
+    mine = Document(u"/mine/paper.pdf", [highlight(1, 10, u"entropy"), highlight(2, 10, u"search")])
+    other = Document(u"/other/paper.pdf", [highlight(1, 10, u"entropy"), highlight(3, 10)])
+    cache = AnnotationSetCache()
+    mine.annotation_cache = other.annotation_cache = cache
+
+    common, only_mine, only_other = mine.find_common_annotations(other)
+    assert len(common) == 1 and len(only_mine) == 1 and len(only_other) == 1
+    annotations = mine.get_annotations()
+    assert mine.loads == 1
+    assert len(annotations.bbox_annotations) == len(annotations.pdfloc_annotations) == 2
+
+    print("OK")